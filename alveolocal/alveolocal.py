@@ -1,13 +1,20 @@
 # -*- coding: utf-8 -*-
 
 import os
+from collections import OrderedDict
+from itertools import islice
 
-from rdflib import Graph, URIRef
+from rdflib import URIRef
 from namespaces import RDF, DCMITYPE, DC, AUSNC, HCSVLAB, DADA, XSD, PROV, LOCALTERMS, RDFS, XYZZY, FOAF
 from uuid import uuid4
 from rdflib.term import Literal
-from rdflib.plugins.sparql.processor import prepareQuery
-from base import Store
+from base import registry
+from documents import DocumentIndex
+from annotations import AnnotationIndex, KIND_TYPES
+from textcache import TextCache
+from offsets import OffsetIndexes
+from ids import IdAllocator
+from queries import sparql
 import requests
 import json
 
@@ -16,25 +23,106 @@ class API(object):
     """The Alveo API"""
 
     base_url = "http://localhost:3000/"
-    last_generated_ann_id = None
+    # the most memory used to cache the text of documents
+    text_cache_bytes = 64 * 1024 * 1024
+    # the SPARQL queries run, with their counters
+    queries = sparql
+    # how many annotations a bulk upload adds to the graph at a time
+    annotation_batch_size = 10000
+    # how many items get_items_metadata_json looks up together
+    metadata_batch_size = 500
 
-    def attach_directory(self, dirname):
+    def attach_directory(self, dirname, workers=1, snapshot=None, lazy=False, max_collections=None,
+                         backend="memory", database=None, fast=False):
         """Attach to a directory containing RDF files
-        and deliver data from there"""
+        and deliver data from there. If workers > 1 the
+        files are parsed in that many worker processes.
+        snapshot is the path of a snapshot file used to
+        avoid parsing files that have not changed.
+        If lazy is True a collection is only loaded when it
+        is first asked for and at most max_collections are
+        kept loaded. With backend "sqlite" the triples are
+        kept in the SQLite database at database, with backend
+        "compact" they are kept in memory as integer ids.
+        If fast is True Turtle files are read with the fast
+        line based parser where possible.
 
-        self.graph = Graph()
-        self.basedir = dirname
+        The graph is shared with anything else in this process
+        that attaches to the same directory with the same options.
+        Attaching again lets go of the directory attached to before"""
 
-        for dirpath, _, filenames in os.walk(dirname):
-            
-            for filename in filenames:
-                if filename.endswith(".rdf"):
-                    self.graph.parse(os.path.join(dirpath, filename), format='turtle')
-                elif filename.endswith(".n3"):
-                    self.graph.parse(os.path.join(dirpath, filename), format='n3')
+        store = registry.acquire(dirname, workers=workers, snapshot=snapshot, lazy=lazy,
+                                 max_collections=max_collections, backend=backend, database=database,
+                                 fast=fast)
+        # acquired first so that the same store is not dropped and loaded again
+        self.detach()
+        self.store = store
+        self.graph = self.store.graph
+        self.basedir = dirname
+        # item URI -> (collection version, JSON metadata)
+        self.metadata_cache = dict()
+        # collection URI -> (collection version, summary), kept while
+        # a collection is unloaded to answer for it in lazy mode
+        self.summary_cache = dict()
+        self.text_cache = TextCache(self.text_cache_bytes)
+        self.offset_indexes = OffsetIndexes()
+        # collection id -> (collection version, DocumentIndex)
+        self.document_indexes = dict()
+        # collection id -> (collection version, AnnotationIndex)
+        self.annotation_indexes = dict()
+        # collection id -> IdAllocator of annotation numbers
+        self.annotation_ids = dict()
+        self.store.unload_hooks.append(self._forget_collection)
+        if not lazy:
+            # find the documents now so that missing ones are reported up front
+            for collection_uri in self.get_collections():
+                self._document_index(self._collection_id(collection_uri))
+                self._annotation_index(self._collection_id(collection_uri))
 
         return len(self.graph)
 
+    def detach(self):
+        """Let go of the directory attached to, if any"""
+
+        if getattr(self, "store", None) is None:
+            return
+        self.store.unload_hooks.remove(self._forget_collection)
+        registry.release(self.store)
+        self.store = None
+
+    def _forget_collection(self, collection_id):
+        """Drop what is cached about a collection that has been
+        unloaded, so that no more is kept than max_collections allows"""
+
+        self.document_indexes.pop(collection_id, None)
+        self.annotation_indexes.pop(collection_id, None)
+        prefix = self.base_url + "catalog/" + collection_id + "/"
+        for item_uri in [uri for uri in self.metadata_cache.keys() if uri.startswith(prefix)]:
+            self.metadata_cache.pop(item_uri, None)
+
+    def reload(self):
+        """Pick up RDF files that have been added, modified or
+        deleted since the directory was attached, and look for
+        the documents again. Returns the paths of the RDF files
+        added, modified and deleted as a dictionary"""
+
+        result = self.store.reload()
+        self.document_indexes.clear()
+        return result
+
+    def get_version(self, uri=None):
+        """Return (version, time) for the triples of the collection
+        that uri belongs to, or for all of them if uri is None.
+        The version changes whenever the triples do and time is
+        when they last changed"""
+
+        if uri is None:
+            return self.store.generation, self.store.modified()
+
+        self._require(uri)
+        collection_id = self._collection_id(uri)
+        return self.store.version(collection_id), self.store.modified(collection_id)
+
     def version(self):
         """Return the current API version string"""
 
@@ -53,9 +141,10 @@ class API(object):
     def get_collection(self, collection_uri):
         """Return the collection metadata for this collection"""
         
+        prefixes = self.store.prefix_map()
         meta = dict()
         for _,p,o in self.graph.triples((URIRef(collection_uri), None, None)):
-            meta[p.n3(self.graph.namespace_manager)] = o.toPython()
+            meta[prefixes.qname(p)] = o.toPython()
         
         name = self.graph.value(URIRef(collection_uri), DC.alternative).toPython()
         return {'collection_url': collection_uri,
@@ -63,6 +152,74 @@ class API(object):
                 'metadata': meta,
                 }
 
+    def get_collection_summary(self, collection_uri):
+        """Return the collection metadata for this collection
+        along with the number of items, documents and annotations
+        it holds. The summary is kept until the triples of the
+        collection change.
+
+        In lazy mode a collection that is not loaded is not loaded
+        for its summary, the last summary made while it was loaded
+        is returned or, if there is none, one whose counts are None"""
+
+        collection_id = self._collection_id(collection_uri)
+        if not self.store.is_loaded(collection_id):
+            cached = self.summary_cache.get(collection_uri)
+            if cached is not None:
+                return cached[1]
+            summary = self.get_collection(collection_uri)
+            summary['num_items'] = summary['num_documents'] = summary['num_annotations'] = None
+            return summary
+
+        with self.store.using(collection_id):
+            version = self.store.version(collection_id)
+            cached = self.summary_cache.get(collection_uri)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+
+            summary = self.get_collection(collection_uri)
+            items = set(self.graph.subjects(DC.isPartOf, URIRef(collection_uri)))
+            documents = set()
+            for item in items:
+                documents.update(self.graph.objects(item, AUSNC.document))
+
+            summary['num_items'] = len(items)
+            summary['num_documents'] = len(documents)
+            summary['num_annotations'] = sum(self._annotation_index(collection_id).type_counts.values())
+            self.summary_cache[collection_uri] = (version, summary)
+            return summary
+
+    def get_collection_summaries(self):
+        """Return the summary of every collection in the store"""
+
+        return [self.get_collection_summary(collection_uri) for collection_uri in self.get_collections()]
+
+    def has_collection(self, collection_id):
+        """True if there is a collection with this id"""
+
+        return collection_id is not None and \
+            (URIRef(self.base_url + "catalog/" + collection_id), RDF.type, DCMITYPE.Collection) in self.graph
+
+    def _collection_id(self, uri):
+        """Return the id of the collection that a catalog or
+        document URI belongs to, None if it is not one of ours"""
+
+        for prefix in (self.base_url + "catalog/", self.base_url + "documents/"):
+            if uri.startswith(prefix):
+                return uri[len(prefix):].split("/")[0]
+        return None
+
+    def _require(self, uri):
+        """Make sure the collection that uri belongs to is loaded"""
+
+        self.store.require(self._collection_id(uri))
+
+    def _using(self, uri):
+        """A context manager that keeps the collection uri belongs
+        to loaded while the graph is read"""
+
+        return self.store.using(self._collection_id(uri))
+
     def _corpus_name(self, item_uri):
         """Return the name of the corpus this item is part of"""
 
@@ -80,10 +237,98 @@ class API(object):
 
         return os.path.join(item_uri, "primary_text.json")      
 
+    def get_item_metadata_json(self, item_uri):
+        """Return the metadata for the given item identifier
+        serialised as JSON. The JSON is kept until the triples
+        of the item's collection change or a prefix is bound with
+        Store.bind, which changes the qnames in it"""
+
+        with self._using(item_uri):
+            version = self._metadata_version(self._collection_id(item_uri))
+            cached = self.metadata_cache.get(item_uri)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+
+            result = json.dumps(self.get_item_metadata(item_uri))
+            if (URIRef(item_uri), None, None) in self.graph:
+                self.metadata_cache[item_uri] = (version, result)
+            return result
+
+    def get_items_metadata_json(self, item_uris):
+        """Generate the JSON metadata for each of a list of item
+        identifiers, in the same order. An item that can't be
+        found gives a JSON object with an error message in its
+        place.
+
+        The items are taken metadata_batch_size at a time and those
+        of each collection in a batch are looked up together, so the
+        collection is loaded and its version and prefixes found once"""
+
+        item_uris = iter(item_uris)
+        while True:
+            batch = list(islice(item_uris, self.metadata_batch_size))
+            if not batch:
+                return
+            for result in self._items_metadata_json(batch):
+                yield result
+
+    def _items_metadata_json(self, item_uris):
+        """Return the JSON metadata of each of a list of item
+        identifiers, looked up a collection at a time"""
+
+        results = [None] * len(item_uris)
+        # collection id -> positions of its items in item_uris
+        collections = OrderedDict()
+        for i, item_uri in enumerate(item_uris):
+            if not isinstance(item_uri, basestring) or self._collection_id(item_uri) is None:
+                results[i] = self._item_error(item_uri, u"not an item URL")
+            else:
+                collections.setdefault(self._collection_id(item_uri), []).append(i)
+
+        for collection_id, positions in collections.items():
+            with self.store.using(collection_id):
+                version = self._metadata_version(collection_id)
+                prefixes = self.store.prefix_map()
+                for i in positions:
+                    item_uri = item_uris[i]
+                    cached = self.metadata_cache.get(item_uri)
+                    if cached is not None and cached[0] == version:
+                        results[i] = cached[1]
+                        continue
+                    # the item's triples show whether it is there and give its documents
+                    properties = list(self.graph.predicate_objects(URIRef(item_uri)))
+                    if not properties:
+                        results[i] = self._item_error(item_uri, u"item not found")
+                        continue
+                    try:
+                        results[i] = json.dumps(self._item_metadata(item_uri, properties, prefixes))
+                    except Exception as e:
+                        results[i] = self._item_error(item_uri, unicode(e))
+                        continue
+                    self.metadata_cache[item_uri] = (version, results[i])
+        return results
+
+    def _metadata_version(self, collection_id):
+        """Return what the cached metadata JSON of an item in this
+        collection is kept for"""
+
+        return (self.store.version(collection_id), self.store.bindings)
+
+    def _item_error(self, item_uri, error):
+        return json.dumps({u'alveo:catalog_url': item_uri, u'error': error})
+
     def get_item_metadata(self, item_uri):
         """Return all metadata for the given item identifier as a
         dictionary"""
         
+        with self._using(item_uri):
+            properties = list(self.graph.predicate_objects(URIRef(item_uri)))
+            return self._item_metadata(item_uri, properties, self.store.prefix_map())
+
+    def _item_metadata(self, item_uri, properties, prefixes):
+        """Return the metadata dictionary of an item given the
+        (predicate, object) of each of its triples"""
+
         meta = {
             u'alveo:annotations_url': self._annotation_url(item_uri),
             u'alveo:primary_text_url': self._primary_text_url(item_uri),
@@ -115,9 +360,8 @@ class API(object):
                          
                          ]
         
-        for _,p,o in self.graph.triples((URIRef(item_uri), None, None)):
-            #meta[u'alveo:metadata'][p.n3(self.graph.namespace_manager)] = o.n3(self.graph.namespace_manager)
-            meta[u'alveo:metadata'][p.n3(self.graph.namespace_manager)] = o.toPython()
+        for p, o in properties:
+            meta[u'alveo:metadata'][prefixes.qname(p)] = o.toPython()
             
         for key in meta_required:
             if not key in meta[u'alveo:metadata']:
@@ -126,7 +370,7 @@ class API(object):
         # get documents and add metadata
         types = []
         docs = []
-        for _,p,o in self.graph.triples((URIRef(item_uri), AUSNC.document, None)):
+        for o in [o for p, o in properties if p == AUSNC.document]:
             dm = self._document_metadata(o)
             meta[u'alveo:documents'].append(dm)
             
@@ -152,11 +396,13 @@ class API(object):
              u'dcterms:type': u'',
              u'rdf:type': u'http://xmlns.com/foaf/0.1/Document',
         }
+        prefixes = self.store.prefix_map()
         for _,p,o in self.graph.triples((doc_uri, None, None)):
-            if p.n3(self.graph.namespace_manager) == u'dc:source':
+            qname = prefixes.qname(p)
+            if qname == u'dc:source':
                 meta[u'alveo:url'] = str(o)
             else:
-                meta[p.n3(self.graph.namespace_manager)] = o.toPython()
+                meta[qname] = o.toPython()
         
          
         return meta
@@ -174,132 +420,246 @@ class API(object):
     def _get_display_document_url(self, item_uri):
         """Return the url of the display document if any, None if not"""
 
-        # get the display document
-        doc_uri = self.graph.value(subject=URIRef(item_uri), predicate=HCSVLAB.indexable_document)
-        source = self.graph.value(subject=doc_uri, predicate=DC.source)
+        with self._using(item_uri):
+            # get the display document
+            doc_uri = self.graph.value(subject=URIRef(item_uri), predicate=HCSVLAB.indexable_document)
+            source = self.graph.value(subject=doc_uri, predicate=DC.source)
 
-        if doc_uri is None:
-            return None
+            if doc_uri is None:
+                return None
         
-        return str(source)
+            return str(source)
         
         
+    def _document_index(self, collection_id):
+        """Return the DocumentIndex of a collection, rebuilt
+        if the triples of the collection have changed. The index
+        of a collection that does not exist is empty and not kept"""
+
+        if not self.has_collection(collection_id):
+            return DocumentIndex(self.graph, self.base_url + "catalog/" + unicode(collection_id), self._uri_to_path)
+        with self.store.using(collection_id):
+            version = self.store.version(collection_id)
+            cached = self.document_indexes.get(collection_id)
+            if cached is None or cached[0] != version:
+                index = DocumentIndex(self.graph, self.base_url + "catalog/" + collection_id, self._uri_to_path)
+                cached = self.document_indexes[collection_id] = (version, index)
+        return cached[1]
+
+    def _annotation_index(self, collection_id):
+        """Return the AnnotationIndex of a collection, rebuilt
+        if the triples of the collection have changed. The index
+        of a collection that does not exist is empty and not kept"""
+
+        if not self.has_collection(collection_id):
+            return AnnotationIndex(self.graph, self.base_url + "catalog/" + unicode(collection_id))
+        with self.store.using(collection_id):
+            version = self.store.version(collection_id)
+            cached = self.annotation_indexes.get(collection_id)
+            if cached is None or cached[0] != version:
+                index = AnnotationIndex(self.graph, self.base_url + "catalog/" + collection_id)
+                cached = self.annotation_indexes[collection_id] = (version, index)
+        return cached[1]
+
+    def missing_documents(self):
+        """Return the (document URI, path) of every document indexed
+        so far whose file was not in the local store"""
+
+        result = []
+        for _, index in self.document_indexes.values():
+            result.extend(index.missing)
+        return result
+
+    def get_display_document(self, item_uri):
+        """Return the (path, size, mtime) of the display document
+        of this item if any, None if not"""
+
+        collection_id = self._collection_id(item_uri)
+        if collection_id is None:
+            return None
+        return self._document_index(collection_id).display_document(item_uri)
+
+    def get_primary_text_path(self, item_uri):
+        """Return the local path of the primary text for this
+        item if any, None if not"""
+
+        document = self.get_display_document(item_uri)
+        if document is None:
+            return None
+        return document[0]
+
     def get_primary_text(self, item_uri):
         """Return the primary text for this item if any, None if not"""
         
-        # get the display document
-        source = self._get_display_document_url(item_uri)
-        
-        if source is None:
-            return None
-        
-        # locate it in local storage
-        sourcepath = self._uri_to_path(source)
+        sourcepath = self.get_primary_text_path(item_uri)
         
-        if not os.path.exists(sourcepath):
+        if sourcepath is None:
             return None
         
         # read the text
-        with open(sourcepath, 'rb') as fp:
-            text = fp.read()
-        
-        # return it
-        return text.decode("utf-8")
-        
+        try:
+            return self.text_cache.read(sourcepath, "utf-8", self.get_document_file(sourcepath))
+        except (IOError, OSError):
+            return None
+
+    def get_document_path(self, collection_id, file_name):
+        """Return the local path of a document in a collection,
+        None if the collection has no such document"""
+
+        uri = "%sdocuments/%s/%s" % (self.base_url, collection_id, file_name)
+        return self._document_index(collection_id).paths.get(uri)
+
+    def get_document_file(self, path):
+        """Return what compress.locate found for the document at
+        path when its collection was indexed, None if it was not there"""
+
+        collection_id = os.path.relpath(path, self.basedir).split(os.sep)[0]
+        return self._document_index(collection_id).files.get(path)
+
+    def get_document_files(self, path):
+        """Return what compress.locate_all found for the document at
+        path when its collection was indexed, the uncompressed file
+        first, an empty list if it was not there"""
+
+        collection_id = os.path.relpath(path, self.basedir).split(os.sep)[0]
+        return self._document_index(collection_id).variants.get(path, [])
+
     def get_document(self, collection_id, file_name):
-        path = os.path.join(self.basedir, collection_id, file_name)
-        with open(path) as textfile:
-            text = textfile.read()
-        return text
-        
-    def get_annotations(self, item_uri, filters):
-        """Return the annotations for this item as a dictionary"""
+        path = self.get_document_path(collection_id, file_name)
+        found = None if path is None else self.get_document_file(path)
+        if found is None:
+            raise IOError(2, "No such file or directory", file_name)
+        return self.text_cache.read(path, None, found)
+
+    def get_text_slices(self, item_uri, annotation_ids=(), spans=()):
+        """Return the primary text of this item under each of a list of
+        annotations, given by URI or by the id at the end of it, then
+        between each of a list of (start, end) character offsets. Each
+        slice is a dictionary, an annotation that is not a text
+        annotation of this item gives an error message in its place.
+        Return None if the item has no primary text"""
+
+        sourcepath = self.get_primary_text_path(item_uri)
+        if sourcepath is None:
+            return None
+
+        item = URIRef(item_uri)
+        prefix = "%scatalog/%s/annotation/" % (self.base_url, self._collection_id(item_uri))
+        slices = []
+        for annid in annotation_ids:
+            annotation = URIRef(annid if annid.startswith(self.base_url) else prefix + annid)
+            region = self.graph.value(subject=annotation, predicate=DADA.targets)
+            annotates = self.graph.value(subject=self.graph.value(subject=annotation, predicate=DADA.partof),
+                                         predicate=DADA.annotates)
+            if annotates != item or (region, RDF.type, DADA.UTF8Region) not in self.graph:
+                slices.append({'@id': annid, 'error': "not a text annotation of this item"})
+                continue
+            slices.append({'@id': str(annotation),
+                           'type': str(self.graph.value(subject=annotation, predicate=DADA.type)),
+                           'start': self.graph.value(subject=region, predicate=DADA.start).toPython(),
+                           'end': self.graph.value(subject=region, predicate=DADA.end).toPython(),
+                           })
+        for start, end in spans:
+            slices.append({'start': start, 'end': end})
+
+        found = [s for s in slices if 'error' not in s]
+        texts = self.offset_indexes.read(sourcepath, [(s['start'], s['end']) for s in found],
+                                         self.get_document_file(sourcepath))
+        for s, text in zip(found, texts):
+            s['text'] = text
+        return slices
+        
+    def get_annotations(self, item_uri, filters, offset=0, limit=None):
+        """Return the annotations for this item as a dictionary. The
+        filters type, user, priorTo and start and end, which keep the
+        annotations that overlap start up to end, can be combined.
+        Only limit annotations from offset on are included if limit
+        is given"""
         
         result = {'@context': "https://app.alveo.edu.au/schema/json-ld",
                   'commonProperties': {},
                   }
-                  
+        result['alveo:annotations'] = list(self.iter_annotations(item_uri, filters, offset, limit)[1])
+        result['commonProperties']['alveo:annotates'] = self._get_display_document_url(item_uri)
+        
+        return result
+
+    def iter_annotations(self, item_uri, filters=None, offset=0, limit=None):
+        """Return the number of annotations for this item that pass the
+        filters, as for get_annotations, and a generator of those from
+        offset on as dictionaries, at most limit of them if it is given.
+        Each dictionary is only made when it is asked for"""
+
         if filters is None:
             filters = {}
-        anns = []
+        index = self._annotation_index(self._collection_id(item_uri))
+        annotations = index.get(item_uri)
+        type_id = None
+        if "type" in filters:
+            type_id = index.term_ids.get(unicode(self._denamespace(filters["type"])), -1)
+        start = float(filters["start"]) if "start" in filters else None
+        end = float(filters["end"]) if "end" in filters else None
+
+        # the user and priorTo filters are not in the index, the
+        # annotations that pass them are found by a query
+        annids = None
+        names = []
         initBindings = {"item":URIRef(item_uri)}
-        query = prepareQuery("""select ?annotation where {
-                                                          ?annotation dada:partof ?annCollection.
-                                                          ?annCollection dada:annotates ?item.
-                                                       }""", initNs={"dada":DADA})
+        if "user" in filters:
+            # users are known by the email address recorded with their uploads
+            initBindings["user"] = URIRef("mailto:" + filters["user"])
+            names.append("by_user")
         if "priorTo" in filters:
-            initBindings = {"item":URIRef(item_uri),
-                            "givenTime":Literal(filters["priorTo"].strftime('%Y-%m-%dT%I:%M:%S'), datatype=XSD.dateTime)}
-            query = prepareQuery("""select ?annotation where {
-                                                              ?annotation dada:partof ?annCollection.
-                                                              ?annCollection dada:annotates ?item.
-                                                              ?annCollecction prov:generatedAtTime ?time.
-                                                              FILTER (?time < ?givenTime)
-                                                           }""", initNs={"dada":DADA,
-                                                                         "prov":PROV})
-        elif "user" in filters:
-            initBindings = {"item":URIRef(item_uri),
-                            "user":Literal(filters["user"])}
-            query = prepareQuery("""select ?annotation where {
-                                                              ?annotation dada:partof ?annCollection.
-                                                              ?annCollection dada:annotates ?item.
-                                                              ?annCollection prov:generatedBy ?activity.
-                                                              ?activity prov:wasAssociatedWith ?user.
-                                                           }""", initNs={"dada":DADA,
-                                                                         "prov":PROV})
-        elif "type" in filters:
-            initBindings = {"item":URIRef(item_uri),
-                            "type":URIRef(self._denamespace(filters["type"]))}
-            query = prepareQuery("""select ?annotation where {
-                                                              ?annotation dada:partof ?annCollection.
-                                                              ?annCollection dada:annotates ?item.
-                                                              ?annotation dada:type ?type
-                                                           }""", initNs={"dada":DADA})
-        annResults = self.graph.query(query, initBindings=initBindings)
-        annIDs = [annResult["annotation"] for annResult in annResults.bindings]
-        for annid in annIDs:
+            initBindings["givenTime"] = Literal(filters["priorTo"].strftime('%Y-%m-%dT%I:%M:%S'), datatype=XSD.dateTime)
+            names.append("prior_to")
+        if names:
+            with self._using(item_uri):
+                annResults = sparql.run(self.graph, "_".join(["annotations"] + names), initBindings)
+                annids = set(unicode(r["annotation"]) for r in annResults.bindings)
+
+        rows = annotations.select(type_id, annids, start, end)
+        page = rows[offset:] if limit is None else rows[offset:offset + limit]
+        return len(rows), self._annotation_dicts(index, annotations.values(page))
+
+    def _annotation_dicts(self, index, values):
+        """Generate the dictionary for each annotation from the
+        values of its row in an AnnotationIndex"""
+
+        prefixes = self.store.prefix_map()
+        for annid, kind, type_id, label_id, start, end, extra in values:
             ann = {
                 '@id': str(annid),
-                '@type': '',
-                'label': str(self.graph.value(subject=annid, predicate=DADA.label)),
-                'type': str(self.graph.value(subject=annid, predicate=DADA.type)),
-                'start': '',
-                'end': '',
+                '@type': KIND_TYPES[kind],
+                'label': index.terms[label_id],
+                'type': index.terms[type_id],
+                'start': start,
+                'end': end,
             }
-            
-            region = self.graph.value(subject=annid, predicate=DADA.targets)
-            ann['start'] = self.graph.value(subject=region, predicate=DADA.start).toPython()
-            ann['end'] = self.graph.value(subject=region, predicate=DADA.end).toPython()
-            
-            atype = self.graph.value(subject=region, predicate=RDF.type)
-            if atype == DADA.UTF8Region:
-                ann['@type'] = 'dada:TextAnnotation'
-            elif atype == DADA.SecondRegion:
-                ann['@type'] = 'dada:SecondAnnotation'
-            
-            
-            for _,p,o in self.graph.triples((annid, None, None)):
-                if p not in [DADA.label, DADA.type, DADA.targets, RDF.type, DADA.partof]:
-                    ann[p.n3(self.graph.namespace_manager)] = o.toPython()
-            
-            anns.append(ann)
-                
-                
-        result['alveo:annotations'] = anns
-        result['commonProperties']['alveo:annotates'] = self._get_display_document_url(item_uri)
-        
-        return result
-        
-    def get_annotation_types(self, item_uri):
+            for p, o in extra:
+                ann[prefixes.qname(p)] = o
+            yield ann
+
+    def get_annotation_types(self, item_uri, counts=False):
+        """Return the types of the annotations on this item, with the
+        number of annotations of each type if counts is True"""
+
+        index = self._annotation_index(self._collection_id(item_uri))
         result = {"item_url":item_uri}
-        types = []
-        for aset in self.graph.subjects(DADA.annotates, URIRef(item_uri)):
-            for annid in self.graph.subjects(DADA.partof, aset):
-                dadatype = self.graph.value(subject=annid, predicate=DADA.type).toPython()
-                if not dadatype in types:
-                    types.append(dadatype)
-                
-        result["annotation_types"] = types
+        return self._annotation_types(result, index.types(index.get(item_uri).type_counts), counts)
+
+    def get_collection_annotation_types(self, collection_uri, counts=False):
+        """Return the types of the annotations on the items of this
+        collection, with the number of annotations of each type if
+        counts is True"""
+
+        index = self._annotation_index(self._collection_id(collection_uri))
+        result = {"collection_url":collection_uri}
+        return self._annotation_types(result, index.types(index.type_counts), counts)
+
+    def _annotation_types(self, result, types, counts):
+        result["annotation_types"] = [t for t, _ in types]
+        if counts:
+            result["annotation_type_counts"] = dict(types)
         return result
              
         
@@ -323,14 +683,8 @@ class API(object):
     
     def _denamespace(self, qname):
         """Return the full url for qname e.g. dada:partof according to the graph prefixes"""
-    
-        for ns in self.graph.namespaces():
-            parts = qname.split(':')
-            if ns[0] == parts[0]:
-                suffix = qname.split(':')[1]
-                return URIRef(ns[1] + suffix)
-        
-        return qname
+
+        return self.store.prefix_map().uri(qname)
         
     
     def search(self, query):
@@ -341,7 +695,7 @@ class API(object):
         matching item identifiers"""
         
         
-        sparql = """SELECT ?item WHERE {
+        query_text = """SELECT ?item WHERE {
             ?item rdf:type ausnc:AusNCObject . 
             %s
         }"""
@@ -350,20 +704,28 @@ class API(object):
         for pred, value in query:
             terms += "?item %s '%s' .\n" % (pred, value)
         
-        sparql = sparql % terms
+        query_text = query_text % terms
                 
-        result = self.graph.query(sparql)
-        items = [str(m[0]) for m in result]        
+        if not self.store.lazy:
+            result = sparql.run(self.graph, 'search', text=query_text)
+            return [str(m[0]) for m in result]
+
+        # only some collections are loaded at a time so
+        # visit each of them in turn
+        items = []
+        for collection_id in self.store.collection_ids():
+            with self.store.using(collection_id):
+                for m in sparql.run(self.graph, 'search', text=query_text):
+                    if not str(m[0]) in items:
+                        items.append(str(m[0]))
         
         return items
     
     def search_sparql(self, collection_uri, query):
         collection_id = self._get_id(collection_uri)
         output = {"head":{"vars":[]}, "results":{"bindings":[]}}
-        subgraph = Store()
-        subgraph.attach_directory(os.path.join(self.basedir, collection_id))
-        subgraph.graph.parse(os.path.join(self.basedir, collection_id+".n3"), format='n3')
-        result = subgraph.graph.query(query)        
+        with self.store.using(collection_id):
+            result = sparql.run(self.store.view(collection_id), 'search_sparql', text=query)
         for var in result.vars:
             output["head"]["vars"].append(str(var))
         for binding in result.bindings:
@@ -394,146 +756,171 @@ class API(object):
             data = params["data"]
         if "filename" in params:
             filename = params["filename"]
-        g = Graph()
-        g.bind("dada", "http://purl.org/dada/schema/0.2#")
+        with self._using(collection_uri):
+            ann_coll_id, triples = self._annotation_triples(collection_uri, data)
+            collection_id = self._get_id(collection_uri)
+            path = os.path.join(self.basedir, collection_id, filename+".n3")
+            self._save_annotations(collection_id, path, 'w', triples,
+                                   [(URIRef(data["metadata"]["alveo:annotates"]), URIRef(ann_coll_id))])
+            return {"success":"file %s uploaded successfully" % filename}
+
+    def add_annotations(self, collection_uri, documents, filename=None):
+        """Add the annotations of each of a sequence of documents, as
+        uploaded to add_annotation, to one new file in the collection.
+        Documents are only read as they are needed and every
+        annotation_batch_size annotations those so far are appended to
+        the file in one write and added to the graph.
+
+        A document that cannot be read or is missing a field stops
+        the upload. The documents before it are still added and the
+        result gives the error and the position of the bad document
+        as failed_document, counting from 0"""
+
+        with self._using(collection_uri):
+            collection_id = self._get_id(collection_uri)
+            if filename is None:
+                filename = "annotations-%s" % uuid4()
+            path = os.path.join(self.basedir, collection_id, filename+".n3")
+
+            triples, annotated, pending = [], [], 0
+            num_documents = num_annotations = 0
+            error = None
+            documents = iter(documents)
+            while True:
+                try:
+                    data = next(documents)
+                    ann_coll_id, document_triples = self._annotation_triples(collection_uri, data)
+                except StopIteration:
+                    break
+                except (ValueError, KeyError, TypeError) as e:
+                    error = e
+                    break
+                triples.extend(document_triples)
+                annotated.append((URIRef(data["metadata"]["alveo:annotates"]), URIRef(ann_coll_id)))
+                num_documents += 1
+                num_annotations += len(data["alveo:annotations"])
+                pending += len(data["alveo:annotations"])
+                if pending >= self.annotation_batch_size:
+                    self._save_annotations(collection_id, path, 'a', triples, annotated)
+                    triples, annotated, pending = [], [], 0
+            if triples:
+                self._save_annotations(collection_id, path, 'a', triples, annotated)
+
+            result = {"filename":filename,
+                      "documents":num_documents,
+                      "annotations":num_annotations}
+            if error is not None:
+                result["error"] = "bad annotation document: %s" % error
+                result["failed_document"] = num_documents
+            else:
+                result["success"] = "%d annotations uploaded to file %s" % (num_annotations, filename)
+            return result
+
+    def _annotation_triples(self, collection_uri, data):
+        """Return the URI of a new annotation collection holding the
+        annotations in data, as uploaded, and a list of its triples"""
+
+        triples = []
         ann_coll_id = "%s/annotation/%s" %(collection_uri, uuid4())
         activity = self.create_activity()
         user = self.get_user(data["metadata"]["creator"])
         software = self.get_software(data["metadata"]["generatedBy"])
         # Annotation Collection
-        g.add((URIRef(ann_coll_id), RDF.type, DADA.AnnotationCollection))
-        g.add((URIRef(ann_coll_id), RDF.type, PROV.Entity))
-        g.add((URIRef(ann_coll_id), DADA.annotates, URIRef(data["metadata"]["alveo:annotates"])))
-        g.add((URIRef(ann_coll_id), PROV.generatedAtTime, Literal(data["metadata"]["generatedAtTime"], datatype=XSD.dateTime)))
-        g.add((URIRef(ann_coll_id), PROV.wasGeneratedBy, URIRef(activity["@id"])))
+        triples.append((URIRef(ann_coll_id), RDF.type, DADA.AnnotationCollection))
+        triples.append((URIRef(ann_coll_id), RDF.type, PROV.Entity))
+        triples.append((URIRef(ann_coll_id), DADA.annotates, URIRef(data["metadata"]["alveo:annotates"])))
+        triples.append((URIRef(ann_coll_id), PROV.generatedAtTime, Literal(data["metadata"]["generatedAtTime"], datatype=XSD.dateTime)))
+        triples.append((URIRef(ann_coll_id), PROV.wasGeneratedBy, URIRef(activity["@id"])))
         # Activity
-        g.add((URIRef(activity["@id"]), RDF.type, PROV.Activity))
-        g.add((URIRef(activity["@id"]), RDFS.label, Literal(activity["label"])))
-        g.add((URIRef(activity["@id"]), PROV.wasAssociatedWith, URIRef(user["@id"])))
-        g.add((URIRef(activity["@id"]), PROV.wasAssociatedWith, URIRef(software["@id"])))
+        triples.append((URIRef(activity["@id"]), RDF.type, PROV.Activity))
+        triples.append((URIRef(activity["@id"]), RDFS.label, Literal(activity["label"])))
+        triples.append((URIRef(activity["@id"]), PROV.wasAssociatedWith, URIRef(user["@id"])))
+        triples.append((URIRef(activity["@id"]), PROV.wasAssociatedWith, URIRef(software["@id"])))
         # Software
-        g.add((URIRef(software["@id"]), RDF.type, PROV.Activity))
-        g.add((URIRef(software["@id"]), RDF.type, PROV.SoftwareAgent))
-        g.add((URIRef(software["@id"]), RDFS.label, Literal(software["label"])))
-        g.add((URIRef(software["@id"]), XYZZY.source, URIRef(software["source"])))
+        triples.append((URIRef(software["@id"]), RDF.type, PROV.Activity))
+        triples.append((URIRef(software["@id"]), RDF.type, PROV.SoftwareAgent))
+        triples.append((URIRef(software["@id"]), RDFS.label, Literal(software["label"])))
+        triples.append((URIRef(software["@id"]), XYZZY.source, URIRef(software["source"])))
         # User
-        g.add((URIRef(user["@id"]), RDF.type, FOAF.Person))
-        g.add((URIRef(user["@id"]), RDF.type, PROV.Agent))
-        g.add((URIRef(user["@id"]), FOAF.name, Literal(user["name"])))
+        triples.append((URIRef(user["@id"]), RDF.type, FOAF.Person))
+        triples.append((URIRef(user["@id"]), RDF.type, PROV.Agent))
+        triples.append((URIRef(user["@id"]), FOAF.name, Literal(user["name"])))
+        triples.append((URIRef(user["@id"]), FOAF.mbox, URIRef("mailto:" + user["email"])))
         # Annotations
-        for annotation in data["alveo:annotations"]:
-            ann_id = self.generate_annotation_id(collection_uri)
+        ann_ids = self.generate_annotation_ids(collection_uri, len(data["alveo:annotations"]))
+        for ann_id, annotation in zip(ann_ids, data["alveo:annotations"]):
             ann_reg_id = ann_id + "L"
-            g.add((URIRef(ann_id), RDF.type, DADA.Annotation))
-            g.add((URIRef(ann_id), DADA.partof, URIRef(ann_coll_id)))
-            g.add((URIRef(ann_id), DADA.targets, URIRef(ann_reg_id)))
+            triples.append((URIRef(ann_id), RDF.type, DADA.Annotation))
+            triples.append((URIRef(ann_id), DADA.partof, URIRef(ann_coll_id)))
+            triples.append((URIRef(ann_id), DADA.targets, URIRef(ann_reg_id)))
             if "label" in annotation:
-                g.add((URIRef(ann_id), DADA.label, Literal(annotation["label"])))
-            g.add((URIRef(ann_id), DADA.type, URIRef(annotation["type"])))
+                triples.append((URIRef(ann_id), DADA.label, Literal(annotation["label"])))
+            triples.append((URIRef(ann_id), DADA.type, URIRef(annotation["type"])))
             if annotation["@type"] == "dada:TextAnnotation":
-                g.add((URIRef(ann_reg_id), RDF.type, DADA.UTF8Region))
+                triples.append((URIRef(ann_reg_id), RDF.type, DADA.UTF8Region))
             elif annotation["@type"] == "dada:SecondAnnotation":
-                g.add((URIRef(ann_reg_id), RDF.type, DADA.SecondRegion))
-            g.add((URIRef(ann_reg_id), DADA.start, Literal(annotation["start"], datatype=XSD.integer)))
-            g.add((URIRef(ann_reg_id), DADA.end, Literal(annotation["end"], datatype=XSD.integer)))
-        g.serialize(os.path.join(self.basedir, self._get_id(collection_uri), filename+".n3"), format="n3")
-        self.graph += g
-        return {"success":"file %s uploaded successfully" % filename}
-     
+                triples.append((URIRef(ann_reg_id), RDF.type, DADA.SecondRegion))
+            triples.append((URIRef(ann_reg_id), DADA.start, Literal(annotation["start"], datatype=XSD.integer)))
+            triples.append((URIRef(ann_reg_id), DADA.end, Literal(annotation["end"], datatype=XSD.integer)))
+        return ann_coll_id, triples
+
+    def _save_annotations(self, collection_id, path, mode, triples, annotated):
+        """Write triples to the file at path, opened with mode, in one
+        write and add them to the graph. annotated holds the (item,
+        annotation collection) of the annotations being added"""
+
+        text = u"".join(u"%s %s %s .\n" % (s.n3(), p.n3(), o.n3()) for s, p, o in triples)
+        with open(path, mode) as fp:
+            fp.write(text.encode('utf-8'))
+        version = self.store.version(collection_id)
+        self.store.insert(path, triples)
+        cached = self.annotation_indexes.get(collection_id)
+        if cached is not None and cached[0] == version and self.store.version(collection_id) == version + 1:
+            # nothing else has changed, add the new annotations to the index
+            cached[1].add(self.graph, annotated)
+            self.annotation_indexes[collection_id] = (version + 1, cached[1])
+
     def generate_annotation_id(self, collection_uri):
+        return self.generate_annotation_ids(collection_uri, 1)[0]
+
+    def generate_annotation_ids(self, collection_uri, count):
+        """Return the URIs of count new annotations in a collection,
+        numbered on from the last one given out. The last number is
+        kept in the collection's directory so that it is shared by
+        every process serving the collection and kept over restarts"""
+
         collection_id = self._get_id(collection_uri)
         prefix = collection_uri + "/annotation/"
-        if API.last_generated_ann_id is None:
-            query = prepareQuery('select ?annotation where {?annotation a ?type}')
-            annotations = []
-            g = Store()
-            g.attach_directory(os.path.join(self.basedir, collection_id))
-            results = g.graph.query(query, initBindings={'type': DADA.Annotation})
-            for result in results.bindings:
-                annotations.append(int(result["annotation"].toPython().replace(prefix, "")))
-    
-            API.last_generated_ann_id = max(annotations)
-        API.last_generated_ann_id += 1
-        return prefix + str(API.last_generated_ann_id)
+        allocator = self.annotation_ids.get(collection_id)
+        if allocator is None:
+            allocator = self.annotation_ids.setdefault(collection_id, IdAllocator(
+                os.path.join(self.basedir, collection_id, ".annotation_ids"),
+                lambda: self._last_annotation_number(collection_id, prefix)))
+        first = allocator.allocate(count)
+        return [prefix + str(number) for number in range(first, first + count)]
+
+    def _last_annotation_number(self, collection_id, prefix):
+        """Return the highest number of the annotations in a collection,
+        0 if it has none"""
+
+        last = 0
+        with self.store.using(collection_id):
+            results = sparql.run(self.store.view(collection_id), 'instances_of_type', {'type': DADA.Annotation})
+        for result in results.bindings:
+            number = result["instance"].toPython().replace(prefix, "")
+            if number.isdigit():
+                last = max(last, int(number))
+        return last
 
     def _get_uri(self, output_uri_type, input_uri_type, input_uri):
-        if output_uri_type == "collection":
-            if input_uri_type == "item":
-                query = prepareQuery("""select ?collection where{
-                                                    ?collection a dcmitype:Collection.
-                                                    ?item dc:isPartOf ?collection.
-                                                    }""", initNs = {"dc":DC, 
-                                                                    "dcmitype":DCMITYPE})
-            elif input_uri_type == "document":
-                query = prepareQuery("""select ?collection where{
-                                                    ?collection a dcmitype:Collection.
-                                                    ?item dc:isPartOf ?collection.
-                                                    ?item ausnc:document ?document.
-                                                    }""", initNs = {"dc":DC, 
-                                                                    "dcmitype":DCMITYPE,
-                                                                    "ausnc":AUSNC})
-            elif input_uri_type == "source":
-                query = prepareQuery("""select ?collection where{
-                                                    ?collection a dcmitype:Collection.
-                                                    ?item dc:isPartOf ?collection.
-                                                    ?item ausnc:document ?document.
-                                                    ?document dc:source ?source. 
-                                                    }""", initNs = {"dc":DC, 
-                                                                    "dcmitype":DCMITYPE,
-                                                                    "ausnc":AUSNC})
-            elif input_uri_type == "annotation":
-                query = prepareQuery("""select ?collection where{
-                                                    ?collection a dcmitype:Collection.
-                                                    ?item dc:isPartOf ?collection.
-                                                    ?annCollID dada:annotates ?item.
-                                                    ?annotation dada:partof ?annCollID.
-                                                    }""", initNs = {"dc":DC, 
-                                                                    "dcmitype":DCMITYPE,
-                                                                    "dada":DADA})
-            else:
-                return []
-        elif output_uri_type == "item":
-            if input_uri_type == "collection":
-                query = prepareQuery("""select ?item where{
-                                                    ?collection a dcmitype:Collection.
-                                                    ?item dc:isPartOf ?collection.
-                                                    }""", initNs = {"dc":DC, 
-                                                                    "dcmitype":DCMITYPE})
-            elif input_uri_type == "itemlist":
-                query = prepareQuery("""select ?item where{
-                                                    ?itemlistid a localterms:itemList.
-                                                    ?item dc:isPartOf ?itemlistid.
-                                                    }""", initNs = {"localterms":LOCALTERMS,
-                                                                    "dc":DC})
-            elif input_uri_type == "annotation":
-                query = prepareQuery("""select ?item where{
-                                                    ?annCollID dada:annotates ?item.
-                                                    ?annotation dada:partof ?annCollID.
-                                                    }""", initNs = {"dada":DADA})
-            elif input_uri_type == "document":
-                query = prepareQuery("""select ?item where{
-                                                    ?item ausnc:document ?document.
-                                                    }""", initNs = {"ausnc":AUSNC})
-            elif input_uri_type == "source":
-                query = prepareQuery("""select ?item where{
-                                                    ?item ausnc:document ?document.
-                                                    ?document dc:source ?source. 
-                                                    }""", initNs = {"dc":DC, 
-                                                                    "ausnc":AUSNC})
-            else:
-                return []
-        elif output_uri_type == "annotation":
-            if input_uri_type == "item":
-                query = prepareQuery("""select ?annotation where{
-                                                    ?annotation dada:partof ?annCollID.
-                                                    ?annCollID dada:annotates ?item.
-                                                    }""", initNs = {"dada":DADA})
-            else:
-                return []
-        initBindings={input_uri_type: URIRef(input_uri)}
-        results = self.graph.query(query, initBindings=initBindings)
-        output = [result[output_uri_type].toPython() for result in results.bindings]
-        return output
+        name = "%s_of_%s" % (output_uri_type, input_uri_type)
+        if name not in sparql:
+            return []
+        with self._using(input_uri):
+            initBindings={input_uri_type: URIRef(input_uri)}
+            results = sparql.run(self.graph, name, initBindings)
+            output = [result[output_uri_type].toPython() for result in results.bindings]
+            return output
     
     def _get_id(self, input_uri):
         return input_uri[input_uri.rfind("/")+1:]
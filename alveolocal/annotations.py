@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+"""An index of the annotations on the items of a collection."""
+
+from array import array
+from bisect import bisect_left
+
+from rdflib import URIRef
+
+from namespaces import RDF, DC, DADA
+
+
+# the kind of region an annotation targets and the @type it is given
+OTHER, TEXT, SECONDS = 0, 1, 2
+KIND_TYPES = {OTHER: '', TEXT: 'dada:TextAnnotation', SECONDS: 'dada:SecondAnnotation'}
+REGION_KINDS = {DADA.UTF8Region: TEXT, DADA.SecondRegion: SECONDS}
+
+# properties of an annotation that have a column of their own
+COLUMNS = set([DADA.label, DADA.type, DADA.targets, RDF.type, DADA.partof])
+
+
+class ItemAnnotations(object):
+    """The annotations on one item held column by column, ordered
+    by start and end. ids holds the annotation URIs, start and end
+    the region offsets (NaN if missing), kind the region kind and
+    type and label the ids of terms in the AnnotationIndex. Offsets
+    that are not integers are also kept as they are in the graph in
+    offsets by row. Any other properties are kept in extra by row
+    and type_counts holds the number of annotations of each type id.
+
+    longest is the greatest end - start, so the annotations that
+    overlap an offset all start no more than longest before it"""
+
+    def __init__(self):
+        self.ids = []
+        self.start = array('d')
+        self.end = array('d')
+        self.kind = array('b')
+        self.type = array('i')
+        self.label = array('i')
+        self.extra = dict()
+        self.offsets = dict()
+        self.type_counts = dict()
+        self.longest = 0.0
+        # annotation URI -> row, None until the rows are sorted
+        self.rows = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def append(self, annid, start, end, kind, type_id, label_id, extra):
+        """Add an annotation, start and end are the values of its
+        offsets in the graph or None if missing"""
+
+        self.ids.append(annid)
+        self.start.append(float('nan') if start is None else float(start))
+        self.end.append(float('nan') if end is None else float(end))
+        self.kind.append(kind)
+        self.type.append(type_id)
+        self.label.append(label_id)
+        self.type_counts[type_id] = self.type_counts.get(type_id, 0) + 1
+        if extra:
+            self.extra[len(self.ids) - 1] = extra
+        if not all(value is None or isinstance(value, (int, long)) for value in (start, end)):
+            self.offsets[len(self.ids) - 1] = (start, end)
+        self.rows = None
+
+    def sort(self):
+        """Put the rows in order of start and end if they have
+        been added to since they were last sorted"""
+
+        if self.rows is not None:
+            return
+        # missing offsets go last so the start column can be bisected
+        order = sorted(range(len(self.ids)),
+                       key=lambda i: (self.start[i] != self.start[i], self.start[i], self.end[i], self.ids[i]))
+        self.ids = [self.ids[i] for i in order]
+        for name in ('start', 'end', 'kind', 'type', 'label'):
+            column = getattr(self, name)
+            setattr(self, name, array(column.typecode, (column[i] for i in order)))
+        where = dict((old, new) for new, old in enumerate(order))
+        self.extra = dict((where[old], extra) for old, extra in self.extra.items())
+        self.offsets = dict((where[old], offsets) for old, offsets in self.offsets.items())
+        self.rows = dict((annid, i) for i, annid in enumerate(self.ids))
+        lengths = [e - s for s, e in zip(self.start, self.end) if e - s == e - s]
+        self.longest = max(lengths) if lengths else 0.0
+
+    def overlapping(self, start=None, end=None):
+        """Return the rows whose region overlaps start up to end,
+        either of which may be None for no limit. An annotation
+        of no length overlaps if start <= its offset < end"""
+
+        self.sort()
+        low = 0 if start is None else bisect_left(self.start, start - self.longest)
+        high = len(self.ids) if end is None else bisect_left(self.start, end)
+        if start is None:
+            return range(low, high)
+        return [i for i in xrange(low, high)
+                if self.end[i] > start or self.start[i] == self.end[i] >= start]
+
+    def select(self, type_id=None, annids=None, start=None, end=None):
+        """Return the rows that overlap start up to end, only those
+        of one type if type_id is given and only those of the
+        annotation URIs in the set annids if that is given"""
+
+        rows = self.overlapping(start, end)
+        if annids is not None:
+            rows = [i for i in rows if self.ids[i] in annids]
+        if type_id is not None:
+            rows = [i for i in rows if self.type[i] == type_id]
+        return rows
+
+    def values(self, rows):
+        """Return a generator of (annotation URI, kind, type id, label
+        id, start, end, other properties) for each of rows. Offsets
+        are as they are in the graph and None if missing. The columns
+        are the ones there now, so
+        annotations added while the generator is used make no
+        difference to it"""
+
+        columns = (self.ids, self.kind, self.type, self.label, self.start, self.end, self.extra, self.offsets)
+        return (_values(columns, i) for i in rows)
+
+
+def _values(columns, i):
+    ids, kind, type_ids, label_ids, start, end, extra, offsets = columns
+    found = offsets.get(i)
+    if found is None:
+        # integers, which a double holds exactly
+        found = [None if value != value else int(value) for value in (start[i], end[i])]
+    return (ids[i], kind[i], type_ids[i], label_ids[i], found[0], found[1], extra.get(i, ()))
+
+
+class AnnotationIndex(object):
+    """The annotations on each item of one collection.
+
+    items maps each item URI to its ItemAnnotations and terms holds
+    the annotation types and labels, each of which is stored as its
+    position in terms. type_counts holds the number of annotations
+    of each type id across the collection"""
+
+    def __init__(self, graph, collection_uri):
+        self.items = dict()
+        self.terms = []
+        self.term_ids = dict()
+        self.type_counts = dict()
+
+        for item in graph.subjects(DC.isPartOf, URIRef(collection_uri)):
+            for aset in graph.subjects(DADA.annotates, item):
+                self._add(graph, item, aset)
+        # sorted now so that reading the index never changes it
+        for annotations in self.items.values():
+            annotations.sort()
+
+    def term_id(self, term):
+        """Return the id of a type or label, adding it if it is new"""
+
+        term_id = self.term_ids.get(term)
+        if term_id is None:
+            term_id = self.term_ids[term] = len(self.terms)
+            self.terms.append(term)
+        return term_id
+
+    def add(self, graph, annotated):
+        """Add the annotations of each (item, annotation collection)
+        in annotated from graph"""
+
+        changed = set(self._add(graph, item, aset) for item, aset in annotated)
+        for annotations in changed:
+            annotations.sort()
+
+    def _add(self, graph, item, aset):
+        annotations = self.items.get(unicode(item))
+        if annotations is None:
+            annotations = self.items[unicode(item)] = ItemAnnotations()
+
+        for annid in graph.subjects(DADA.partof, aset):
+            values = dict()
+            extra = []
+            for p, o in graph.predicate_objects(annid):
+                if p in COLUMNS:
+                    values[p] = o
+                else:
+                    extra.append((p, o.toPython()))
+
+            # a region may have several types, only one of which is a kind
+            region = dict()
+            if DADA.targets in values:
+                for p, o in graph.predicate_objects(values[DADA.targets]):
+                    region.setdefault(p, []).append(o)
+            kinds = [REGION_KINDS[t] for t in region.get(RDF.type, ()) if t in REGION_KINDS]
+            kind = kinds[0] if kinds else OTHER
+            start, end = [region[p][0].toPython() if p in region else None for p in (DADA.start, DADA.end)]
+            type_id = self.term_id(unicode(values.get(DADA.type)))
+            annotations.append(unicode(annid), start, end, kind, type_id,
+                               self.term_id(unicode(values.get(DADA.label))), extra)
+            self.type_counts[type_id] = self.type_counts.get(type_id, 0) + 1
+        return annotations
+
+    def get(self, item_uri):
+        """Return the ItemAnnotations of an item, empty if it has none"""
+
+        return self.items.get(unicode(item_uri), ItemAnnotations())
+
+    def types(self, type_counts):
+        """Return the (type, count) of each type id in type_counts,
+        in the order the types were first found"""
+
+        return [(self.terms[t], type_counts[t]) for t in sorted(type_counts)]
@@ -1,22 +1,501 @@
-from rdflib.graph import Graph
+import inspect
+import logging
 import os
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import RLock
+
+from rdflib.graph import ConjunctiveGraph, ReadOnlyGraphAggregate
+
+from loader import rdf_files, rdf_format, parse_files, merge, decode_terms, file_stat, file_context, TermTable
+from snapshot import Snapshot
+from sqlitestore import SQLiteStore
+from compactstore import CompactStore
+from namespaces import PrefixMap
+
+
+log = logging.getLogger(__name__)
 
 
 class Store(object):
+    """The triples from a directory of RDF files. Each file is
+    loaded into its own context so that it can later be reloaded
+    or removed without touching the rest of the graph.
+
+    In lazy mode only the RDF files at the top level of the directory
+    (the collection descriptions) are loaded up front, the files in a
+    collection's sub-directory are loaded the first time that collection
+    is required. If max_collections is given, the least recently
+    required collections are unloaded to keep no more than that
+    many in memory. A collection in use through using() is not
+    unloaded until every with block using it has ended.
+
+    The triples are held in memory unless backend is "sqlite", in
+    which case they are kept in an SQLite database at database
+    (by default triples.db in the directory). Reopening an existing
+    database only parses the files that have changed since they were
+    loaded into it. A backend of "compact" holds them in memory as
+    arrays of integer term ids, which takes a fraction of the space
+    of the default rdflib store.
+
+    If fast is True Turtle files are read with the line based parser
+    in fastparse, which hands any file it cannot handle back to rdflib.
+
+    adopt is a list of stores already loaded from directories inside
+    this one. The graph of the first of them with the same in memory
+    backend becomes this store's graph, so the files they loaded are
+    not parsed again and they see everything this store loads. The
+    triples of a file that another store sharing the graph has loaded
+    stay in the graph when this store unloads it."""
     
-    def attach_directory(self, dirname):
+    def attach_directory(self, dirname, workers=1, snapshot=None, lazy=False, max_collections=None,
+                         backend="memory", database=None, fast=False, adopt=()):
         """Attach to a directory containing RDF files
         and deliver data from there"""
 
-        self.graph = Graph()
         self.basedir = dirname
+        self.backend = backend
+        self.workers = workers
+        self.fast = fast
+        self.snapshot = None if snapshot is None else Snapshot(snapshot)
+        self.lazy = lazy
+        self.max_collections = max_collections
+        # (size, mtime) of every file loaded, keyed by path
+        self.files = dict()
+        # ids of the collections loaded in lazy mode, least recently used first
+        self.collections = OrderedDict()
+        # collection id -> number of with blocks using it, these are not unloaded
+        self.pins = dict()
+        # bumped whenever the triples of a collection change, keyed by collection id
+        self.versions = dict()
+        # bumped whenever any triples change
+        self.generation = 0
+        # bumped whenever a prefix is bound with bind
+        self.bindings = 0
+        # when the triples of each collection last changed, None for any collection
+        self.changed_at = dict()
+        self.attached_at = time.time()
+        self.lock = RLock()
+        # called with the id of each collection unloaded in lazy mode
+        self.unload_hooks = []
+
+        if backend == "sqlite":
+            store = SQLiteStore()
+            store.open(database or os.path.join(dirname, "triples.db"), create=True)
+            self.graph = ConjunctiveGraph(store)
+            self.files = store.load_manifest()
+            adopted = dict()
+        else:
+            self.graph = None
+            adopted = self._adopt(adopt)
+            if self.graph is None:
+                self.graph = ConjunctiveGraph(CompactStore()) if backend == "compact" else ConjunctiveGraph()
+
+        self.prefixes = PrefixMap(self.graph)
+        self.prefixes_state = (self.generation, self.bindings)
+
+        if self.files:
+            # an existing database, bring it up to date
+            for path in self.files:
+                if self._collection_of(path) is not None:
+                    self.collections[self._collection_of(path)] = True
+            self._reload()
+        else:
+            sources = self._sources()
+            stats = dict((path, file_stat(path)) for path, _ in sources)
+            stale = []
+            for path, format in sources:
+                if adopted.get(os.path.abspath(path)) == stats[path]:
+                    # already in the graph
+                    self.files[path] = stats[path]
+                    self._changed(path)
+                else:
+                    if os.path.abspath(path) in adopted:
+                        self.graph.remove_context(self.graph.get_context(file_context(path)))
+                    stale.append((path, format))
+            self._load(stale, stats)
+            self._save_snapshot(sources)
+            self._commit()
+
+        return len(self.graph)
+
+    def _adopt(self, stores):
+        """Take over the graph of the first of stores with the same
+        backend and return the (size, mtime) of the files that it and
+        any others sharing the graph hold and that this store loads,
+        keyed by absolute path"""
+
+        shared = [store for store in stores if store.backend == self.backend]
+        if not shared:
+            return dict()
+        self.graph = shared[0].graph
+        for store in stores:
+            if store.graph is not self.graph:
+                log.warning("%s is loaded separately from %s and keeps its own graph", store.basedir, self.basedir)
+
+        adopted = dict()
+        collection_ids = set(self.collection_ids())
+        for store in stores:
+            if store.graph is self.graph:
+                for path, stat in store.files.items():
+                    adopted[os.path.abspath(path)] = stat
+                    if self.lazy and self._collection_of(path) in collection_ids:
+                        self.collections[self._collection_of(path)] = True
+
+        # the rest stay in the graph for the stores that loaded them
+        wanted = set(os.path.abspath(path) for path, _ in self._sources())
+        return dict((path, stat) for path, stat in adopted.items() if path in wanted)
+
+    def collection_ids(self):
+        """Return the ids of all collections in the directory,
+        loaded or not, those sub-directories with a description"""
+
+        return [name for name in os.listdir(self.basedir)
+                if os.path.isdir(os.path.join(self.basedir, name))
+                and os.path.isfile(os.path.join(self.basedir, name + ".n3"))]
+
+    def view(self, collection_id):
+        """Return a read only graph of the triples of one collection,
+        those from its description at the top level of the directory
+        and from the files in its sub-directory"""
+
+        description = os.path.join(self.basedir, collection_id + ".n3")
+        with self.lock:
+            self.require(collection_id)
+            paths = list(self.files)
+        return ReadOnlyGraphAggregate([self.graph.get_context(file_context(path)) for path in paths
+                                       if path == description or self._collection_of(path) == collection_id])
+
+    def version(self, collection_id):
+        """Return a number that changes whenever the triples of
+        this collection are loaded, unloaded or added to"""
+
+        return self.versions.get(collection_id, 0)
+
+    def modified(self, collection_id=None):
+        """Return the time that the triples of this collection,
+        or of any collection if collection_id is None, last changed"""
+
+        return self.changed_at.get(collection_id, self.attached_at)
+
+    def bind(self, prefix, namespace):
+        """Bind prefix to namespace in the graph"""
+
+        with self.lock:
+            self.graph.bind(prefix, namespace)
+            self.bindings += 1
+
+    def prefix_map(self):
+        """Return the PrefixMap for the graph, refreshed if files have
+        been loaded or prefixes bound with bind since it was last used.
+        A prefix bound on the graph itself is not seen until then, or
+        until the PrefixMap is refreshed"""
+
+        with self.lock:
+            state = (self.generation, self.bindings)
+            if self.prefixes_state != state:
+                self.prefixes_state = state
+                self.prefixes.refresh()
+            return self.prefixes
+
+    def is_loaded(self, collection_id):
+        """True if the triples of this collection are in the graph"""
+
+        with self.lock:
+            return not self.lazy or collection_id in self.collections
+
+    @contextmanager
+    def using(self, collection_id):
+        """Require a collection and keep it loaded for the length of
+        a with block, so that other collections being required in
+        the meantime do not unload it while it is being read"""
+
+        with self.lock:
+            self.require(collection_id)
+            pinned = self.lazy and collection_id in self.collections
+            if pinned:
+                self.pins[collection_id] = self.pins.get(collection_id, 0) + 1
+        try:
+            yield
+        finally:
+            if pinned:
+                with self.lock:
+                    self.pins[collection_id] -= 1
+                    if not self.pins[collection_id]:
+                        del self.pins[collection_id]
+                        if self._evict():
+                            self._save_snapshot(self._sources())
+                            self._commit()
+
+    def require(self, collection_id):
+        """Make sure that the triples of this collection are loaded"""
+
+        if not self.lazy or collection_id is None:
+            return
+
+        with self.lock:
+            if collection_id in self.collections:
+                # move to the most recently used end
+                self.collections[collection_id] = self.collections.pop(collection_id)
+                return
+
+            dirname = os.path.join(self.basedir, collection_id)
+            if not os.path.isdir(dirname):
+                return
+
+            sources = list(rdf_files(dirname))
+            self._load(sources, dict((path, file_stat(path)) for path, _ in sources))
+            self.collections[collection_id] = True
+            self._evict(collection_id)
+            self._save_snapshot(self._sources())
+            self._commit()
+
+    def _evict(self, keep=None):
+        """Unload the least recently used collections, other than
+        keep and those in use, until no more than max_collections
+        are loaded and return their ids, the caller holds the lock"""
+
+        evicted = []
+        while self.max_collections is not None and len(self.collections) - len(evicted) > self.max_collections:
+            unpinned = [c for c in self.collections if c not in self.pins and c not in evicted and c != keep]
+            if not unpinned:
+                # all in use, the last one to finish unloads the rest
+                break
+            evicted.append(unpinned[0])
+
+        kept = self._shared_files() if evicted else set()
+        for collection_id in evicted:
+            del self.collections[collection_id]
+            for path in [path for path in self.files if self._collection_of(path) == collection_id]:
+                self._unload(path, kept)
+            for hook in self.unload_hooks:
+                hook(collection_id)
+        return evicted
+
+    def reload(self):
+        """Parse files that have been added or modified since they
+        were loaded and retract the triples of files that have been
+        deleted. Return a dictionary listing the paths of each.
+        In lazy mode only loaded collections are considered"""
+
+        with self.lock:
+            return self._reload()
+
+    def _reload(self):
+        """Reload, the caller holds the lock"""
+
+        sources = self._sources()
+        stats = dict((path, file_stat(path)) for path, _ in sources)
+
+        added = [(path, format) for path, format in sources if path not in self.files]
+        modified = [(path, format) for path, format in sources
+                    if path in self.files and self.files[path] != stats[path]]
+        removed = [path for path in self.files if path not in stats]
+
+        kept = self._shared_files()
+        for path in removed:
+            self._unload(path, kept)
+        for path, _ in modified:
+            self._unload(path)
+        self._load(added + modified, stats)
+        self._save_snapshot(sources)
+        self._commit()
+
+        return {'added': [path for path, _ in added],
+                'modified': [path for path, _ in modified],
+                'removed': removed,
+                }
+
+    def insert(self, path, triples):
+        """Add triples that have just been written to the file at path"""
+
+        context = self.graph.get_context(file_context(path))
+        with self.lock:
+            context.addN((s, p, o, context) for s, p, o in triples)
+            self.files[path] = file_stat(path)
+            self._changed(path)
+            self._commit()
+
+    def _sources(self):
+        """Return the (path, format) of the RDF files that should be loaded"""
+
+        if not self.lazy:
+            return list(rdf_files(self.basedir))
+
+        sources = []
+        for filename in os.listdir(self.basedir):
+            path = os.path.join(self.basedir, filename)
+            if rdf_format(filename) is not None and os.path.isfile(path):
+                sources.append((path, rdf_format(filename)))
+        for collection_id in self.collections:
+            sources.extend(rdf_files(os.path.join(self.basedir, collection_id)))
+        return sources
+
+    def _changed(self, path):
+        """Note that the triples from path have changed, a file at the
+        top level describes the collection of the same name"""
+
+        collection_id = self._collection_of(path)
+        if collection_id is None:
+            collection_id = os.path.splitext(os.path.basename(path))[0]
+        self.versions[collection_id] = self.versions.get(collection_id, 0) + 1
+        self.generation += 1
+        self.changed_at[collection_id] = self.changed_at[None] = time.time()
+
+    def _collection_of(self, path):
+        """Return the id of the collection whose sub-directory
+        holds path, None for files at the top level"""
+
+        parts = os.path.relpath(path, self.basedir).split(os.sep)
+        if len(parts) > 1:
+            return parts[0]
+        return None
+
+    def _load(self, sources, stats):
+        """Load each of the (path, format) sources into its own context"""
+
+        for path, _ in sources:
+            self.files[path] = stats[path]
+            self._changed(path)
+
+        if self.snapshot is not None:
+            self._load_with_snapshot(sources, stats)
+        elif self.workers > 1 or self.fast or not self.graph.store.formula_aware:
+            # the N3 parser can only write straight into a formula aware store
+            for path, namespaces, terms, triples in parse_files(sources, self.workers, self.fast):
+                merge(self.graph.get_context(file_context(path)), namespaces, decode_terms(terms), triples)
+        else:
+            for path, format in sources:
+                self.graph.get_context(file_context(path)).parse(path, format=format)
+
+    def _load_with_snapshot(self, sources, stats):
+        """Load sources from the snapshot, parsing only those
+        files that have changed since it was written"""
+
+        names = dict((path, os.path.relpath(path, self.basedir)) for path, _ in sources)
+        stale = [(path, format) for path, format in sources
+                 if not self.snapshot.is_current(names[path], stats[path])]
+        for path, namespaces, terms, triples in parse_files(stale, self.workers, self.fast):
+            self.snapshot.update(names[path], stats[path], namespaces, terms, triples)
+
+        nodes = TermTable(self.snapshot.terms)
+        for path, _ in sources:
+            _, _, namespaces, triples = self.snapshot.files[names[path]]
+            merge(self.graph.get_context(file_context(path)), namespaces, nodes, triples)
+
+    def _unload(self, path, kept=()):
+        """Remove the triples that were loaded from path, unless its
+        absolute path is in kept"""
+
+        if os.path.abspath(path) not in kept:
+            self.graph.remove_context(self.graph.get_context(file_context(path)))
+        del self.files[path]
+        self._changed(path)
+
+    def _shared_files(self):
+        """Return the absolute paths of the files loaded by the other
+        stores in the registry that share the graph"""
+
+        return set(os.path.abspath(path) for other in registry.sharing(self) for path in list(other.files))
+
+    def _save_snapshot(self, sources):
+        """Write the snapshot if it no longer matches the directory"""
+
+        if self.snapshot is not None:
+            names = [os.path.relpath(path, self.basedir) for path, _ in sources]
+            if self.lazy:
+                # keep the collections that are not loaded at the moment
+                names.extend(name for name in self.snapshot.files
+                             if os.sep in name and name.split(os.sep)[0] not in self.collections)
+            self.snapshot.retain(names)
+            if self.snapshot.changed:
+                self.snapshot.save()
+
+    def _commit(self):
+        """Make the changes to a persistent backend durable"""
+
+        if self.backend == "sqlite":
+            self.graph.store.save_manifest(self.files)
+
+
+class Registry(object):
+    """The stores shared by everything in this process, so that a
+    directory is only ever parsed once for the same options. A store
+    is kept for as long as anything that acquired it has not released it"""
+
+    def __init__(self):
+        # [store, reference count] keyed by the real path of the
+        # directory and the attach_directory options it was loaded with
+        self.stores = dict()
+        self.lock = RLock()
+
+    def acquire(self, dirname, **options):
+        """Return the store for dirname loaded with the given
+        attach_directory options, loading it if there is none.
+
+        A directory inside one loaded with the same options shares
+        its store, unless that is lazy and could unload it. A
+        directory loaded after directories inside it takes over
+        their graph, so their files are not parsed again"""
+
+        path = os.path.realpath(dirname)
+        settings = self._settings(options)
+        with self.lock:
+            # the outermost directory loaded that holds this one
+            roots = sorted(root for root, other in self.stores
+                           if other == settings and (path == root or path.startswith(root + os.sep)))
+            if roots and (roots[0] == path or not self.stores[(roots[0], settings)][0].lazy):
+                entry = self.stores[(roots[0], settings)]
+            else:
+                inside = [entry[0] for (root, _), entry in sorted(self.stores.items())
+                          if root.startswith(path + os.sep)]
+                store = Store()
+                store.attach_directory(dirname, adopt=inside, **options)
+                entry = self.stores[(path, settings)] = [store, 0]
+
+            entry[1] += 1
+            return entry[0]
+
+    def _settings(self, options):
+        """Return all of the attach_directory options, given or
+        defaulted, in a form that can be compared and hashed"""
+
+        settings = dict(zip(reversed(ATTACH_OPTIONS.args), reversed(ATTACH_OPTIONS.defaults)))
+        del settings["adopt"]
+        settings.update(options)
+        return tuple(sorted(settings.items()))
+
+    def sharing(self, store):
+        """Return the other stores that share the graph of store"""
+
+        with self.lock:
+            return [entry[0] for entry in self.stores.values()
+                    if entry[0] is not store and entry[0].graph is store.graph]
+
+    def release(self, store):
+        """Give up a store returned by acquire, it is dropped
+        once everything that acquired it has released it"""
+
+        with self.lock:
+            for key, entry in self.stores.items():
+                if entry[0] is store:
+                    entry[1] -= 1
+                    if entry[1] == 0:
+                        del self.stores[key]
+                        if not self.sharing(store):
+                            store.graph.close()
+                            return
+                        # the graph was taken over from a store still in use,
+                        # leave it with only the files that the others loaded
+                        kept = store._shared_files()
+                        for path in store.files:
+                            if os.path.abspath(path) not in kept:
+                                store.graph.remove_context(store.graph.get_context(file_context(path)))
+                    return
+
 
-        for dirpath, _, filenames in os.walk(dirname):
-            
-            for filename in filenames:
-                if filename.endswith(".rdf"):
-                    self.graph.parse(os.path.join(dirpath, filename), format='turtle')
-                elif filename.endswith(".n3"):
-                    self.graph.parse(os.path.join(dirpath, filename), format='n3')
+# the arguments of attach_directory and their defaults
+ATTACH_OPTIONS = inspect.getargspec(Store.attach_directory)
 
-        return len(self.graph)
\ No newline at end of file
+registry = Registry()
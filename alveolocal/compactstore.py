@@ -0,0 +1,434 @@
+# -*- coding: utf-8 -*-
+
+"""A compact in-memory rdflib store.
+
+Every term is interned once and given an integer id. Quads are kept in
+four indexes, each a dictionary from the id of the leading term to an
+array of the ids of the other three terms, sorted so that a range can
+be found by binary search:
+
+    spo: subject -> (predicate, object, context)
+    pos: predicate -> (object, subject, context)
+    osp: object -> (subject, predicate, context)
+    cx:  context -> (subject, predicate, object)
+
+Additions are appended and each array is only sorted when it is next
+read, so loading a file costs one sort per key touched. Sorting, adding
+and removing hold a lock so that threads reading at once never sort
+the same array twice or see the counts half updated.
+
+Each term counts the quads that use it. A term no longer used, after
+a context is removed say, is forgotten and its id given to the next
+new term.
+"""
+
+import sys
+import threading
+from array import array
+from collections import Counter
+
+from rdflib.graph import Graph
+from rdflib.store import Store, VALID_STORE
+from rdflib.term import Node
+
+
+# the positions of s, p, o, c within each index, leading term first
+INDEXES = {'spo': (0, 1, 2, 3),
+           'pos': (1, 2, 0, 3),
+           'osp': (2, 0, 1, 3),
+           'cx': (3, 0, 1, 2),
+           }
+
+
+class CompactStore(Store):
+    """A context aware rdflib store holding term ids in sorted arrays"""
+
+    context_aware = True
+    formula_aware = False
+    transaction_aware = False
+    graph_aware = False
+
+    def __init__(self, configuration=None, identifier=None):
+        super(CompactStore, self).__init__(configuration, identifier)
+        self._terms = []
+        self._ids = dict()
+        # the number of quads using each term and ids free for reuse
+        self._refs = array('i')
+        self._free = []
+        # graphs given as contexts, keyed by the id of their identifier
+        self._graphs = dict()
+        self._indexes = dict((name, dict()) for name in INDEXES)
+        # (index, key) of arrays that have had quads appended since being sorted
+        self._unsorted = set()
+        # the number of distinct triples of each subject and in all
+        self._sizes = dict()
+        self._count = 0
+        self._namespace = dict()
+        self._prefix = dict()
+        # held while the indexes and counts change
+        self._lock = threading.RLock()
+
+    def open(self, configuration, create=False):
+        return VALID_STORE
+
+    # terms
+
+    def _id(self, term, create=False):
+        """Return the id of a term, None if it is not in the store
+        unless create is True in which case it is added"""
+
+        tid = self._ids.get(term)
+        if tid is None and create:
+            if self._free:
+                tid = self._free.pop()
+                self._terms[tid] = term
+            else:
+                tid = len(self._terms)
+                self._terms.append(term)
+                self._refs.append(0)
+            self._ids[term] = tid
+        return tid
+
+    def _release(self, quads):
+        """Forget the terms that are no longer used once quads are gone"""
+
+        for quad in quads:
+            for tid in quad:
+                self._refs[tid] -= 1
+                if self._refs[tid] == 0:
+                    del self._ids[self._terms[tid]]
+                    self._terms[tid] = None
+                    self._graphs.pop(tid, None)
+                    self._free.append(tid)
+
+    def _context_id(self, context, create=False):
+        """Return the id of a context given as a Graph or an identifier"""
+
+        if isinstance(context, Graph):
+            cid = self._id(context.identifier, create)
+            if cid is not None and cid not in self._graphs:
+                self._graphs[cid] = context
+            return cid
+        return self._id(context, create)
+
+    def _graph(self, cid):
+        """Return the Graph for a context id"""
+
+        graph = self._graphs.get(cid)
+        if graph is None:
+            graph = self._graphs[cid] = Graph(self, identifier=self._terms[cid])
+        return graph
+
+    # the sorted arrays
+
+    def _rows(self, name, key):
+        """Return the sorted array of an index for this key"""
+
+        if (name, key) not in self._unsorted:
+            return self._indexes[name].get(key)
+
+        with self._lock:
+            rows = self._indexes[name].get(key)
+            # sorted by another thread while this one waited
+            if rows is None or (name, key) not in self._unsorted:
+                return rows
+            self._unsorted.discard((name, key))
+            found = zip(rows[0::3], rows[1::3], rows[2::3])
+            unique = sorted(set(found))
+            rows = self._indexes[name][key] = array('i', [i for row in unique for i in row])
+            if name == 'spo':
+                if len(unique) < len(found):
+                    # a quad added twice is only counted once
+                    self._release((key, ) + row for row, n in Counter(found).items() for _ in xrange(n - 1))
+                self._recount(key, rows)
+            return rows
+
+    def _recount(self, key, rows):
+        """Update the number of triples from the sorted spo array
+        of a subject"""
+
+        size = 0
+        for i in xrange(0, len(rows), 3):
+            # the contexts of a triple are adjacent
+            if i == 0 or rows[i:i + 2] != rows[i - 3:i - 1]:
+                size += 1
+        self._count += size - self._sizes.pop(key, 0)
+        if size:
+            self._sizes[key] = size
+
+    def _range(self, rows, prefix):
+        """Return the (start, end) rows of a sorted array of
+        triples that begin with prefix"""
+
+        n = len(prefix)
+        lo, hi = 0, len(rows) // 3
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if tuple(rows[mid * 3:mid * 3 + n]) < prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+        start = lo
+        hi = len(rows) // 3
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if tuple(rows[mid * 3:mid * 3 + n]) <= prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+        return start, lo
+
+    def _match(self, quad):
+        """Generate the quads of ids matching a pattern of ids,
+        None matches anything"""
+
+        # choose the index whose leading terms are bound
+        s, p, o, c = quad
+        if s is not None:
+            name = 'spo'
+        elif p is not None:
+            name = 'pos'
+        elif o is not None:
+            name = 'osp'
+        elif c is not None:
+            name = 'cx'
+        else:
+            name = 'spo'
+
+        order = INDEXES[name]
+        pattern = [quad[i] for i in order]
+        if pattern[0] is None:
+            keys = list(self._indexes[name])
+        else:
+            keys = [pattern[0]]
+
+        for key in keys:
+            rows = self._rows(name, key)
+            if rows is None:
+                continue
+
+            prefix = []
+            for term in pattern[1:]:
+                if term is None:
+                    break
+                prefix.append(term)
+            start, end = self._range(rows, tuple(prefix))
+
+            for i in xrange(start * 3, end * 3, 3):
+                found = [key, rows[i], rows[i + 1], rows[i + 2]]
+                if all(pattern[j] is None or pattern[j] == found[j] for j in xrange(len(prefix) + 1, 4)):
+                    result = [None] * 4
+                    for j, position in enumerate(order):
+                        result[position] = found[j]
+                    yield tuple(result)
+
+    def _pattern(self, triple, context):
+        """Return the pattern of ids for a triple pattern and
+        context, None if a term is not in the store"""
+
+        quad = []
+        for term in triple:
+            if term is None:
+                quad.append(None)
+            else:
+                tid = self._id(term)
+                if tid is None:
+                    return None
+                quad.append(tid)
+
+        if context is None:
+            quad.append(None)
+        else:
+            cid = self._context_id(context)
+            if cid is None:
+                return None
+            quad.append(cid)
+        return tuple(quad)
+
+    # RDF API
+
+    def add(self, triple, context, quoted=False):
+        self.addN([(triple[0], triple[1], triple[2], context)])
+
+    def addN(self, quads):
+        with self._lock:
+            self._add(quads)
+
+    def _add(self, quads):
+        for s, p, o, c in quads:
+            quad = (self._id(s, True), self._id(p, True), self._id(o, True), self._context_id(c, True))
+            for tid in quad:
+                self._refs[tid] += 1
+            for name, order in INDEXES.items():
+                index = self._indexes[name]
+                key = quad[order[0]]
+                rows = index.get(key)
+                if rows is None:
+                    rows = index[key] = array('i')
+                rows.extend((quad[order[1]], quad[order[2]], quad[order[3]]))
+                if len(rows) > 3:
+                    self._unsorted.add((name, key))
+                elif name == 'spo':
+                    self._recount(key, rows)
+
+    def remove(self, triple, context=None):
+        with self._lock:
+            self._remove(triple, context)
+
+    def _remove(self, triple, context):
+        pattern = self._pattern(triple, context)
+        if pattern is None:
+            return
+
+        removed = set(self._match(pattern))
+        if not removed:
+            return
+
+        for name, order in INDEXES.items():
+            index = self._indexes[name]
+            keys = set(quad[order[0]] for quad in removed)
+            for key in keys:
+                rows = self._rows(name, key)
+                kept = array('i')
+                for i in xrange(0, len(rows), 3):
+                    found = [key, rows[i], rows[i + 1], rows[i + 2]]
+                    quad = [None] * 4
+                    for j, position in enumerate(order):
+                        quad[position] = found[j]
+                    if tuple(quad) not in removed:
+                        kept.extend(found[1:])
+                if kept:
+                    index[key] = kept
+                else:
+                    del index[key]
+                if name == 'spo':
+                    self._recount(key, kept)
+        self._release(removed)
+
+    def triples(self, triple, context=None):
+        pattern = self._pattern(triple, context)
+        if pattern is None:
+            return
+
+        if context is not None:
+            for s, p, o, c in self._match(pattern):
+                yield (self._terms[s], self._terms[p], self._terms[o]), iter([context])
+            return
+
+        # the contexts of a triple are adjacent in every index
+        # so each triple is reported once with all of its contexts
+        last = None
+        contexts = []
+        for s, p, o, c in self._match(pattern):
+            if (s, p, o) != last:
+                if last is not None:
+                    yield self._triple(last), iter(contexts)
+                last = (s, p, o)
+                contexts = []
+            contexts.append(self._graph(c))
+        if last is not None:
+            yield self._triple(last), iter(contexts)
+
+    def _triple(self, ids):
+        return self._terms[ids[0]], self._terms[ids[1]], self._terms[ids[2]]
+
+    def __len__(self, context=None):
+        if context is not None:
+            cid = self._context_id(context)
+            rows = self._rows('cx', cid)
+            if rows is None:
+                return 0
+            return len(rows) // 3
+        # the triples of subjects added to since are counted as they are sorted
+        with self._lock:
+            for name, key in list(self._unsorted):
+                if name == 'spo':
+                    self._rows(name, key)
+            return self._count
+
+    def contexts(self, triple=None):
+        if triple is None:
+            for cid in list(self._indexes['cx']):
+                yield self._graph(cid)
+            return
+
+        pattern = self._pattern(triple, None)
+        if pattern is None:
+            return
+        for cid in sorted(set(quad[3] for quad in self._match(pattern))):
+            yield self._graph(cid)
+
+    # namespaces
+
+    def bind(self, prefix, namespace):
+        self._prefix[namespace] = prefix
+        self._namespace[prefix] = namespace
+
+    def namespace(self, prefix):
+        return self._namespace.get(prefix, None)
+
+    def prefix(self, namespace):
+        return self._prefix.get(namespace, None)
+
+    def namespaces(self):
+        for prefix, namespace in self._namespace.items():
+            yield prefix, namespace
+
+    def memory_usage(self):
+        """Return an estimate of the bytes used to hold the triples"""
+
+        return sizeof((self._terms, self._ids, self._indexes))
+
+
+def sizeof(obj, seen=None):
+    """Return an estimate of the bytes used by obj and everything it
+    refers to through containers, terms and instance dictionaries"""
+
+    if seen is None:
+        seen = set()
+    if id(obj) in seen or isinstance(obj, type):
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += sizeof(key, seen) + sizeof(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += sizeof(item, seen)
+    elif isinstance(obj, Node) and not isinstance(obj, Graph):
+        # terms are strings that may also carry a datatype and a language
+        for value in getattr(obj, '__dict__', {}).values():
+            size += sizeof(value, seen)
+        for name in ('_datatype', '_language'):
+            size += sizeof(getattr(obj, name, None), seen)
+    elif hasattr(obj, '__dict__') and not isinstance(obj, (Graph, Store)):
+        size += sizeof(obj.__dict__, seen)
+    return size
+
+
+def compare_memory(dirname):
+    """Load dirname into the default rdflib store and into a
+    CompactStore, return the estimated bytes used by each"""
+
+    from base import Store as DirectoryStore
+
+    result = dict()
+    for backend in ("memory", "compact"):
+        store = DirectoryStore()
+        store.attach_directory(dirname, backend=backend)
+        if backend == "compact":
+            result[backend] = store.graph.store.memory_usage()
+        else:
+            result[backend] = sizeof(store.graph.store.__dict__)
+        store.graph.close()
+    return result
+
+
+if __name__ == '__main__':
+
+    usage = compare_memory(sys.argv[1])
+    print("rdflib memory store: %d bytes" % usage["memory"])
+    print("compact store:       %d bytes (%.1f%% of the memory store)"
+          % (usage["compact"], 100.0 * usage["compact"] / usage["memory"]))
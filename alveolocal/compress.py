@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+"""Compressed copies of documents.
+
+A document may be stored as itself or as a sibling with .gz or, if
+the zstandard module is installed, .zst appended to its name, or as
+both when compressed with --keep. find locates whichever is there and
+read returns the uncompressed bytes.
+
+Run as a command to compress the documents of a data directory in
+place:
+
+    alveolocal-compress [--zstd] [--keep] [--suffix .txt] <dirname>
+"""
+
+import argparse
+import gzip
+import os
+import shutil
+from io import BytesIO
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# the suffix of the compressed sibling for each content encoding
+ENCODINGS = [('gzip', '.gz')]
+if zstandard is not None:
+    ENCODINGS.append(('zstd', '.zst'))
+
+
+def find_all(path):
+    """Return (path, encoding) for every file holding the document at
+    path, the uncompressed file first if it is there. encoding is None
+    for the uncompressed file"""
+
+    result = []
+    if os.path.isfile(path):
+        result.append((path, None))
+    for encoding, suffix in ENCODINGS:
+        if os.path.isfile(path + suffix):
+            result.append((path + suffix, encoding))
+    return result
+
+
+def find(path):
+    """Return (path, encoding) for the file holding the document at
+    path, the first of find_all. Return None if there is no such
+    document"""
+
+    found = find_all(path)
+    return found[0] if found else None
+
+
+def locate_all(path):
+    """Return (path, encoding, size, mtime) for every file holding the
+    document at path, as for find_all along with the size and
+    modification time of each file"""
+
+    result = []
+    for found in find_all(path):
+        try:
+            stat = os.stat(found[0])
+        except OSError:
+            continue
+        result.append(found + (stat.st_size, stat.st_mtime))
+    return result
+
+
+def locate(path):
+    """Return the first of locate_all for the document at path, None
+    if there is no such document"""
+
+    found = locate_all(path)
+    return found[0] if found else None
+
+
+def open_document(path, found=None):
+    """Return a file object reading the uncompressed document at
+    path. Seeking in a gzip file decompresses up to the new position
+    and a zstd file is decompressed into memory. found is what find
+    or locate returned for path, it is looked for if not given"""
+
+    if found is None:
+        found = find(path)
+    if found is None:
+        raise IOError(2, "No such file or directory", path)
+
+    filename, encoding = found[:2]
+    if encoding == 'gzip':
+        return gzip.open(filename, 'rb')
+    if encoding == 'zstd':
+        out = BytesIO()
+        with open(filename, 'rb') as fp:
+            zstandard.ZstdDecompressor().copy_stream(fp, out)
+        out.seek(0)
+        return out
+    return open(filename, 'rb')
+
+
+def read(path, found=None):
+    """Return the uncompressed contents of the document at path,
+    found is as for open_document"""
+
+    with open_document(path, found) as fp:
+        return fp.read()
+
+
+def compress_file(path, encoding='gzip', keep=False):
+    """Write a compressed sibling of the file at path with the same
+    modification time, removing the original unless keep is True.
+    Return the path of the compressed file"""
+
+    suffix = dict(ENCODINGS)[encoding]
+    target = path + suffix
+    tmp = target + ".tmp"
+    with open(path, 'rb') as src:
+        if encoding == 'gzip':
+            with open(tmp, 'wb') as raw:
+                # a fixed name and time so that the output only depends on the content
+                with gzip.GzipFile(os.path.basename(path), 'wb', 9, raw, 0) as dst:
+                    shutil.copyfileobj(src, dst)
+        else:
+            with open(tmp, 'wb') as dst:
+                zstandard.ZstdCompressor(level=19).copy_stream(src, dst)
+
+    stat = os.stat(path)
+    os.utime(tmp, (stat.st_atime, stat.st_mtime))
+    os.rename(tmp, target)
+    if not keep:
+        os.remove(path)
+    return target
+
+
+def compress_directory(dirname, encoding='gzip', suffixes=('.txt',), keep=False):
+    """Compress every file below dirname whose name ends with one
+    of suffixes, return the paths of the compressed files"""
+
+    result = []
+    for dirpath, _, filenames in os.walk(dirname):
+        for filename in filenames:
+            if filename.endswith(tuple(suffixes)):
+                result.append(compress_file(os.path.join(dirpath, filename), encoding, keep))
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compress the documents of an alveolocal data directory in place")
+    parser.add_argument('dirname')
+    parser.add_argument('--zstd', action='store_true', help="use zstandard rather than gzip")
+    parser.add_argument('--keep', action='store_true', help="keep the uncompressed files")
+    parser.add_argument('--suffix', action='append', help="compress files ending with this, default .txt")
+    args = parser.parse_args(argv)
+
+    if args.zstd and zstandard is None:
+        parser.error("the zstandard module is not installed")
+
+    compressed = compress_directory(args.dirname, 'zstd' if args.zstd else 'gzip',
+                                    args.suffix or ['.txt'], args.keep)
+    print("compressed %d files" % len(compressed))
+
+
+if __name__ == '__main__':
+    main()
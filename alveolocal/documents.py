@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+"""An index of where the documents of a collection are on disk."""
+
+import logging
+
+from rdflib import URIRef
+
+from namespaces import DC, AUSNC, HCSVLAB
+import compress
+
+
+log = logging.getLogger(__name__)
+
+
+class DocumentIndex(object):
+    """The local paths of the documents of one collection.
+
+    paths maps the URI of each document and of its source to the
+    local path, variants maps each path to what compress.locate_all
+    found for it and files to the first of those, None if the file was
+    not there. display maps each item URI
+    to the path of its display document and missing lists the (document
+    URI, path) of documents whose file was not there. Files are only
+    looked for when the index is built, so it has to be built again to
+    notice files added or deleted since"""
+
+    def __init__(self, graph, collection_uri, uri_to_path):
+        self.paths = dict()
+        self.variants = dict()
+        self.files = dict()
+        self.display = dict()
+        self.missing = []
+
+        for item in graph.subjects(DC.isPartOf, URIRef(collection_uri)):
+            for doc in graph.objects(item, AUSNC.document):
+                self._add(graph, doc, uri_to_path)
+
+            doc = graph.value(item, HCSVLAB.indexable_document)
+            if doc is not None:
+                self.display[unicode(item)] = self._add(graph, doc, uri_to_path)
+
+        for doc, path in self.missing:
+            log.warning("document %s is missing, expected it at %s", doc, path)
+
+    def _add(self, graph, doc, uri_to_path):
+        """Record the path of a document and return it"""
+
+        doc = unicode(doc)
+        if doc in self.paths:
+            return self.paths[doc]
+
+        source = graph.value(URIRef(doc), DC.source)
+        path = uri_to_path(unicode(source if source is not None else doc))
+        self.paths[doc] = path
+        if source is not None:
+            self.paths[unicode(source)] = path
+        if path not in self.files:
+            self.variants[path] = compress.locate_all(path)
+            self.files[path] = self.variants[path][0] if self.variants[path] else None
+            if self.files[path] is None:
+                self.missing.append((doc, path))
+        return path
+
+    def display_document(self, item_uri):
+        """Return the (path, size, mtime) of the display document of
+        an item, None if it has none or the file was not there. A
+        document may be stored compressed, the size and mtime are
+        those of the file holding it"""
+
+        path = self.display.get(unicode(item_uri))
+        found = self.files.get(path)
+        if found is None:
+            return None
+        return (path, found[2], found[3])
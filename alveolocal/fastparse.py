@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+
+"""A fast parser for the regular subset of Turtle used by the
+generated metadata and annotation files.
+
+Files are read line by line and each line is split into tokens with
+one regular expression. Only prefix declarations, absolute IRIs,
+prefixed names, 'a', strings on one line with an optional language
+or datatype, numbers and booleans are understood. Anything else
+(blank nodes, collections, long strings, @base, relative IRIs...)
+raises Unsupported so that the caller can fall back to rdflib.
+"""
+
+import codecs
+import re
+import sys
+import time
+
+from rdflib.namespace import RDF, XSD
+from rdflib.term import URIRef, Literal
+
+
+class Unsupported(Exception):
+    """The file uses a construct this parser does not handle"""
+    pass
+
+
+TOKEN = re.compile(r'''[ \t\r\n]*(?:
+      (?P<iri><[^<>"{}|^`\\\s]*>)
+    | "(?P<string>(?:[^"\\\r\n]|\\.)*)"
+          (?:\^\^(?:<(?P<dtiri>[^<>"{}|^`\\\s]*)>|(?P<dtqname>(?:[A-Za-z][\w-]*)?:(?:[\w-]+(?:\.[\w-]+)*)?))
+           |@(?P<lang>[A-Za-z]+(?:-[A-Za-z0-9]+)*))?
+    | (?P<double>[+-]?(?:\d+\.?\d*|\.\d+)[eE][+-]?\d+)
+    | (?P<decimal>[+-]?\d*\.\d+)
+    | (?P<integer>[+-]?\d+)
+    | (?P<qname>(?:[A-Za-z][\w-]*)?:(?:[\w-]+(?:\.[\w-]+)*)?)
+    | (?P<keyword>@prefix|a|true|false)(?=[ \t\r\n<"])
+    | (?P<punct>[;,.])
+    | (?P<comment>\#.*)
+    )''', re.X | re.U)
+
+SPACE = re.compile(r'[ \t\r\n]*$')
+
+ESCAPE = re.compile(r'\\(?:u([0-9A-Fa-f]{4})|U([0-9A-Fa-f]{8})|(.))')
+
+ESCAPES = {'t': u'\t', 'b': u'\b', 'n': u'\n', 'r': u'\r', 'f': u'\f',
+           '"': u'"', "'": u"'", '\\': u'\\'}
+
+
+def _unescape(match):
+    if match.group(3) is not None:
+        if match.group(3) not in ESCAPES:
+            raise Unsupported("unknown escape \\%s" % match.group(3))
+        return ESCAPES[match.group(3)]
+    return unichr(int(match.group(1) or match.group(2), 16))
+
+
+def tokens(lines):
+    """Generate (kind, match) for the tokens in a sequence of lines"""
+
+    for lineno, line in enumerate(lines, 1):
+        pos = 0
+        end = len(line)
+        while pos < end:
+            match = TOKEN.match(line, pos)
+            if match is None or match.end() == pos:
+                if SPACE.match(line, pos):
+                    break
+                raise Unsupported("line %d: cannot parse %r" % (lineno, line[pos:pos + 20]))
+            pos = match.end()
+            kind = match.lastgroup
+            if kind in ('dtiri', 'dtqname', 'lang'):
+                kind = 'string'
+            if kind != 'comment':
+                yield kind, match
+
+
+class Parser(object):
+    """Turn the tokens of one file into rdflib triples, each distinct
+    token is only turned into a term once"""
+
+    def __init__(self):
+        self.namespaces = []
+        self.prefixes = dict()
+        self.cache = dict()
+
+    def qname(self, text):
+        prefix, local = text.split(':', 1)
+        if prefix not in self.prefixes:
+            raise Unsupported("undeclared prefix %s" % prefix)
+        return URIRef(self.prefixes[prefix] + local)
+
+    def term(self, kind, match):
+        """Return the rdflib term for a token in subject, predicate or object position"""
+
+        text = match.group(0)
+        node = self.cache.get(text)
+        if node is not None:
+            return node
+
+        if kind == 'iri':
+            iri = match.group('iri')[1:-1]
+            if ':' not in iri:
+                raise Unsupported("relative IRI <%s>" % iri)
+            node = URIRef(iri)
+        elif kind == 'qname':
+            node = self.qname(match.group('qname'))
+        elif kind == 'string':
+            value = match.group('string')
+            if '\\' in value:
+                value = ESCAPE.sub(_unescape, value)
+            if match.group('dtiri') is not None:
+                node = Literal(value, datatype=URIRef(match.group('dtiri')))
+            elif match.group('dtqname') is not None:
+                node = Literal(value, datatype=self.qname(match.group('dtqname')))
+            else:
+                node = Literal(value, lang=match.group('lang'))
+        elif kind in ('integer', 'decimal', 'double'):
+            node = Literal(match.group(kind), datatype=XSD[kind])
+        elif kind == 'keyword' and match.group(kind) == 'a':
+            node = RDF.type
+        elif kind == 'keyword' and match.group(kind) in ('true', 'false'):
+            node = Literal(match.group(kind), datatype=XSD.boolean)
+        else:
+            raise Unsupported("unexpected %r" % text.strip())
+
+        self.cache[text] = node
+        return node
+
+    def parse(self, lines):
+        """Generate the triples in a sequence of lines"""
+
+        stream = tokens(lines)
+        for kind, match in stream:
+            if kind == 'keyword' and match.group(kind) == '@prefix':
+                self.prefix(stream)
+                continue
+
+            subject = self.term(kind, match)
+            predicate = None
+            while True:
+                if predicate is None:
+                    predicate = self.term(*self.next(stream))
+                yield subject, predicate, self.term(*self.next(stream))
+
+                kind, match = self.next(stream)
+                punct = match.group('punct') if kind == 'punct' else None
+                if punct == ',':
+                    continue
+                elif punct == ';':
+                    predicate = None
+                    kind, match = self.next(stream)
+                    if kind == 'punct' and match.group(kind) == '.':
+                        break
+                    predicate = self.term(kind, match)
+                elif punct == '.':
+                    break
+                else:
+                    raise Unsupported("unexpected %r" % match.group(0).strip())
+
+    def next(self, stream):
+        """Return the next token, the file must not end part way
+        through a statement"""
+
+        try:
+            return next(stream)
+        except StopIteration:
+            raise Unsupported("unexpected end of file")
+
+    def prefix(self, stream):
+        kind, name = self.next(stream)
+        kind2, iri = self.next(stream)
+        kind3, end = self.next(stream)
+        if (kind, kind2, kind3) != ('qname', 'iri', 'punct') or not name.group(kind).endswith(':') \
+                or end.group(kind3) != '.':
+            raise Unsupported("malformed @prefix")
+        prefix = name.group(kind)[:-1]
+        self.prefixes[prefix] = iri.group('iri')[1:-1]
+        self.namespaces.append((prefix, self.prefixes[prefix]))
+
+
+def parse(path):
+    """Parse a Turtle file and return (namespaces, triples) where
+    namespaces is a list of (prefix, uri) declared in the file and
+    triples is a list of rdflib triples. Raises Unsupported if the
+    file uses a construct that is not handled"""
+
+    parser = Parser()
+    with codecs.open(path, encoding='utf-8') as fp:
+        triples = list(parser.parse(fp))
+    return parser.namespaces, triples
+
+
+def benchmark(dirname, repeat=3):
+    """Parse the Turtle files below dirname with rdflib and with the
+    fast parser, return {'rdflib': triples/sec, 'fast': triples/sec,
+    'fallback': files the fast parser could not handle}"""
+
+    from rdflib import Graph
+    from loader import rdf_files
+
+    paths = [path for path, format in rdf_files(dirname) if format == 'turtle']
+
+    def rate(parse_one):
+        best = None
+        for _ in xrange(repeat):
+            start = time.time()
+            count = sum(parse_one(path) for path in paths)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return count / best
+
+    fallback = []
+
+    def rdflib_one(path):
+        return len(Graph().parse(path, format='turtle'))
+
+    def fast_one(path):
+        try:
+            return len(set(parse(path)[1]))
+        except Unsupported:
+            if path not in fallback:
+                fallback.append(path)
+            return rdflib_one(path)
+
+    return {'rdflib': rate(rdflib_one), 'fast': rate(fast_one), 'fallback': fallback}
+
+
+if __name__ == '__main__':
+
+    result = benchmark(sys.argv[1])
+    print("rdflib: %10.0f triples/sec" % result['rdflib'])
+    print("fast:   %10.0f triples/sec (%.1fx)" % (result['fast'], result['fast'] / result['rdflib']))
+    for path in result['fallback']:
+        print("fell back to rdflib for %s" % path)
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+"""Numbers for new annotations, handed out a range at a time.
+
+The last number given out is kept in a file so that it survives a
+restart. The file is locked while it is read and written so that
+any number of threads and processes can share one counter.
+"""
+
+import os
+from threading import Lock
+
+try:
+    import fcntl
+except ImportError:
+    # no file locking, only the threads of one process can share a counter
+    fcntl = None
+
+
+class IdAllocator(object):
+    """Consecutive numbers from the counter in the file at path.
+    initial is called with no arguments to find the highest number
+    already in use if the file is missing or empty"""
+
+    def __init__(self, path, initial):
+        self.path = path
+        self.initial = initial
+        self.lock = Lock()
+
+    def allocate(self, count=1):
+        """Return the first of count new consecutive numbers"""
+
+        with self.lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if fcntl is not None:
+                    # released when the file is closed
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                text = os.read(fd, 64).strip()
+                last = int(text) if text else self.initial()
+                data = "%d\n" % (last + count)
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.write(fd, data)
+                # the counter only grows so the file is never left empty
+                os.ftruncate(fd, len(data))
+            finally:
+                os.close(fd)
+        return last + 1
@@ -1,4 +1,5 @@
 import os
+import time
 try:
     import sqlite3
     import redis
@@ -9,6 +10,7 @@ from rdflib import Graph
 from rdflib.term import URIRef, Literal
 
 from namespaces import RDF, DC, LOCALTERMS
+from base import registry
 
 
 class RedisDb(object):
@@ -142,21 +144,14 @@ class SqliteDb(object):
             
 class RdfDb(object):
         
-    def attach_directory(self, dirname):
+    def attach_directory(self, dirname, snapshot=None):
         """Attach to a directory containing RDF files
         and deliver data from there"""
 
-        self.graph = Graph()
+        self.store = registry.acquire(dirname, snapshot=snapshot)
+        self.graph = self.store.graph
         self.basedir = dirname
 
-        for dirpath, _, filenames in os.walk(dirname):
-            
-            for filename in filenames:
-                if filename.endswith(".rdf"):
-                    self.graph.parse(os.path.join(dirpath, filename), format='turtle')
-                elif filename.endswith(".n3"):
-                    self.graph.parse(os.path.join(dirpath, filename), format='n3')
-
         return len(self.graph)
         
     def _save_item_list(self, item_list_id, dir_name):
@@ -241,6 +236,9 @@ class RdfDb(object):
 class ItemListFactory():
     
     def __init__(self, method, dirname):
+        # bumped by every change made through the factory
+        self.version = 0
+        self.modified = time.time()
         if method == "redis":
             self.db = RedisDb()
         elif method == "sqlite":
@@ -249,6 +247,10 @@ class ItemListFactory():
             self.db = RdfDb()
             self.db.attach_directory(dirname)
             
+    def _changed(self):
+        self.version += 1
+        self.modified = time.time()
+
     def get_item_lists(self):
         itemlists = self.db.get_item_lists()
         output = {"shared":[], "own":[]}
@@ -277,32 +279,39 @@ class ItemListFactory():
     
     def create_item_list(self, itemlistid, itemlistname, shared):
         self.db.create_item_list(itemlistid, itemlistname, shared)
+        self._changed()
         return {"success":"Itemlist %s created successfully" % itemlistname}
         
     def add_to_item_list(self, itemlistid, itemid):
         self.db.add_to_item_list(itemlistid, itemid)
+        self._changed()
         
     def share_item_list(self, itemlist_id):
         self.db.change_item_list_shared(itemlist_id, "shared")
+        self._changed()
         return {"success":"Item list %s is shared. Any user in the application will be able to see it." % self.db.get_item_list_name(itemlist_id)} 
         
     def unshare_item_list(self, itemlist_id):
         self.db.change_item_list_shared(itemlist_id, "own")
+        self._changed()
         return {"success":"Item list %s is not being shared anymore." % self.db.get_item_list_name(itemlist_id)}
         
     def delete_item_list(self, itemlist_id):
         name = self.db.get_item_list_name(itemlist_id)
         self.db.delete_item_list(itemlist_id)
+        self._changed()
         return {"success":"item list %s deleted successfully" % name} 
         
     def clear_item_list(self, itemlist_id):
         num = len(self.db.get_items(itemlist_id))
         self.db.clear_item_list(itemlist_id)
+        self._changed()
         name = self.db.get_item_list_name(itemlist_id)
         return {"success":"%s cleared from item list %s" %(num, name)}
     
     def rename_item_list(self, itemlist_id, new_name):
         self.db.rename_item_list(itemlist_id, new_name)
+        self._changed()
         
 
                 
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+"""Walking a data directory and parsing the RDF files it contains.
+
+Files can be parsed in worker processes; each worker ships back the
+triples of one file in a compact form (a table of terms plus an array
+of indexes into that table) which is then merged into the main graph.
+"""
+
+import os
+from array import array
+from multiprocessing import Pool
+from urllib import pathname2url
+
+from rdflib import Graph
+from rdflib.term import URIRef, BNode, Literal
+
+import fastparse
+
+
+def rdf_format(filename):
+    """Return the rdflib parser format for this file name,
+    None if it is not an RDF file"""
+
+    if filename.endswith(".rdf"):
+        return 'turtle'
+    elif filename.endswith(".n3"):
+        return 'n3'
+    return None
+
+
+def rdf_files(dirname):
+    """Generate (path, format) for every RDF file below dirname
+    in the order that os.walk visits them"""
+
+    for dirpath, _, filenames in os.walk(dirname):
+        for filename in filenames:
+            format = rdf_format(filename)
+            if format is not None:
+                yield os.path.join(dirpath, filename), format
+
+
+def encode_term(term):
+    """Return a compact, picklable form of an rdflib term"""
+
+    if isinstance(term, Literal):
+        return (unicode(term), term.datatype, term.language)
+    elif isinstance(term, BNode):
+        return (unicode(term),)
+    return unicode(term)
+
+
+def decode_terms(terms):
+    """Turn a list of encoded terms back into rdflib terms.
+    Blank nodes are given fresh identifiers so that those from
+    different files can never collide"""
+
+    result = []
+    for term in terms:
+        if not isinstance(term, tuple):
+            result.append(URIRef(term))
+        elif len(term) == 1:
+            result.append(BNode())
+        else:
+            value, datatype, lang = term
+            result.append(Literal(value, datatype=datatype, lang=lang))
+    return result
+
+
+class TermTable(dict):
+    """Decoded terms indexed by their position in a list of encoded
+    terms, each term is only decoded when it is first needed"""
+
+    def __init__(self, terms):
+        dict.__init__(self)
+        self.terms = terms
+
+    def __missing__(self, i):
+        node = self[i] = decode_terms([self.terms[i]])[0]
+        return node
+
+
+def parse_file(source):
+    """Parse one RDF file given as a (path, format) pair and return
+    (path, namespaces, terms, triples) where triples is an array of
+    indexes into terms, three per triple"""
+
+    path, format = source
+    graph = Graph()
+    graph.parse(path, format=format)
+
+    namespaces = [(prefix, unicode(ns)) for prefix, ns in graph.namespaces()]
+    return (path, namespaces) + encode_triples(graph)
+
+
+def parse_file_fast(source):
+    """As parse_file but Turtle files are read with the fast parser,
+    falling back to rdflib for those it cannot handle"""
+
+    path, format = source
+    if format == 'turtle':
+        try:
+            namespaces, triples = fastparse.parse(path)
+        except fastparse.Unsupported:
+            pass
+        else:
+            return (path, namespaces) + encode_triples(set(triples))
+    return parse_file(source)
+
+
+def encode_triples(triples):
+    """Return (terms, indexes) for a sequence of triples where terms
+    is a list of encoded terms and indexes an array of positions in
+    terms, three per triple"""
+
+    index = dict()
+    terms = []
+    indexes = array('i')
+    for triple in triples:
+        for term in triple:
+            i = index.get(term)
+            if i is None:
+                i = index[term] = len(terms)
+                terms.append(encode_term(term))
+            indexes.append(i)
+    return terms, indexes
+
+
+def parse_files(sources, workers=1, fast=False):
+    """Parse a sequence of (path, format) pairs, using a pool of
+    worker processes if workers > 1 and the fast Turtle parser if
+    fast is True. Results are generated in the same order as sources"""
+
+    parse = parse_file_fast if fast else parse_file
+    if workers > 1:
+        pool = Pool(workers)
+        try:
+            for result in pool.imap(parse, sources, chunksize=16):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for source in sources:
+            yield parse(source)
+
+
+def merge(graph, namespaces, nodes, triples):
+    """Add the triples of one file to graph, nodes are the
+    decoded terms that triples index into"""
+
+    for prefix, ns in namespaces:
+        graph.bind(prefix, ns)
+
+    graph.addN((nodes[triples[i]], nodes[triples[i + 1]], nodes[triples[i + 2]], graph)
+               for i in xrange(0, len(triples), 3))
+
+
+def file_stat(path):
+    """Return the (size, mtime) of a file"""
+
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime
+
+
+def file_context(path):
+    """Return the identifier of the context holding the triples
+    loaded from path"""
+
+    return URIRef("file://" + pathname2url(os.path.abspath(path)))
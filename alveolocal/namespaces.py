@@ -1,4 +1,4 @@
-from rdflib import Namespace
+from rdflib import Namespace, URIRef
 
 # Define namespaces
 RDF = Namespace(u"http://www.w3.org/1999/02/22-rdf-syntax-ns#")
@@ -22,7 +22,7 @@ OWL = Namespace(u"http://www.w3.org/2002/07/owl#")
 XSD = Namespace(u"http://www.w3.org/2001/XMLSchema#")
 HCSVLAB = Namespace(u"http://hcsvlab.org/vocabulary/")
 LOCALTERMS = Namespace(u"http://localhost:3000/alveolocal/terms#")
-PROV = Namespace(u"prov")
+PROV = Namespace(u"http://www.w3.org/ns/prov#")
 XYZZY = Namespace(u"xyzzy")
 
 # Namespaces we control
@@ -64,6 +64,51 @@ def bind_graph(graph):
     return graph
 
 
+class PrefixMap(object):
+    """The qnames of URIs and the URIs of qnames according to the
+    prefixes bound in a graph, both cached. Call refresh when
+    prefixes may have been bound to drop the caches if they have"""
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.prefixes = None
+        self.chosen = None
+        self.refresh()
+
+    def refresh(self):
+        prefixes = dict((prefix, unicode(ns)) for prefix, ns in self.graph.namespaces())
+        # a namespace bound to several prefixes is written with the one bound last
+        chosen = dict((ns, self.graph.store.prefix(URIRef(ns))) for ns in set(prefixes.values()))
+        if (prefixes, chosen) != (self.prefixes, self.chosen):
+            self.prefixes = prefixes
+            self.chosen = chosen
+            self.qnames = dict()
+            self.uris = dict()
+            # the namespace manager keeps the qnames it has worked out too
+            self.graph.namespace_manager.reset()
+
+    def qname(self, uri):
+        """Return uri as a qname e.g. dc:title, or as <uri> if
+        no prefix is bound for its namespace"""
+
+        qname = self.qnames.get(uri)
+        if qname is None:
+            qname = self.qnames[uri] = uri.n3(self.graph.namespace_manager)
+        return qname
+
+    def uri(self, qname):
+        """Return the URIRef for a qname e.g. dc:title, or
+        qname itself if its prefix is not bound"""
+
+        uri = self.uris.get(qname)
+        if uri is None:
+            prefix, colon, name = qname.partition(':')
+            if not colon or prefix not in self.prefixes:
+                return qname
+            uri = self.uris[qname] = URIRef(self.prefixes[prefix] + name)
+        return uri
+
+
 def corpus_property_namespace(corpusID):
     """Return a namespace object suitable for use
     in generating new property names for this corpus"""
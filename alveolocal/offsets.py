@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+"""Character offsets into UTF-8 documents.
+
+Annotations give their regions as character offsets but a UTF-8
+file can only be seeked by byte. An OffsetIndex records the byte
+offset of every step'th character so the text of a region is read
+by seeking to the checkpoint before it and decoding from there.
+"""
+
+import codecs
+from threading import Lock
+
+import compress
+
+
+# how much of a file to decode at a time when building an index
+CHUNK = 64 * 1024
+
+
+def _decoder():
+    return codecs.getincrementaldecoder('utf-8')()
+
+
+class OffsetIndex(object):
+    """The byte offsets of every step'th character of a UTF-8 file.
+    length is the number of characters in the file"""
+
+    def __init__(self, fp, step=1024):
+        self.step = step
+        self.checkpoints = [0]
+        self.length = 0
+
+        decoder = _decoder()
+        pos = 0
+        while True:
+            data = fp.read(CHUNK)
+            text = decoder.decode(data, not data)
+            done = 0
+            char = len(self.checkpoints) * step - self.length
+            while char < len(text):
+                pos += len(text[done:char].encode('utf-8'))
+                self.checkpoints.append(pos)
+                done = char
+                char += step
+            pos += len(text[done:].encode('utf-8'))
+            self.length += len(text)
+            if not data:
+                break
+
+    def read(self, fp, start, end):
+        """Return the characters from start up to end of the file
+        this is the index of"""
+
+        start = max(0, min(start, self.length))
+        end = max(start, min(end, self.length))
+        # there is no checkpoint at the end of a text whose length is a multiple of step
+        checkpoint = min(start // self.step, len(self.checkpoints) - 1)
+        fp.seek(self.checkpoints[checkpoint])
+
+        # every character is at least one byte so reading as many
+        # bytes as there are characters still wanted never overshoots
+        wanted = end - checkpoint * self.step
+        decoder = _decoder()
+        text = u""
+        while len(text) < wanted:
+            data = fp.read(wanted - len(text))
+            text += decoder.decode(data, not data)
+            if not data:
+                break
+        return text[start - checkpoint * self.step:wanted]
+
+
+class OffsetIndexes(object):
+    """The OffsetIndex of each document read so far, rebuilt when
+    the file changes"""
+
+    def __init__(self, step=1024):
+        self.step = step
+        self.indexes = dict()
+        self.lock = Lock()
+
+    def read(self, path, spans, found=None):
+        """Return the text of the document at path between each of
+        a list of (start, end) character offsets. found is what
+        compress.locate returned for path, it is looked for if not given"""
+
+        if found is None:
+            found = compress.locate(path)
+        if found is None:
+            raise IOError(2, "No such file or directory", path)
+        key = (found[3], found[2])
+
+        with compress.open_document(path, found) as fp:
+            with self.lock:
+                cached = self.indexes.get(path)
+            if cached is None or cached[0] != key:
+                cached = (key, OffsetIndex(fp, self.step))
+                with self.lock:
+                    self.indexes[path] = cached
+            # in order of start as compressed files only seek forward cheaply
+            result = [None] * len(spans)
+            for i in sorted(range(len(spans)), key=lambda i: spans[i][0]):
+                result[i] = cached[1].read(fp, spans[i][0], spans[i][1])
+            return result
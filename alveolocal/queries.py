@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+"""The SPARQL queries the API runs, each prepared once.
+
+Queries are named and prepared the first time they are run. Every
+run is counted and timed, ad hoc query text such as a search can be
+counted too under a name of its own.
+"""
+
+import time
+from threading import Lock
+
+from rdflib.plugins.sparql.processor import prepareQuery
+
+from namespaces import DC, DCMITYPE, AUSNC, DADA, PROV, LOCALTERMS, FOAF
+
+
+NAMESPACES = {"dc": DC,
+              "dcmitype": DCMITYPE,
+              "ausnc": AUSNC,
+              "dada": DADA,
+              "prov": PROV,
+              "foaf": FOAF,
+              "localterms": LOCALTERMS,
+              }
+
+# the annotations of ?item and how to restrict them to those made
+# before ?givenTime or by ?user
+ANNOTATIONS = """select ?annotation where {
+                     ?annotation dada:partof ?annCollection.
+                     ?annCollection dada:annotates ?item.
+                     %s
+                 }"""
+PRIOR_TO = """?annCollection prov:generatedAtTime ?time.
+              FILTER (?time < ?givenTime)"""
+BY_USER = """?annCollection prov:wasGeneratedBy ?activity.
+             ?activity prov:wasAssociatedWith ?agent.
+             ?agent foaf:mbox ?user."""
+
+# the queries of _get_uri are named <output>_of_<input>
+QUERIES = {
+    'collection_of_item': """select ?collection where {
+                                 ?collection a dcmitype:Collection.
+                                 ?item dc:isPartOf ?collection.
+                             }""",
+    'collection_of_document': """select ?collection where {
+                                     ?collection a dcmitype:Collection.
+                                     ?item dc:isPartOf ?collection.
+                                     ?item ausnc:document ?document.
+                                 }""",
+    'collection_of_source': """select ?collection where {
+                                   ?collection a dcmitype:Collection.
+                                   ?item dc:isPartOf ?collection.
+                                   ?item ausnc:document ?document.
+                                   ?document dc:source ?source.
+                               }""",
+    'collection_of_annotation': """select ?collection where {
+                                       ?collection a dcmitype:Collection.
+                                       ?item dc:isPartOf ?collection.
+                                       ?annCollID dada:annotates ?item.
+                                       ?annotation dada:partof ?annCollID.
+                                   }""",
+    'item_of_collection': """select ?item where {
+                                 ?collection a dcmitype:Collection.
+                                 ?item dc:isPartOf ?collection.
+                             }""",
+    'item_of_itemlist': """select ?item where {
+                               ?itemlistid a localterms:itemList.
+                               ?item dc:isPartOf ?itemlistid.
+                           }""",
+    'item_of_annotation': """select ?item where {
+                                 ?annCollID dada:annotates ?item.
+                                 ?annotation dada:partof ?annCollID.
+                             }""",
+    'item_of_document': """select ?item where {
+                               ?item ausnc:document ?document.
+                           }""",
+    'item_of_source': """select ?item where {
+                             ?item ausnc:document ?document.
+                             ?document dc:source ?source.
+                         }""",
+    'annotation_of_item': """select ?annotation where {
+                                 ?annotation dada:partof ?annCollID.
+                                 ?annCollID dada:annotates ?item.
+                             }""",
+    'annotations_prior_to': ANNOTATIONS % PRIOR_TO,
+    'annotations_by_user': ANNOTATIONS % BY_USER,
+    'annotations_by_user_prior_to': ANNOTATIONS % (BY_USER + "\n" + PRIOR_TO),
+    'instances_of_type': """select ?instance where {
+                                ?instance a ?type
+                            }""",
+}
+
+
+class QueryRegistry(object):
+    """Named SPARQL queries, prepared on first use, with the
+    number of times each has been run and the time taken"""
+
+    def __init__(self, texts, namespaces):
+        self.texts = texts
+        self.namespaces = namespaces
+        self.prepared = dict()
+        self.executions = dict()
+        self.seconds = dict()
+        self.lock = Lock()
+
+    def __contains__(self, name):
+        return name in self.texts
+
+    def get(self, name):
+        """Return the prepared query of this name"""
+
+        query = self.prepared.get(name)
+        if query is None:
+            query = prepareQuery(self.texts[name], initNs=self.namespaces)
+            with self.lock:
+                self.prepared[name] = query
+        return query
+
+    def run(self, graph, name, bindings=None, text=None):
+        """Run the named query on graph with the given variable
+        bindings and return the result, all of whose bindings have
+        been found. If text is given it is run in place of a
+        prepared query and counted under name"""
+
+        query = text if text is not None else self.get(name)
+        started = time.time()
+        result = graph.query(query, initBindings=bindings or {})
+        # the bindings are found lazily, find them now to time them
+        result.bindings
+        self._count(name, time.time() - started)
+        return result
+
+    def _count(self, name, seconds):
+        with self.lock:
+            self.executions[name] = self.executions.get(name, 0) + 1
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    def stats(self):
+        """Return the number of executions and total seconds of
+        each query that has been run"""
+
+        with self.lock:
+            return dict((name, {'executions': self.executions[name],
+                                'seconds': self.seconds[name]})
+                        for name in self.executions)
+
+
+sparql = QueryRegistry(QUERIES, NAMESPACES)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+"""A binary snapshot of the parsed contents of a directory of RDF files.
+
+Alongside the triples from each file the snapshot keeps a manifest of
+the file's size and modification time so that when a directory is
+attached again only the files that have changed need to be parsed.
+"""
+
+import os
+from array import array
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+class Snapshot(object):
+    """The triples of a directory of RDF files, stored as one table of
+    terms shared by every file and an array of term indexes per file"""
+
+    FORMAT = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.terms = []
+        self.files = dict()
+        self.changed = False
+        self._index = None
+        self.load()
+
+    def load(self):
+        """Read the snapshot file if there is one. A missing, unreadable
+        or out of date snapshot leaves the snapshot empty"""
+
+        if not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path, 'rb') as fp:
+                data = pickle.load(fp)
+        except Exception:
+            return
+
+        if data.get('format') == self.FORMAT:
+            self.terms = data['terms']
+            self.files = data['files']
+
+    def save(self):
+        """Write the snapshot, dropping terms that are no longer used"""
+
+        self._compact()
+        tmp = self.path + ".tmp"
+        with open(tmp, 'wb') as fp:
+            pickle.dump({'format': self.FORMAT, 'terms': self.terms, 'files': self.files},
+                        fp, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, self.path)
+        self.changed = False
+
+    def is_current(self, name, stat):
+        """True if the snapshot holds name with this (size, mtime)"""
+
+        entry = self.files.get(name)
+        return entry is not None and (entry[0], entry[1]) == stat
+
+    def update(self, name, stat, namespaces, terms, triples):
+        """Record the freshly parsed triples of one file, terms and
+        triples are in the form returned by loader.parse_file"""
+
+        if self._index is None:
+            self._index = dict((term, i) for i, term in enumerate(self.terms))
+
+        ids = []
+        for term in terms:
+            if isinstance(term, tuple) and len(term) == 1:
+                # blank nodes are only the same within one file
+                term = (u"%s %s" % (name, term[0]),)
+            i = self._index.get(term)
+            if i is None:
+                i = self._index[term] = len(self.terms)
+                self.terms.append(term)
+            ids.append(i)
+
+        self.files[name] = (stat[0], stat[1], namespaces, array('i', [ids[i] for i in triples]))
+        self.changed = True
+
+    def retain(self, names):
+        """Forget about any file not in names"""
+
+        for name in set(self.files) - set(names):
+            del self.files[name]
+            self.changed = True
+
+    def _compact(self):
+        """Renumber the terms so that only those in use are kept"""
+
+        used = set()
+        for entry in self.files.values():
+            used.update(entry[3])
+
+        if len(used) == len(self.terms):
+            return
+
+        renumber = dict()
+        terms = []
+        for i in sorted(used):
+            renumber[i] = len(terms)
+            terms.append(self.terms[i])
+
+        for name, (size, mtime, namespaces, triples) in self.files.items():
+            self.files[name] = (size, mtime, namespaces, array('i', [renumber[i] for i in triples]))
+        self.terms = terms
+        self._index = None
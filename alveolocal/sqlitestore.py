@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+
+"""An rdflib store that keeps its triples in an SQLite database.
+
+Terms are stored once in a table of terms and the quads refer to them
+by integer id. The quads table is indexed on (s, p, o, c), (p, o, s),
+(o, s, p) and (c) so that any triple pattern can be answered from an
+index. The store also records the size and modification time of the
+files that were loaded into it so that an existing database can be
+reopened without parsing the files again.
+
+Each thread has a connection of its own, so that one thread never
+commits or reads the half finished changes of another. The connection
+is closed when its thread ends, and the term caches go with it since a
+term added in a transaction has no id for other threads until it is
+committed.
+"""
+
+import os
+import sqlite3
+import threading
+import weakref
+
+from rdflib.graph import Graph
+from rdflib.store import Store, VALID_STORE, NO_STORE
+from rdflib.term import URIRef, BNode, Literal
+
+
+class _Connection(object):
+    """The connection of one thread and its term id caches"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.ids = dict()
+        self.terms = dict()
+
+
+class SQLiteStore(Store):
+    """A context aware rdflib store backed by an SQLite database"""
+
+    context_aware = True
+    formula_aware = False
+    transaction_aware = False
+    graph_aware = False
+
+    # largest number of terms kept in the in-memory id caches
+    CACHE_SIZE = 100000
+
+    def __init__(self, configuration=None, identifier=None):
+        self.path = None
+        self._local = threading.local()
+        # the connections still open, by a weak reference to the
+        # _Connection of their thread, to be closed with the store
+        self._connections = dict()
+        self._lock = threading.Lock()
+        super(SQLiteStore, self).__init__(configuration, identifier)
+
+    def open(self, configuration, create=False):
+        """Open the database at the path given as configuration"""
+
+        if not create and not os.path.exists(configuration):
+            return NO_STORE
+
+        self.path = configuration
+        cursor = self.conn.cursor()
+        cursor.execute("PRAGMA journal_mode = WAL")
+        cursor.execute("""CREATE TABLE IF NOT EXISTS [terms]
+                        (
+                        [id] INTEGER PRIMARY KEY,
+                        [kind] TEXT,
+                        [value] TEXT,
+                        [datatype] TEXT,
+                        [lang] TEXT,
+                        UNIQUE ([value], [kind], [datatype], [lang])
+                        )""")
+        cursor.execute("""CREATE TABLE IF NOT EXISTS [quads]
+                        (
+                        [s] INTEGER,
+                        [p] INTEGER,
+                        [o] INTEGER,
+                        [c] INTEGER,
+                        PRIMARY KEY ([s], [p], [o], [c])
+                        ) WITHOUT ROWID""")
+        cursor.execute("CREATE INDEX IF NOT EXISTS [pos] ON [quads] ([p], [o], [s])")
+        cursor.execute("CREATE INDEX IF NOT EXISTS [osp] ON [quads] ([o], [s], [p])")
+        cursor.execute("CREATE INDEX IF NOT EXISTS [ctx] ON [quads] ([c])")
+        cursor.execute("""CREATE TABLE IF NOT EXISTS [namespaces]
+                        (
+                        [prefix] TEXT PRIMARY KEY,
+                        [uri] TEXT UNIQUE
+                        )""")
+        cursor.execute("""CREATE TABLE IF NOT EXISTS [files]
+                        (
+                        [path] TEXT PRIMARY KEY,
+                        [size] INTEGER,
+                        [mtime] REAL
+                        )""")
+        self.conn.commit()
+        return VALID_STORE
+
+    @property
+    def _state(self):
+        """The _Connection of the calling thread, None if the store is
+        not open"""
+
+        state = getattr(self._local, 'state', None)
+        if state is None and self.path is not None:
+            # closed from whichever thread ends or closes the store
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.text_factory = unicode
+            state = self._local.state = _Connection(conn)
+            with self._lock:
+                self._connections[weakref.ref(state, self._closed)] = conn
+        return state
+
+    @property
+    def conn(self):
+        """The connection of the calling thread, None if the store is
+        not open"""
+
+        state = self._state
+        return state.conn if state is not None else None
+
+    def _closed(self, ref):
+        """Close the connection of a thread that has ended"""
+
+        with self._lock:
+            conn = self._connections.pop(ref, None)
+        if conn is not None:
+            conn.close()
+
+    def close(self, commit_pending_transaction=False):
+        if self.path is not None:
+            if commit_pending_transaction:
+                self.conn.commit()
+            with self._lock:
+                for conn in self._connections.values():
+                    conn.close()
+                self._connections = dict()
+            self._local = threading.local()
+            self.path = None
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        state = self._state
+        state.conn.rollback()
+        # the ids of terms added since the last commit are gone
+        state.ids.clear()
+        state.terms.clear()
+
+    # terms
+
+    def _encode(self, term):
+        """Return the (kind, value, datatype, lang) row for a term"""
+
+        if isinstance(term, Literal):
+            return (u'L', unicode(term), unicode(term.datatype or u''), term.language or u'')
+        elif isinstance(term, BNode):
+            return (u'B', unicode(term), u'', u'')
+        return (u'U', unicode(term), u'', u'')
+
+    def _decode(self, kind, value, datatype, lang):
+        """Return the term stored in a row of the terms table"""
+
+        if kind == u'L':
+            return Literal(value, datatype=datatype or None, lang=lang or None)
+        elif kind == u'B':
+            return BNode(value)
+        return URIRef(value)
+
+    def _cache(self, cache, key, value):
+        if len(cache) >= self.CACHE_SIZE:
+            cache.clear()
+        cache[key] = value
+
+    def _id(self, term, create=False):
+        """Return the id of a term, None if it is not in the store
+        unless create is True in which case it is added"""
+
+        state = self._state
+        tid = state.ids.get(term)
+        if tid is not None:
+            return tid
+
+        row = self._encode(term)
+        cursor = state.conn.execute("SELECT id FROM terms WHERE value = ? AND kind = ? AND datatype = ? AND lang = ?",
+                                    (row[1], row[0], row[2], row[3]))
+        result = cursor.fetchone()
+        if result is not None:
+            tid = result[0]
+        elif create:
+            cursor = state.conn.execute("INSERT OR IGNORE INTO terms (kind, value, datatype, lang) VALUES (?, ?, ?, ?)", row)
+            if cursor.rowcount:
+                tid = cursor.lastrowid
+            else:
+                # added by another thread since it was looked for
+                tid = state.conn.execute("SELECT id FROM terms WHERE value = ? AND kind = ? AND datatype = ? AND lang = ?",
+                                         (row[1], row[0], row[2], row[3])).fetchone()[0]
+        else:
+            return None
+
+        self._cache(state.ids, term, tid)
+        return tid
+
+    def _term(self, tid):
+        """Return the term with this id"""
+
+        state = self._state
+        term = state.terms.get(tid)
+        if term is None:
+            row = state.conn.execute("SELECT kind, value, datatype, lang FROM terms WHERE id = ?", (tid,)).fetchone()
+            term = self._decode(*row)
+            self._cache(state.terms, tid, term)
+        return term
+
+    def _context_id(self, context, create=False):
+        """Return the id of a context given as a Graph or an identifier"""
+
+        if isinstance(context, Graph):
+            context = context.identifier
+        return self._id(context, create)
+
+    def _where(self, triple, context):
+        """Return the SQL condition and parameters matching the triple
+        pattern in context, None if one of the terms is not in the store"""
+
+        conditions = []
+        params = []
+        for column, term in zip(('s', 'p', 'o'), triple):
+            if term is not None:
+                tid = self._id(term)
+                if tid is None:
+                    return None
+                conditions.append("%s = ?" % column)
+                params.append(tid)
+
+        if context is not None:
+            cid = self._context_id(context)
+            if cid is None:
+                return None
+            conditions.append("c = ?")
+            params.append(cid)
+
+        if conditions:
+            return " WHERE " + " AND ".join(conditions), params
+        return "", params
+
+    # RDF API
+
+    def add(self, triple, context, quoted=False):
+        self.addN([(triple[0], triple[1], triple[2], context)])
+
+    def addN(self, quads):
+        rows = []
+        for s, p, o, c in quads:
+            rows.append((self._id(s, True), self._id(p, True), self._id(o, True), self._context_id(c, True)))
+        self.conn.executemany("INSERT OR IGNORE INTO quads (s, p, o, c) VALUES (?, ?, ?, ?)", rows)
+
+    def remove(self, triple, context=None):
+        where = self._where(triple, context)
+        if where is not None:
+            self.conn.execute("DELETE FROM quads" + where[0], where[1])
+
+    def triples(self, triple, context=None):
+        where = self._where(triple, context)
+        if where is None:
+            return
+
+        if context is None:
+            sql = "SELECT DISTINCT s, p, o FROM quads"
+        else:
+            sql = "SELECT s, p, o FROM quads"
+
+        for s, p, o in self.conn.cursor().execute(sql + where[0], where[1]):
+            result = (self._term(s), self._term(p), self._term(o))
+            if context is None:
+                yield result, self._contexts((s, p, o))
+            else:
+                yield result, iter([context])
+
+    def _contexts(self, ids):
+        """Generate the contexts holding the triple with these term ids"""
+
+        for (c,) in self.conn.execute("SELECT c FROM quads WHERE s = ? AND p = ? AND o = ?", ids).fetchall():
+            yield Graph(self, identifier=self._term(c))
+
+    def __len__(self, context=None):
+        if context is None:
+            sql = "SELECT COUNT(*) FROM (SELECT DISTINCT s, p, o FROM quads)"
+            return self.conn.execute(sql).fetchone()[0]
+
+        cid = self._context_id(context)
+        if cid is None:
+            return 0
+        return self.conn.execute("SELECT COUNT(*) FROM quads WHERE c = ?", (cid,)).fetchone()[0]
+
+    def contexts(self, triple=None):
+        if triple is None:
+            sql, params = "SELECT DISTINCT c FROM quads", []
+        else:
+            where = self._where(triple, None)
+            if where is None:
+                return
+            sql, params = "SELECT DISTINCT c FROM quads" + where[0], where[1]
+
+        for (c,) in self.conn.execute(sql, params).fetchall():
+            yield Graph(self, identifier=self._term(c))
+
+    # namespaces
+
+    def bind(self, prefix, namespace):
+        self.conn.execute("DELETE FROM namespaces WHERE prefix = ? OR uri = ?", (prefix, unicode(namespace)))
+        self.conn.execute("INSERT INTO namespaces VALUES (?, ?)", (prefix, unicode(namespace)))
+
+    def namespace(self, prefix):
+        result = self.conn.execute("SELECT uri FROM namespaces WHERE prefix = ?", (prefix,)).fetchone()
+        if result is not None:
+            return URIRef(result[0])
+
+    def prefix(self, namespace):
+        result = self.conn.execute("SELECT prefix FROM namespaces WHERE uri = ?", (unicode(namespace),)).fetchone()
+        if result is not None:
+            return result[0]
+
+    def namespaces(self):
+        for prefix, uri in self.conn.execute("SELECT prefix, uri FROM namespaces").fetchall():
+            yield prefix, URIRef(uri)
+
+    # the files loaded into the store
+
+    def load_manifest(self):
+        """Return the (size, mtime) of the files loaded, keyed by path"""
+
+        return dict((path, (size, mtime)) for path, size, mtime
+                    in self.conn.execute("SELECT path, size, mtime FROM files"))
+
+    def save_manifest(self, files):
+        """Record the (size, mtime) of the files loaded, keyed by path"""
+
+        self.conn.execute("DELETE FROM files")
+        self.conn.executemany("INSERT INTO files VALUES (?, ?, ?)",
+                              [(path, size, mtime) for path, (size, mtime) in files.items()])
+        self.conn.commit()
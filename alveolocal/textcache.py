@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+"""An in-process cache of the contents of text files."""
+
+import sys
+from collections import OrderedDict
+from threading import Lock
+
+import compress
+
+
+class TextCache(object):
+    """The contents of recently read files, least recently used
+    first, holding no more than max_bytes in total. Entries are
+    keyed by path and modification time so a file that is edited
+    is read again. Compressed documents are cached uncompressed"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        # the keys of the entries for each path
+        self.paths = dict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = Lock()
+
+    def read(self, path, encoding=None, found=None):
+        """Return the contents of the document at path, decoded
+        if an encoding is given. found is what compress.locate
+        returned for path, it is looked for if not given"""
+
+        if found is None:
+            found = compress.locate(path)
+        if found is None:
+            raise IOError(2, "No such file or directory", path)
+        key = (path, found[3], found[2], encoding)
+
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.entries[key] = value
+                self.hits += 1
+                return value
+            self.misses += 1
+
+        value = compress.read(path, found)
+        if encoding is not None:
+            value = value.decode(encoding)
+
+        size = sys.getsizeof(value)
+        if size > self.max_bytes:
+            return value
+
+        with self.lock:
+            # older versions of the file will not be asked for again
+            for old in [k for k in self.paths.get(path, ()) if k[1:3] != key[1:3]]:
+                self._remove(old)
+
+            if key not in self.entries:
+                self.entries[key] = value
+                self.size += size
+                self.paths.setdefault(path, set()).add(key)
+
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+        return value
+
+    def _remove(self, key):
+        self.size -= sys.getsizeof(self.entries.pop(key))
+        keys = self.paths[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self.paths[key[0]]
+
+    def stats(self):
+        """Return the hit, miss and eviction counts along with the
+        number of entries and bytes held"""
+
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self.entries),
+                    'bytes': self.size,
+                    'max_bytes': self.max_bytes,
+                    }
@@ -33,6 +33,11 @@ setup(
     package_dir={'alveolocal':
                  'alveolocal'},
     include_package_data=True,
+    entry_points={
+        'console_scripts': [
+            'alveolocal-compress = alveolocal.compress:main',
+        ],
+    },
     install_requires=requirements,
     license="BSD",
     zip_safe=False,
@@ -10,15 +10,43 @@ Tests for `alveolocal` module.
 
 import json 
 import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 
-from alveolocal import API
+from alveolocal import API, compress
+from alveolocal import base
+from alveolocal.annotations import AnnotationIndex, SECONDS
+from alveolocal.base import registry
+from alveolocal.compactstore import compare_memory
+from alveolocal.itemlist import ItemListFactory
+from alveolocal.namespaces import DADA, RDF
 from datetime import datetime
+from decimal import Decimal
+from rdflib import Literal, URIRef
 
 
 TEST_DATA = os.path.join(os.path.dirname(__file__), "data")
 
 
+def copy_test_data(testcase, *names):
+    """Return a copy of the cooee collection and any other named
+    directories of TEST_DATA, with their descriptions, removed when
+    the test is over. The copy is a "data" directory inside a new
+    temporary directory"""
+
+    tmpdir = tempfile.mkdtemp()
+    testcase.addCleanup(shutil.rmtree, tmpdir)
+    datadir = os.path.join(tmpdir, "data")
+    for name in ("cooee",) + names:
+        shutil.copytree(os.path.join(TEST_DATA, name), os.path.join(datadir, name))
+        if os.path.exists(os.path.join(TEST_DATA, name + ".n3")):
+            shutil.copy(os.path.join(TEST_DATA, name + ".n3"), datadir)
+    return datadir
+
+
 class TestAlveolocalLoad(unittest.TestCase):
 
     def setUp(self):
@@ -32,6 +60,429 @@ class TestAlveolocalLoad(unittest.TestCase):
         # check the number of triples loaded
         self.assertEqual(7628, self.api.attach_directory(TEST_DATA))
 
+    def test_attach_directory_workers(self):
+        """parsing in worker processes loads the same triples"""
+
+        serial = API()
+        count = serial.attach_directory(TEST_DATA)
+        serial.detach()
+
+        self.assertEqual(count, self.api.attach_directory(TEST_DATA, workers=3))
+
+        # prefixes declared in the files are carried over too
+        meta = self.api.get_collection('http://localhost:3000/catalog/cooee')
+        self.assertEqual('2004', meta['metadata']['dc:created'])
+
+    def test_attach_directory_snapshot(self):
+        """a snapshot is written on first load and reused after that"""
+
+        datadir = copy_test_data(self)
+        snapshot = os.path.join(os.path.dirname(datadir), "snapshot")
+
+        count = self.api.attach_directory(datadir, snapshot=snapshot)
+        self.assertTrue(os.path.exists(snapshot))
+
+        # a file that is not in the snapshot gets parsed
+        newfile = os.path.join(datadir, "cooee", "extra.n3")
+        with open(newfile, 'w') as fp:
+            fp.write("<http://example.org/a> <http://example.org/b> <http://example.org/c> .\n")
+
+        self.api.detach()
+        self.assertEqual(count + 1, self.api.attach_directory(datadir, snapshot=snapshot))
+        self.assertEqual('2004', self.api.get_collection('http://localhost:3000/catalog/cooee')['metadata']['dc:created'])
+
+        # and a deleted one is dropped
+        os.remove(newfile)
+        self.api.detach()
+        self.assertEqual(count, self.api.attach_directory(datadir, snapshot=snapshot))
+
+    def test_reload(self):
+        """reloading picks up added, modified and deleted files"""
+
+        tmpdir = copy_test_data(self)
+        self.api.attach_directory(tmpdir)
+
+        self.assertEqual({'added': [], 'modified': [], 'removed': []}, self.api.reload())
+
+        itemuri = "http://localhost:3000/catalog/cooee/items/1-012"
+        self.assertEqual(2, len(self.api.get_annotation_types(itemuri)['annotation_types']))
+
+        added = os.path.join(tmpdir, "cooee", "extra.n3")
+        with open(added, 'w') as fp:
+            fp.write("<http://example.org/a> <http://example.org/b> <http://example.org/c> .\n")
+        removed = os.path.join(tmpdir, "cooee", "1-012-ann.rdf")
+        os.remove(removed)
+
+        result = self.api.reload()
+        self.assertEqual([added], result['added'])
+        self.assertEqual([removed], result['removed'])
+        self.assertEqual([], self.api.get_annotation_types(itemuri)['annotation_types'])
+
+        with open(added, 'w') as fp:
+            fp.write("<http://example.org/a> <http://example.org/b> <http://example.org/d> .\n")
+        result = self.api.reload()
+        self.assertEqual([added], result['modified'])
+        a, b = URIRef("http://example.org/a"), URIRef("http://example.org/b")
+        self.assertEqual([URIRef("http://example.org/d")], list(self.api.graph.objects(a, b)))
+
+    def test_item_metadata_cache(self):
+        """item metadata JSON is kept until the collection changes"""
+
+        tmpdir = copy_test_data(self)
+        self.api.attach_directory(tmpdir)
+
+        itemuri = "http://localhost:3000/catalog/cooee/items/1-012"
+        first = self.api.get_item_metadata_json(itemuri)
+        self.assertEqual(json.loads(json.dumps(self.api.get_item_metadata(itemuri))), json.loads(first))
+        self.assertIs(first, self.api.get_item_metadata_json(itemuri))
+
+        # binding a prefix changes the qnames
+        self.api.store.bind('terms', "http://purl.org/dc/terms/")
+        meta = json.loads(self.api.get_item_metadata_json(itemuri))
+        self.assertIn('terms:created', meta['alveo:metadata'])
+        self.assertEqual(meta, json.loads(list(self.api.get_items_metadata_json([itemuri]))[0]))
+        self.api.store.bind('dc', "http://purl.org/dc/terms/")
+
+        with open(os.path.join(tmpdir, "cooee", "extra.n3"), 'w') as fp:
+            fp.write("<%s> <http://purl.org/dc/terms/title> \"Letter\" .\n" % itemuri)
+        self.api.reload()
+
+        version = self.api.get_version(itemuri)
+        meta = json.loads(self.api.get_item_metadata_json(itemuri))
+        self.assertEqual('Letter', meta['alveo:metadata']['dc:title'])
+
+        # the version only moves on when the collection changes
+        self.assertEqual(version, self.api.get_version(itemuri))
+        os.remove(os.path.join(tmpdir, "cooee", "extra.n3"))
+        self.api.reload()
+        self.assertTrue(self.api.get_version(itemuri)[0] > version[0])
+
+    def test_attach_directory_lazy(self):
+        """in lazy mode collections are loaded when first used"""
+
+        count = self.api.attach_directory(TEST_DATA, lazy=True, max_collections=1)
+        self.assertTrue(count < 100)
+        self.assertEqual(2, len(self.api.get_collections()))
+
+        meta = self.api.get_item_metadata("http://localhost:3000/catalog/cooee/items/1-012")
+        self.assertEqual('1788', meta['alveo:metadata']['dc:created'])
+        self.assertEqual(['cooee'], list(self.api.store.collections))
+
+        types = self.api.get_annotation_types("http://localhost:3000/catalog/mitcheldelbridge/items/S1219s1")
+        self.assertIn("http://ns.ausnc.org.au/schemas/annotation/maus/orthography", types['annotation_types'])
+        self.assertEqual(['mitcheldelbridge'], list(self.api.store.collections))
+
+        # search visits every collection
+        self.assertEqual(5, len(self.api.search((('dc:created', '1788'), ))))
+
+    def test_using_lazy(self):
+        """a collection in use is not unloaded by another being required"""
+
+        self.api.attach_directory(TEST_DATA, lazy=True, max_collections=1)
+        store = self.api.store
+        item = URIRef("http://localhost:3000/catalog/cooee/items/1-012")
+        with store.using('cooee'):
+            with store.using('mitcheldelbridge'):
+                self.assertEqual(['cooee', 'mitcheldelbridge'], list(store.collections))
+            # the one over the limit goes once nothing uses it
+            self.assertEqual(['cooee'], list(store.collections))
+            self.assertTrue((item, None, None) in self.api.graph)
+        self.assertEqual(['cooee'], list(store.collections))
+        self.assertEqual({}, store.pins)
+
+        # readers and loaders at once
+        errors = []
+
+        def read(collection_id):
+            try:
+                for _ in range(5):
+                    with store.using(collection_id):
+                        count = len(list(store.view(collection_id).triples((None, None, None))))
+                        self.assertTrue(count > 0)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=read, args=(collection_id,))
+                   for collection_id in ['cooee', 'mitcheldelbridge'] * 3]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        self.assertEqual(1, len(store.collections))
+
+    def test_summaries_lazy(self):
+        """summaries in lazy mode do not load collections"""
+
+        self.api.attach_directory(TEST_DATA, lazy=True, max_collections=1)
+        summaries = self.api.get_collection_summaries()
+        self.assertEqual([None, None], [summary['num_items'] for summary in summaries])
+        self.assertEqual([], list(self.api.store.collections))
+
+        self.api.get_item_metadata("http://localhost:3000/catalog/cooee/items/1-012")
+        cooee = self.api.get_collection_summary('http://localhost:3000/catalog/cooee')
+        self.assertEqual(10, cooee['num_items'])
+        version = self.api.get_version()
+        for _ in range(2):
+            summaries = dict((summary['collection_name'], summary) for summary in self.api.get_collection_summaries())
+        self.assertIs(cooee, summaries['COOEE'])
+        self.assertEqual(None, [s for name, s in summaries.items() if name != 'COOEE'][0]['num_items'])
+        self.assertEqual(['cooee'], list(self.api.store.collections))
+        self.assertEqual(version, self.api.get_version())
+
+        # the last summary made is kept once the collection is unloaded
+        self.api.get_item_metadata("http://localhost:3000/catalog/mitcheldelbridge/items/S1219s1")
+        self.assertEqual(['mitcheldelbridge'], list(self.api.store.collections))
+        self.assertIs(cooee, self.api.get_collection_summary('http://localhost:3000/catalog/cooee'))
+        self.assertEqual(['mitcheldelbridge'], list(self.api.store.collections))
+
+    def test_items_metadata_lazy(self):
+        """the items of a batch are looked up a collection at a time"""
+
+        self.api.attach_directory(TEST_DATA, lazy=True, max_collections=1)
+        items = ["http://localhost:3000/catalog/cooee/items/1-012",
+                 "http://localhost:3000/catalog/mitcheldelbridge/items/S1219s1",
+                 "http://localhost:3000/catalog/cooee/items/1-013",
+                 "http://localhost:3000/catalog/mitcheldelbridge/items/missing"]
+        loaded = []
+        load = self.api.store._load
+        self.api.store._load = lambda sources, stats: loaded.append(len(sources)) or load(sources, stats)
+
+        result = [json.loads(meta) for meta in self.api.get_items_metadata_json(items)]
+        self.assertEqual(items, [meta['alveo:catalog_url'] for meta in result])
+        self.assertEqual([False, False, False, True], ['error' in meta for meta in result])
+        self.assertEqual(2, len(loaded))
+
+    def test_caches_lazy(self):
+        """what is cached about a collection goes when it is unloaded"""
+
+        self.api.attach_directory(TEST_DATA, lazy=True, max_collections=1)
+        itemuri = "http://localhost:3000/catalog/cooee/items/1-012"
+        self.api.get_item_metadata_json(itemuri)
+        self.api.get_annotations(itemuri, {})
+        self.api.get_primary_text(itemuri)
+        self.assertEqual(['cooee'], self.api.annotation_indexes.keys())
+        self.assertEqual(['cooee'], self.api.document_indexes.keys())
+        self.assertEqual([itemuri], self.api.metadata_cache.keys())
+
+        self.api.get_annotations("http://localhost:3000/catalog/mitcheldelbridge/items/S1219s1", {})
+        self.assertEqual(['mitcheldelbridge'], self.api.annotation_indexes.keys())
+        self.assertEqual([], self.api.document_indexes.keys())
+        self.assertEqual([], self.api.metadata_cache.keys())
+
+        # nothing is kept for a collection that is not there
+        self.assertFalse(self.api.has_collection("nosuch"))
+        self.assertEqual([], self.api.get_annotations("http://localhost:3000/catalog/nosuch/items/1-012", {})['alveo:annotations'])
+        self.api.get_item_metadata_json("http://localhost:3000/catalog/nosuch/items/1-012")
+        self.assertEqual(['mitcheldelbridge'], self.api.annotation_indexes.keys())
+        self.assertEqual([], self.api.metadata_cache.keys())
+
+    def test_attach_directory_sqlite(self):
+        """triples can be kept in an SQLite database that is reused"""
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            database = os.path.join(tmpdir, "triples.db")
+            count = self.api.attach_directory(TEST_DATA, backend="sqlite", database=database)
+
+            itemuri = "http://localhost:3000/catalog/cooee/items/1-012"
+            meta = self.api.get_item_metadata(itemuri)
+            self.assertEqual('1788', meta['alveo:metadata']['dc:created'])
+            self.assertEqual(5, len(self.api.search((('dc:created', '1788'), ))))
+
+            # nothing needs parsing when the database is opened again
+            self.api.detach()
+            self.assertEqual(count, self.api.attach_directory(TEST_DATA, backend="sqlite", database=database))
+            self.assertEqual({'added': [], 'modified': [], 'removed': []}, self.api.reload())
+            self.assertEqual(2, len(self.api.get_annotations(itemuri, {})['alveo:annotations']))
+        finally:
+            self.api.detach()
+            shutil.rmtree(tmpdir)
+
+    def test_sqlite_threads(self):
+        """threads can read and add to an SQLite database at once"""
+
+        datadir = copy_test_data(self)
+        database = os.path.join(os.path.dirname(datadir), "triples.db")
+        self.api.attach_directory(datadir, backend="sqlite", database=database)
+        itemuri = "http://localhost:3000/catalog/cooee/items/1-012"
+        title = URIRef("http://purl.org/dc/terms/title")
+        errors = []
+
+        def read():
+            try:
+                for _ in range(20):
+                    meta = self.api.get_item_metadata(itemuri)
+                    self.assertEqual('1788', meta['alveo:metadata']['dc:created'])
+            except Exception as e:
+                errors.append(e)
+
+        def insert(n):
+            try:
+                path = os.path.join(datadir, "cooee", "extra%d.n3" % n)
+                open(path, 'w').close()
+                for i in range(20):
+                    self.api.store.insert(path, [(URIRef("http://example.org/%d/%d" % (n, i)), title, Literal(u"wörd"))])
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=read) for _ in range(3)]
+        threads += [threading.Thread(target=insert, args=(n,)) for n in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        self.assertEqual(60, len(list(self.api.graph.triples((None, title, Literal(u"wörd"))))))
+
+        # the connections of the threads are closed as they end, which
+        # happens just after join returns
+        store = self.api.graph.store
+        conn = store.conn
+        for _ in range(100):
+            if len(store._connections) == 1:
+                break
+            time.sleep(0.01)
+        self.assertEqual([conn], store._connections.values())
+
+        # a term added in a transaction that is rolled back is not remembered
+        term = URIRef("http://example.org/rolled/back")
+        store._id(term, create=True)
+        store.rollback()
+        self.assertEqual(None, store._id(term))
+
+    def test_attach_directory_compact(self):
+        """the compact store answers the same queries in less memory"""
+
+        count = self.api.attach_directory(TEST_DATA, backend="compact")
+        self.assertEqual(count, len(set(self.api.graph.triples((None, None, None)))))
+
+        itemuri = "http://localhost:3000/catalog/cooee/items/1-012"
+        meta = self.api.get_item_metadata(itemuri)
+        self.assertEqual('1788', meta['alveo:metadata']['dc:created'])
+        self.assertEqual(5, len(self.api.search((('dc:created', '1788'), ))))
+        self.assertEqual(2, len(self.api.get_annotations(itemuri, {})['alveo:annotations']))
+        result = self.api.search_sparql("cooee", "select * where {?s <http://purl.org/dc/terms/isPartOf> ?o}")
+        self.assertTrue(len(result["results"]["bindings"]) > 0)
+
+        usage = compare_memory(TEST_DATA)
+        self.assertTrue(usage["compact"] < usage["memory"])
+
+    def test_compact_unload(self):
+        """the compact store forgets the terms of a collection once it is unloaded"""
+
+        self.api.attach_directory(TEST_DATA, backend="compact", lazy=True, max_collections=1)
+        store = self.api.graph.store
+        terms = len(store._ids)
+        self.api.get_item_metadata("http://localhost:3000/catalog/cooee/items/1-012")
+        self.assertTrue(len(store._ids) > terms)
+        self.assertEqual(len(set(self.api.graph.triples((None, None, None)))), len(store))
+
+        self.api.get_item_metadata("http://localhost:3000/catalog/mitcheldelbridge/items/S1219s1")
+        self.assertEqual(['mitcheldelbridge'], list(self.api.store.collections))
+        self.assertNotIn(URIRef("http://localhost:3000/catalog/cooee/items/1-012"), store._ids)
+        self.assertEqual(len(set(self.api.graph.triples((None, None, None)))), len(store))
+
+        # the ids of the forgotten terms are used again
+        size = len(store._terms)
+        self.api.get_item_metadata("http://localhost:3000/catalog/cooee/items/1-012")
+        self.assertEqual(size, len(store._terms))
+
+    def test_compact_threads(self):
+        """threads reading the compact store at once sort each array once"""
+
+        self.api.attach_directory(TEST_DATA, backend="compact")
+        store = self.api.graph.store
+        expected = set(self.api.graph.triples((None, None, None)))
+        self.api.graph.addN((s, p, o, self.api.graph) for s, p, o in list(expected)[:500])
+        errors = []
+
+        def read():
+            try:
+                self.assertEqual(expected, set(self.api.graph.triples((None, None, None))))
+                self.assertEqual(len(expected), len(store))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=read) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        self.assertEqual([], [key for key in store._unsorted if key[0] == 'spo'])
+
+    def test_shared_graph(self):
+        """a directory is only loaded once however many attach to it"""
+
+        tmpdir = copy_test_data(self, "itemlists")
+
+        self.api.attach_directory(tmpdir)
+        other = API()
+        other.attach_directory(tmpdir)
+        self.assertIs(self.api.graph, other.graph)
+
+        # a directory inside it shares the same graph
+        factory = ItemListFactory("rdf", os.path.join(tmpdir, "itemlists"))
+        self.assertIs(self.api.graph, factory.db.graph)
+        registry.release(factory.db.store)
+
+        other.detach()
+        self.assertIs(self.api.store, registry.acquire(tmpdir))
+        registry.release(self.api.store)
+        self.api.detach()
+
+        # as does one loaded before the directory holding it
+        factory = ItemListFactory("rdf", os.path.join(tmpdir, "itemlists"))
+        parsed = []
+        parse = base.parse_files
+        base.parse_files = lambda sources, *args: parsed.extend(path for path, _ in sources) or parse(sources, *args)
+        try:
+            self.api.attach_directory(tmpdir, fast=True)
+        finally:
+            base.parse_files = parse
+        self.assertIs(self.api.graph, factory.db.graph)
+        self.assertEqual([], [path for path in parsed if "itemlists" in path])
+        self.assertTrue(len(factory.db.get_item_lists()) > 0)
+        self.assertTrue(len(self.api.get_collections()) > 0)
+        self.assertIs(self.api.store, registry.acquire(os.path.join(tmpdir, "itemlists"), fast=True))
+        registry.release(self.api.store)
+        registry.release(factory.db.store)
+
+    def test_shared_graph_lazy(self):
+        """a lazy store keeps the files of the others sharing its graph"""
+
+        tmpdir = copy_test_data(self, "mitcheldelbridge", "itemlists")
+        factory = ItemListFactory("rdf", os.path.join(tmpdir, "itemlists"))
+        lists = sorted(factory.db.get_item_lists())
+        self.assertTrue(len(lists) > 0)
+
+        self.api.attach_directory(tmpdir, lazy=True, max_collections=1)
+        self.assertIs(self.api.graph, factory.db.graph)
+        self.assertEqual(['cooee', 'mitcheldelbridge'], sorted(self.api.store.collection_ids()))
+        for itemuri in ("http://localhost:3000/catalog/cooee/items/1-012",
+                        "http://localhost:3000/catalog/mitcheldelbridge/items/S1219s1"):
+            self.api.get_item_metadata(itemuri)
+        self.assertEqual(['mitcheldelbridge'], list(self.api.store.collections))
+        self.assertEqual(lists, sorted(factory.db.get_item_lists()))
+
+        # other options get a store of their own and a lazy one is
+        # not shared by the directories inside it
+        store = registry.acquire(tmpdir)
+        self.assertIsNot(self.api.store, store)
+        registry.release(store)
+        itemlists = registry.acquire(os.path.join(tmpdir, "itemlists"), lazy=True, max_collections=1)
+        self.assertIsNot(self.api.store, itemlists)
+        registry.release(itemlists)
+        self.assertEqual(lists, sorted(factory.db.get_item_lists()))
+
+        # attaching again holds on to the same store once
+        store = self.api.store
+        self.api.attach_directory(tmpdir, lazy=True, max_collections=1)
+        self.assertIs(store, self.api.store)
+        self.assertEqual([self.api._forget_collection], store.unload_hooks)
+        self.assertEqual([1], [entry[1] for entry in registry.stores.values() if entry[0] is store])
+        registry.release(factory.db.store)
 
     def test_version(self):
         """we return the right version string"""
@@ -39,6 +490,10 @@ class TestAlveolocalLoad(unittest.TestCase):
         
         self.assertEqual("V2.0", self.api.version())
 
+    def tearDown(self):
+        if hasattr(self.api, "store"):
+            self.api.detach()
+
 
 class TestAlveolocal(unittest.TestCase):
 
@@ -79,6 +534,22 @@ class TestAlveolocal(unittest.TestCase):
         self.assertEqual(dict, type(meta['metadata']))
         self.assertEqual('2004', meta['metadata']['dc:created'])
 
+    def test_get_collection_summaries(self):
+        """we can get a summary of every collection"""
+
+        summaries = self.api.get_collection_summaries()
+
+        self.assertEqual(2, len(summaries))
+        cooee = [summary for summary in summaries if summary['collection_name'] == 'COOEE'][0]
+        self.assertEqual('http://localhost:3000/catalog/cooee', cooee['collection_url'])
+        self.assertEqual('2004', cooee['metadata']['dc:created'])
+        self.assertEqual(10, cooee['num_items'])
+        self.assertEqual(20, cooee['num_documents'])
+        self.assertEqual(234, cooee['num_annotations'])
+
+        # the summary is kept while the collection is unchanged
+        self.assertIs(cooee, self.api.get_collection_summary('http://localhost:3000/catalog/cooee'))
+
     def test_get_item_metadata(self):
         """we can get the metadata for an item"""
 
@@ -104,6 +575,44 @@ class TestAlveolocal(unittest.TestCase):
             self.assertTrue(doc[u'alveo:url'].startswith('http'), "expected url '%s' to start with http" % doc[u'alveo:url'])
         
     
+    def test_get_items_metadata_json(self):
+        """we can get the metadata of several items at once"""
+
+        items = ["http://localhost:3000/catalog/cooee/items/1-012",
+                 "http://localhost:3000/catalog/cooee/items/missing",
+                 "http://example.org/foo"]
+
+        result = [json.loads(meta) for meta in self.api.get_items_metadata_json(items)]
+
+        self.assertEqual(3, len(result))
+        self.assertEqual(json.loads(self.api.get_item_metadata_json(items[0])), result[0])
+        self.assertEqual(items[1], result[1]['alveo:catalog_url'])
+        self.assertIn('error', result[1])
+        self.assertIn('error', result[2])
+
+    def test_prefix_map(self):
+        """qnames and URIs are mapped according to the graph prefixes"""
+
+        prefixes = self.api.store.prefix_map()
+        created = URIRef("http://purl.org/dc/terms/created")
+        other = URIRef("http://example.org/terms/thing")
+
+        self.assertEqual('dc:created', prefixes.qname(created))
+        self.assertEqual(created, prefixes.uri('dc:created'))
+        self.assertEqual('<http://example.org/terms/thing>', prefixes.qname(other))
+        self.assertEqual('ex:thing', prefixes.uri('ex:thing'))
+
+        # a prefix bound through the store is seen without a refresh
+        self.api.store.bind('ex', "http://example.org/terms/")
+        prefixes = self.api.store.prefix_map()
+        self.assertEqual('ex:thing', prefixes.qname(other))
+        self.assertEqual(other, prefixes.uri('ex:thing'))
+
+        # one bound on the graph itself once the map is refreshed
+        self.api.graph.bind('ex2', "http://example.org/other/")
+        prefixes.refresh()
+        self.assertEqual(URIRef("http://example.org/other/thing"), prefixes.uri('ex2:thing'))
+
     def test_get_primary_text(self):
         """we can return the text of the primary document"""
 
@@ -122,6 +631,321 @@ class TestAlveolocal(unittest.TestCase):
         
         
 
+    def test_get_primary_text_path(self):
+        """we can find the file holding the primary text"""
+
+        itemuri = "http://localhost:3000/catalog/cooee/items/1-012"
+
+        path = self.api.get_primary_text_path(itemuri)
+
+        self.assertEqual(os.path.join(TEST_DATA, "cooee", "1-012-plain.txt"), path)
+        self.assertEqual(path, self.api.get_document_path("cooee", "1-012-plain.txt"))
+        self.assertEqual(None, self.api.get_primary_text_path("http://example.org/foo"))
+
+    def test_document_index(self):
+        """documents are found when the directory is attached"""
+
+        itemuri = "http://localhost:3000/catalog/cooee/items/1-012"
+        path = os.path.join(TEST_DATA, "cooee", "1-012-plain.txt")
+
+        self.assertEqual((path, os.path.getsize(path), os.path.getmtime(path)),
+                         self.api.get_display_document(itemuri))
+
+        # the audio files of mitcheldelbridge are not in the test data
+        missing = self.api.missing_documents()
+        self.assertTrue(len(missing) > 0)
+        for doc, path in missing:
+            self.assertTrue(path.endswith(".wav"))
+            self.assertFalse(os.path.exists(path))
+
+    def test_text_cache(self):
+        """texts are cached up to a number of bytes"""
+
+        self.api.get_primary_text("http://localhost:3000/catalog/cooee/items/1-012")
+        self.api.get_primary_text("http://localhost:3000/catalog/cooee/items/1-012")
+        self.assertEqual(self.api.get_document("cooee", "1-012-plain.txt").decode("utf-8"),
+                         self.api.get_primary_text("http://localhost:3000/catalog/cooee/items/1-012"))
+
+        stats = self.api.text_cache.stats()
+        self.assertEqual(2, stats['hits'])
+        self.assertEqual(2, stats['misses'])
+        self.assertEqual(2, stats['entries'])
+
+        # a cache too small for both keeps only the latest
+        self.api.text_cache.max_bytes = stats['bytes'] - 1
+        self.api.get_document("cooee", "1-013-plain.txt")
+        stats = self.api.text_cache.stats()
+        self.assertTrue(stats['evictions'] > 0)
+        self.assertTrue(stats['bytes'] <= stats['max_bytes'])
+
+    def test_compressed_documents(self):
+        """documents compressed in place are still found and read"""
+
+        itemuri = "http://localhost:3000/catalog/cooee/items/1-012"
+        text = self.api.get_primary_text(itemuri)
+        document = self.api.get_document("cooee", "1-013-plain.txt")
+
+        tmpdir = copy_test_data(self)
+        compressed = compress.compress_directory(os.path.join(tmpdir, "cooee"))
+        self.assertEqual(20, len(compressed))
+        self.assertFalse(os.path.exists(os.path.join(tmpdir, "cooee", "1-012-plain.txt")))
+
+        api = API()
+        api.attach_directory(tmpdir)
+        self.assertEqual([], api.missing_documents())
+        self.assertEqual(text, api.get_primary_text(itemuri))
+        self.assertEqual(document, api.get_document("cooee", "1-013-plain.txt"))
+        self.assertEqual(os.path.join(tmpdir, "cooee", "1-012-plain.txt"),
+                         api.get_primary_text_path(itemuri))
+
+    def test_compressed_documents_kept(self):
+        """both files of a document compressed with keep are recorded, the uncompressed first"""
+
+        tmpdir = copy_test_data(self)
+        compress.compress_directory(os.path.join(tmpdir, "cooee"), keep=True)
+
+        api = API()
+        api.attach_directory(tmpdir)
+        path = os.path.join(tmpdir, "cooee", "1-012-plain.txt")
+        found = api.get_document_files(path)
+        self.assertEqual([(path, None), (path + ".gz", "gzip")], [f[:2] for f in found])
+        self.assertEqual(found[0], api.get_document_file(path))
+        self.assertEqual(os.path.getsize(path + ".gz"), found[1][2])
+        self.assertEqual([], api.get_document_files(os.path.join(tmpdir, "cooee", "nothing.txt")))
+        api.detach()
+
+    def test_documents_added_and_deleted(self):
+        """display documents deleted or added after attaching are noticed on reload"""
+
+        itemuri = "http://localhost:3000/catalog/cooee/items/1-012"
+        tmpdir = copy_test_data(self)
+        path = os.path.join(tmpdir, "cooee", "1-012-plain.txt")
+        os.rename(path, path + ".away")
+
+        api = API()
+        api.attach_directory(tmpdir)
+        self.assertEqual(None, api.get_primary_text_path(itemuri))
+        self.assertIn(path, [p for _, p in api.missing_documents()])
+
+        # the files are only looked for again on reload
+        os.rename(path + ".away", path)
+        self.assertEqual(None, api.get_primary_text_path(itemuri))
+        api.reload()
+        self.assertEqual(path, api.get_primary_text_path(itemuri))
+        self.assertNotIn(path, [p for _, p in api.missing_documents()])
+        self.assertEqual(api.get_document("cooee", "1-012-plain.txt").decode("utf-8"), api.get_primary_text(itemuri))
+
+        # a deleted file is only noticed on reload too
+        text = api.get_primary_text(itemuri)
+        os.remove(path)
+        self.assertEqual(text, api.get_primary_text(itemuri))
+        api.reload()
+        self.assertEqual(None, api.get_primary_text(itemuri))
+        self.assertEqual(None, api.get_primary_text_path(itemuri))
+        self.assertRaises(IOError, api.get_document, "cooee", "1-012-plain.txt")
+        api.detach()
+
+    def test_get_text_slices(self):
+        """the text under annotations and between offsets"""
+
+        itemuri = "http://localhost:3000/catalog/cooee/items/1-012"
+        text = self.api.get_primary_text(itemuri)
+
+        slices = self.api.get_text_slices(itemuri, ["66", "http://localhost:3000/catalog/cooee/annotation/67", "1"],
+                                          [(6, 19), (2390, 3000)])
+        self.assertEqual(5, len(slices))
+        self.assertEqual("http://localhost:3000/catalog/cooee/annotation/66", slices[0]['@id'])
+        self.assertEqual((1831, 1831, u""), (slices[0]['start'], slices[0]['end'], slices[0]['text']))
+        self.assertEqual("http://ns.ausnc.org.au/schemas/annotation/cooee/pageno", slices[1]['type'])
+        self.assertIn('error', slices[2])
+        self.assertEqual(text[6:19], slices[3]['text'])
+        self.assertEqual(text[2390:], slices[4]['text'])
+
+        self.assertEqual(None, self.api.get_text_slices("http://localhost:3000/catalog/cooee/items/nothere", [], []))
+
+    def test_annotation_index(self):
+        """annotations are served from an index that add_annotation updates"""
+
+        itemuri = "http://localhost:3000/catalog/cooee/items/1-012"
+        index = self.api._annotation_index("cooee")
+        annotations = index.get(itemuri)
+        self.assertEqual(2, len(annotations))
+        self.assertEqual([1831, 2282], [v[4] for v in annotations.values(annotations.select())])
+        self.assertEqual(0, len(index.get("http://localhost:3000/catalog/cooee/items/nothere")))
+
+        ann = self.api.get_annotations("http://localhost:3000/catalog/mitcheldelbridge/items/S1219s1", {})
+        self.assertTrue(len(ann['alveo:annotations']) > 0)
+        for a in ann['alveo:annotations']:
+            self.assertEqual('dada:SecondAnnotation', a['@type'])
+            # the offsets are as they are in the graph
+            region = self.api.graph.value(URIRef(a['@id']), DADA.targets)
+            start = self.api.graph.value(region, DADA.start).toPython()
+            self.assertEqual((type(start), start), (type(a['start']), a['start']))
+
+        # a region of more than one type with a decimal offset
+        annid = URIRef(ann['alveo:annotations'][0]['@id'])
+        region = self.api.graph.value(annid, DADA.targets)
+        start = self.api.graph.value(region, DADA.start)
+        added = [(region, RDF.type, URIRef("http://example.org/Region")),
+                 (region, DADA.start, Literal(Decimal("0.1")))]
+        self.api.graph.remove((region, DADA.start, start))
+        for triple in added:
+            self.api.graph.add(triple)
+        try:
+            annotations = AnnotationIndex(self.api.graph, "http://localhost:3000/catalog/mitcheldelbridge")
+        finally:
+            for triple in added:
+                self.api.graph.remove(triple)
+            self.api.graph.add((region, DADA.start, start))
+        item = annotations.get("http://localhost:3000/catalog/mitcheldelbridge/items/S1219s1")
+        self.assertEqual(set([SECONDS]), set(item.kind))
+        values = [v for v in item.values(item.select()) if v[0] == unicode(annid)][0]
+        self.assertEqual(Decimal("0.1"), values[4])
+
+        tmpdir = copy_test_data(self)
+        api = API()
+        api.attach_directory(tmpdir)
+        index = api._annotation_index("cooee")
+
+        data = {"metadata": {"alveo:annotates": itemuri,
+                             "creator": "Steve.Cassidy@mq.edu.au",
+                             "generatedBy": "test",
+                             "generatedAtTime": "2015-03-01T12:00:00"},
+                "alveo:annotations": [{"@type": "dada:TextAnnotation", "label": "hello",
+                                       "type": "http://example.org/greeting", "start": 0, "end": 5}]}
+        api.add_annotation(collection_uri="http://localhost:3000/catalog/cooee", data=data, filename="extra")
+
+        self.assertIs(index, api._annotation_index("cooee"))
+        ann = api.get_annotations(itemuri, {"type": "http://example.org/greeting"})
+        self.assertEqual(1, len(ann['alveo:annotations']))
+        self.assertEqual((0, 5, "hello"), (ann['alveo:annotations'][0]['start'],
+                                           ann['alveo:annotations'][0]['end'],
+                                           ann['alveo:annotations'][0]['label']))
+        self.assertEqual(3, len(api.get_annotations(itemuri, {})['alveo:annotations']))
+        types = api.get_annotation_types(itemuri, counts=True)
+        self.assertEqual(1, types['annotation_type_counts']["http://example.org/greeting"])
+        types = api.get_collection_annotation_types("http://localhost:3000/catalog/cooee", counts=True)
+        self.assertEqual(1, types['annotation_type_counts']["http://example.org/greeting"])
+        api.detach()
+
+    def test_get_annotation_types(self):
+        """the types of an item's or collection's annotations, with counts if asked for"""
+
+        itemuri = "http://localhost:3000/catalog/cooee/items/1-012"
+        types = self.api.get_annotation_types(itemuri)
+        self.assertEqual(set(["http://ns.ausnc.org.au/schemas/annotation/cooee/pageno",
+                              "http://ns.ausnc.org.au/schemas/annotation/art/correction"]),
+                         set(types['annotation_types']))
+        self.assertNotIn('annotation_type_counts', types)
+
+        types = self.api.get_annotation_types(itemuri, counts=True)
+        self.assertEqual({"http://ns.ausnc.org.au/schemas/annotation/cooee/pageno": 1,
+                          "http://ns.ausnc.org.au/schemas/annotation/art/correction": 1},
+                         types['annotation_type_counts'])
+
+        collection = self.api.get_collection_annotation_types("http://localhost:3000/catalog/cooee", counts=True)
+        self.assertEqual("http://localhost:3000/catalog/cooee", collection['collection_url'])
+        self.assertTrue(set(types['annotation_types']) <= set(collection['annotation_types']))
+        self.assertEqual(234, sum(collection['annotation_type_counts'].values()))
+
+    def test_add_annotations(self):
+        """many annotation documents are added a batch at a time"""
+
+        itemuri = "http://localhost:3000/catalog/cooee/items/1-012"
+        tmpdir = copy_test_data(self)
+        api = API()
+        api.attach_directory(tmpdir)
+        api.annotation_batch_size = 5
+        index = api._annotation_index("cooee")
+        inserted = []
+        insert = api.store.insert
+        api.store.insert = lambda path, triples: inserted.append(len(triples)) or insert(path, triples)
+
+        def documents():
+            for n in range(4):
+                yield {"metadata": {"alveo:annotates": itemuri,
+                                    "creator": "Steve.Cassidy@mq.edu.au",
+                                    "generatedBy": "test",
+                                    "generatedAtTime": "2015-03-01T12:00:00"},
+                       "alveo:annotations": [{"@type": "dada:TextAnnotation", "label": u"wörd %d" % i,
+                                              "type": "http://example.org/word", "start": i, "end": i + 1}
+                                             for i in range(n * 3, n * 3 + 3)]}
+
+        result = api.add_annotations("http://localhost:3000/catalog/cooee", documents(), "bulk")
+        self.assertEqual(4, result['documents'])
+        self.assertEqual(12, result['annotations'])
+        # 6, 6 then nothing left
+        self.assertEqual(2, len(inserted))
+
+        self.assertIs(index, api._annotation_index("cooee"))
+        words = api.get_annotations(itemuri, {"type": "http://example.org/word"})['alveo:annotations']
+        self.assertEqual(range(12), [a['start'] for a in words])
+        self.assertEqual(u"wörd 11", words[-1]['label'])
+        api.detach()
+
+        # the file holds them all
+        api = API()
+        api.attach_directory(tmpdir)
+        self.assertTrue(os.path.exists(os.path.join(tmpdir, "cooee", "bulk.n3")))
+        self.assertEqual(words, api.get_annotations(itemuri, {"type": "http://example.org/word"})['alveo:annotations'])
+
+        # the ids are consecutive and carry on from the saved counter after a restart
+        numbers = [int(a['@id'].rsplit("/", 1)[1]) for a in words]
+        self.assertEqual(range(numbers[0], numbers[0] + 12), numbers)
+
+        # the uploads are found by the email of the user that made them
+        found = api.get_annotations(itemuri, {"user": "Steve.Cassidy@mq.edu.au", "type": "http://example.org/word"})
+        self.assertEqual(words, found['alveo:annotations'])
+        self.assertEqual([], api.get_annotations(itemuri, {"user": "someone@example.org"})['alveo:annotations'])
+        self.assertTrue(os.path.exists(os.path.join(tmpdir, "cooee", ".annotation_ids")))
+        self.assertEqual("http://localhost:3000/catalog/cooee/annotation/%d" % (numbers[-1] + 1),
+                         api.generate_annotation_id("http://localhost:3000/catalog/cooee"))
+
+        # a bad document stops the upload, those before it in the
+        # batch being built are still added and they are all reported
+        api.annotation_batch_size = 100
+        bad = list(documents())
+        del bad[2]["alveo:annotations"][1]["start"]
+        result = api.add_annotations("http://localhost:3000/catalog/cooee", bad, "partial")
+        self.assertEqual(("partial", 2, 6, 2), (result['filename'], result['documents'],
+                                                result['annotations'], result['failed_document']))
+        self.assertIn("start", result['error'])
+        self.assertNotIn('success', result)
+        self.assertEqual(18, len(api.get_annotations(itemuri, {"type": "http://example.org/word"})['alveo:annotations']))
+        api.detach()
+
+    def test_get_annotations_overlapping(self):
+        """start and end keep the annotations overlapping a range and combine with type"""
+
+        itemuri = "http://localhost:3000/catalog/mitcheldelbridge/items/S1219s1"
+        everything = self.api.get_annotations(itemuri, {})['alveo:annotations']
+        for filters in [{"start": 0.5, "end": 1.0}, {"start": "1.2"}, {"end": 0.7},
+                        {"start": 0.5, "end": 1.0, "type": "http://ns.ausnc.org.au/schemas/annotation/maus/phonetic"}]:
+            found = self.api.get_annotations(itemuri, filters)['alveo:annotations']
+            expected = [a for a in everything
+                        if a['start'] < float(filters.get("end", "inf")) and a['end'] > float(filters.get("start", "-inf"))
+                        and a['type'] == filters.get("type", a['type'])]
+            self.assertTrue(0 < len(found) < len(everything), filters)
+            self.assertEqual(sorted(a['@id'] for a in expected), sorted(a['@id'] for a in found), filters)
+
+        # annotations of no length count when they fall inside the range
+        itemuri = "http://localhost:3000/catalog/cooee/items/1-012"
+        self.assertEqual(1, len(self.api.get_annotations(itemuri, {"start": 1831, "end": 2000})['alveo:annotations']))
+        self.assertEqual(0, len(self.api.get_annotations(itemuri, {"start": 1832, "end": 2282})['alveo:annotations']))
+        self.assertEqual(0, len(self.api.get_annotations(itemuri, {"start": 0, "end": 2000, "type": "cooeea:pageno"})['alveo:annotations']))
+
+    def test_iter_annotations(self):
+        """annotations can be had a page at a time"""
+
+        itemuri = "http://localhost:3000/catalog/mitcheldelbridge/items/S1219s1"
+        everything = self.api.get_annotations(itemuri, {})['alveo:annotations']
+
+        total, anns = self.api.iter_annotations(itemuri, {}, 3, 4)
+        self.assertEqual(len(everything), total)
+        self.assertEqual(everything[3:7], list(anns))
+        self.assertEqual(everything[10:], self.api.get_annotations(itemuri, {}, offset=10)['alveo:annotations'])
+        self.assertEqual([], self.api.get_annotations(itemuri, {}, offset=total)['alveo:annotations'])
+
     def test_get_annotations(self):
         """we can get the annotations for an item"""
 
@@ -145,6 +969,28 @@ class TestAlveolocal(unittest.TestCase):
         
         pass
 
+    def test_queries(self):
+        """queries are prepared once and their runs counted"""
+
+        itemuri = "http://localhost:3000/catalog/cooee/items/1-012"
+        before = self.api.queries.stats().get('collection_of_item', {'executions': 0, 'seconds': 0.0})
+
+        self.assertEqual(["http://localhost:3000/catalog/cooee"], self.api._get_uri("collection", "item", itemuri))
+        self.assertEqual(["http://localhost:3000/catalog/cooee"], self.api._get_uri("collection", "item", itemuri))
+        self.assertEqual(2, len(self.api._get_uri("annotation", "item", itemuri)))
+        self.assertEqual([itemuri], self.api._get_uri("item", "annotation",
+                                                      "http://localhost:3000/catalog/cooee/annotation/66"))
+        self.assertEqual([], self.api._get_uri("item", "nothing", itemuri))
+
+        prepared = self.api.queries.get('collection_of_item')
+        self.assertIs(prepared, self.api.queries.get('collection_of_item'))
+        stats = self.api.queries.stats()
+        self.assertEqual(before['executions'] + 2, stats['collection_of_item']['executions'])
+        self.assertTrue(stats['collection_of_item']['seconds'] > before['seconds'])
+
+        self.api.search((('dc:created', '1788'), ))
+        self.assertIn('search', self.api.queries.stats())
+
     def test_search(self):
         """we can search for items"""
         
@@ -178,7 +1024,7 @@ class TestAlveolocal(unittest.TestCase):
                 self.assertIn(var, binding, "Expected all bindings to include items in vars")
         
     def tearDown(self):
-        pass
+        self.api.detach()
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
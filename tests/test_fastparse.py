@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_fastparse
+----------------------------------
+
+Tests for the `fastparse` module.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from alveolocal import API
+from alveolocal.fastparse import parse, Unsupported
+from alveolocal.loader import rdf_files
+from rdflib import Graph, Literal
+from rdflib.namespace import XSD
+
+
+TEST_DATA = os.path.join(os.path.dirname(__file__), "data")
+
+
+class TestFastParse(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def write(self, text):
+        path = os.path.join(self.tmpdir, "test.rdf")
+        with open(path, 'w') as fp:
+            fp.write(text)
+        return path
+
+    def test_same_triples(self):
+        """the fast parser finds the same triples as rdflib"""
+
+        for path, format in rdf_files(TEST_DATA):
+            if format == 'turtle':
+                namespaces, triples = parse(path)
+                self.assertEqual(set(Graph().parse(path, format=format)), set(triples), path)
+
+    def test_literals(self):
+        """escapes, languages, datatypes and numbers"""
+
+        path = self.write('@prefix ex: <http://example.org/> .\n'
+                          '@prefix xsd: <http://www.w3.org/2001/XMLSchema#> .\n'
+                          'ex:a ex:b "say \\"hi\\"\\n"@en, 12, -1.5, 2e3, true ; # comment\n'
+                          '    ex:c "1"^^xsd:int, "x"^^<http://example.org/t> ;\n'
+                          '    .\n')
+        namespaces, triples = parse(path)
+        self.assertIn(('ex', 'http://example.org/'), namespaces)
+        self.assertEqual(set(Graph().parse(path, format='turtle')), set(triples))
+        self.assertIn(Literal("12", datatype=XSD.integer), [o for s, p, o in triples])
+
+    def test_unsupported(self):
+        """blank nodes and relative IRIs are left to rdflib"""
+
+        for text in ('<http://example.org/a> <http://example.org/b> [ <http://example.org/c> "d" ] .\n',
+                     '<a> <http://example.org/b> "c" .\n',
+                     'ex:a ex:b ex:c .\n',
+                     '<http://example.org/a> <http://example.org/b> """c""" .\n',
+                     '<http://example.org/a> <http://example.org/b> "c"'):
+            self.assertRaises(Unsupported, parse, self.write(text))
+
+    def test_attach_directory_fast(self):
+        """attaching with the fast parser loads the same graph"""
+
+        api = API()
+        count = api.attach_directory(TEST_DATA, backend="compact")
+        api.detach()
+
+        api.attach_directory(TEST_DATA, backend="compact", fast=True)
+        try:
+            self.assertEqual(count, len(api.graph))
+            meta = api.get_collection('http://localhost:3000/catalog/cooee')
+            self.assertEqual('2004', meta['metadata']['dc:created'])
+        finally:
+            api.detach()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_ids
+----------------------------------
+
+Tests for the `ids` module.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from alveolocal.ids import IdAllocator
+
+
+class TestIds(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, ".annotation_ids")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_ranges(self):
+        """ranges follow on from the highest number in use and from each other"""
+
+        found = []
+        allocator = IdAllocator(self.path, lambda: found.append(1) or 41)
+        self.assertEqual(42, allocator.allocate())
+        self.assertEqual(43, allocator.allocate(10))
+        self.assertEqual(53, allocator.allocate(0))
+        self.assertEqual(53, allocator.allocate())
+
+        # kept over a restart, the highest number is only found once
+        allocator = IdAllocator(self.path, lambda: found.append(1) or 41)
+        self.assertEqual(54, allocator.allocate(2))
+        self.assertEqual(1, len(found))
+
+    def test_shared(self):
+        """threads using one counter file never get the same number"""
+
+        # two allocators lock the file as two processes would
+        allocators = [IdAllocator(self.path, lambda: 0) for _ in range(2)]
+        numbers = []
+
+        def allocate(allocator):
+            for _ in range(50):
+                first = allocator.allocate(3)
+                numbers.extend(range(first, first + 3))
+
+        threads = [threading.Thread(target=allocate, args=(allocators[i % 2],)) for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(range(1, 901), sorted(numbers))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_offsets
+----------------------------------
+
+Tests for the `offsets` module.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from io import BytesIO
+
+from alveolocal import compress
+from alveolocal.offsets import OffsetIndex, OffsetIndexes
+
+
+# one, two, three and four byte characters
+TEXT = u"Ein Bär, ein Löwe € und \U0001f600.\r\n" * 50
+
+
+class TestOffsets(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_character_offsets(self):
+        """slices are by character whatever the width of the characters"""
+
+        fp = BytesIO(TEXT.encode('utf-8'))
+        for step in (1, 7, 1024):
+            index = OffsetIndex(fp, step)
+            self.assertEqual(len(TEXT), index.length)
+            for start, end in [(0, 3), (5, 6), (17, 40), (100, 333), (len(TEXT) - 4, len(TEXT) + 10), (50, 20)]:
+                self.assertEqual(TEXT[start:end], index.read(fp, start, end), (step, start, end))
+            fp.seek(0)
+
+    def test_end_of_text(self):
+        """spans at or past the end of the text are empty"""
+
+        fp = BytesIO(TEXT.encode('utf-8'))
+        # steps that divide the length as well as those that do not
+        for step in (1, 7, len(TEXT) // 50, len(TEXT)):
+            index = OffsetIndex(fp, step)
+            for start, end in [(len(TEXT), len(TEXT)), (len(TEXT) + 5, len(TEXT) + 10), (len(TEXT) - 3, len(TEXT) + 10)]:
+                self.assertEqual(TEXT[start:end], index.read(fp, start, end), (step, start, end))
+            fp.seek(0)
+
+    def test_compressed(self):
+        """slices of a compressed file, read out of order"""
+
+        path = os.path.join(self.tmpdir, "text.txt")
+        with open(path, 'wb') as fp:
+            fp.write(TEXT.encode('utf-8'))
+        compress.compress_file(path)
+
+        spans = [(300, 310), (2, 9), (1000, 1200)]
+        indexes = OffsetIndexes(step=16)
+        self.assertEqual([TEXT[s:e] for s, e in spans], indexes.read(path, spans))
+        self.assertEqual(1, len(indexes.indexes))
+        self.assertRaises(IOError, indexes.read, os.path.join(self.tmpdir, "missing.txt"), spans)
+
+
+if __name__ == '__main__':
+    unittest.main()
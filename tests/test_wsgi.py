@@ -169,6 +169,17 @@ class TestWSGI(unittest.TestCase):
         for key in c1:
             self.assertIn(key, h1, "Expected local output to include %s" % key)
             
+    def test_batch_metadata(self):
+        items = ["http://localhost:3000/catalog/cooee/items/1-010",
+                 "http://localhost:3000/catalog/cooee/items/1-011",
+                 "http://localhost:3000/catalog/cooee/items/missing"]
+        hit = self.make_request("local", "post", "/catalog/metadata", {"items": items}).json()
+
+        self.assertEqual(3, len(hit))
+        single = self.make_request("local", "get", "/catalog/cooee/1-010").json()
+        self.assertEqual(single, hit[0], "Expected the same output as the metadata route")
+        self.assertIn("error", hit[2], "Expected an error for a missing item")
+
     def test_primary_text(self):
         url = "/catalog/cooee/1-010/primary_text"
         hit = self.make_request("local", "get", url).text[31:51]
@@ -183,6 +194,60 @@ class TestWSGI(unittest.TestCase):
         
         self.assertEqual(hit, compare, "Expected the same output")
         
+    def test_primary_text_range(self):
+        url = "/catalog/cooee/1-012/primary_text"
+        whole = self.make_request("local", "get", url)
+        self.assertEqual(str(len(whole.content)), whole.headers["Content-Length"])
+
+        part = requests.get(self.local_prefix + url, headers={"Range": "bytes=6-19"})
+        self.assertEqual(206, part.status_code)
+        self.assertEqual(whole.content[6:20], part.content)
+
+    def test_conditional_get(self):
+        for url in ["/catalog", "/catalog/cooee/1-010", "/catalog/cooee/1-010/annotations",
+                    "/item_lists", "/catalog/cooee/1-010/primary_text"]:
+            first = self.make_request("local", "get", url)
+            self.assertIn("ETag", first.headers, "Expected an ETag for %s" % url)
+            self.assertIn("Accept", first.headers["Vary"])
+
+            headers = {"Accept": "application/json", "If-None-Match": first.headers["ETag"]}
+            again = requests.get(self.local_prefix + url, headers=headers)
+            self.assertEqual(304, again.status_code, "Expected 304 for %s" % url)
+
+            headers = {"Accept": "application/json", "If-Modified-Since": first.headers["Last-Modified"]}
+            again = requests.get(self.local_prefix + url, headers=headers)
+            self.assertEqual(304, again.status_code, "Expected 304 for %s" % url)
+
+    def test_annotation_pages(self):
+        url = "/catalog/mitcheldelbridge/S1219s1/annotations"
+        everything = self.make_request("local", "get", url).json()["alveo:annotations"]
+
+        page = self.make_request("local", "get", url, {"limit": 4, "offset": 2})
+        self.assertEqual(everything[2:6], page.json()["alveo:annotations"])
+        self.assertIn("offset=6", page.headers["Link"])
+
+        lines = requests.get(self.local_prefix + url, params={"limit": 4},
+                             headers={"Accept": "application/x-ndjson"}).text.splitlines()
+        self.assertEqual(everything[:4], [json.loads(line) for line in lines])
+
+        bad = self.make_request("local", "get", url, {"limit": "x"})
+        self.assertEqual(400, bad.status_code)
+
+    def test_annotation_type_counts(self):
+        hit = self.make_request("local", "get", "/catalog/cooee/1-012/annotations/types", {"counts": "true"}).json()
+        self.assertEqual(sorted(hit["annotation_types"]), sorted(hit["annotation_type_counts"]))
+
+        hit = self.make_request("local", "get", "/catalog/cooee/annotations/types", {"counts": "1"}).json()
+        self.assertEqual("http://localhost:3000/catalog/cooee", hit["collection_url"])
+        self.assertEqual(234, sum(hit["annotation_type_counts"].values()))
+
+    def test_stats(self):
+        self.make_request("local", "get", "/catalog/cooee/1-010/document/1-010-plain.txt")
+        hit = self.make_request("local", "get", "/stats").json()
+
+        for key in ["hits", "misses", "evictions", "entries", "bytes", "max_bytes"]:
+            self.assertIn(key, hit["text_cache"], "Expected text cache stats to include %s" % key)
+
     def test_annotations(self):
         url = "/catalog/cooee/1-012/annotations"
         hit = self.make_request("local", "get", url).json()
@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
 
-from bottle import Bottle, request, abort, response, jinja2_view as view, static_file
+from bottle import Bottle, request, abort, response, jinja2_view as view, static_file, \
+    HTTPResponse, http_date, parse_date, parse_range_header
 from alveolocal import API
+import itertools
 import json
 import os
+import time
+from urllib import urlencode
 from alveolocal.itemlist import ItemListFactory
 
 
@@ -11,6 +15,109 @@ application = Bottle()
 alveo = API()
 TEST_DATA = os.path.join(os.path.dirname(__file__), "..", "tests", "data")
 factory = ItemListFactory("rdf", os.path.join(TEST_DATA, "itemlists"))
+# part of every ETag derived from a version counter, since the counters start again on restart
+STARTED = "%x" % int(time.time())
+
+def wants_json():
+    return 'Accept' in request.headers and request.headers['Accept'] == "application/json"
+
+def wants_raw():
+    """True if the client wants the text itself rather than an HTML page"""
+
+    return wants_json() or 'Range' in request.headers
+
+def accepts_encoding(encoding):
+    """True if the client accepts responses with this Content-Encoding"""
+
+    for part in request.headers.get('Accept-Encoding', '').split(","):
+        name, _, params = part.partition(";")
+        if name.strip() == encoding:
+            params = params.replace(" ", "")
+            try:
+                return not params.startswith("q=") or float(params[2:]) > 0
+            except ValueError:
+                return False
+    return False
+
+def check_modified(tag, mtime, variant=None, vary='Accept'):
+    """Send an ETag made from tag and a Last-Modified of mtime and
+    raise a 304 response if the client's copy is still current,
+    so that none of the work of building the response is done.
+    variant names the representation sent, by default json or html
+    according to the Accept header. Returns the validator headers"""
+
+    if variant is None:
+        variant = "json" if wants_json() else "html"
+    etag = '"%s-%s"' % (tag, variant)
+    headers = {'ETag': etag, 'Last-Modified': http_date(mtime), 'Vary': vary}
+    for name, value in headers.items():
+        response.set_header(name, value)
+
+    if 'If-None-Match' in request.headers:
+        tags = [t.strip() for t in request.headers['If-None-Match'].split(",")]
+        current = '*' in tags or etag in tags or 'W/' + etag in tags
+    elif 'If-Modified-Since' in request.headers:
+        since = parse_date(request.headers['If-Modified-Since'].split(";")[0].strip())
+        current = since is not None and since >= int(mtime)
+    else:
+        current = False
+
+    if current:
+        raise HTTPResponse(status=304, headers=headers)
+    return headers
+
+def check_graph(uri=None, variant=None):
+    """check_modified for a response built from the triples of the
+    collection uri belongs to, or from all triples if uri is None"""
+
+    version, mtime = alveo.get_version(uri)
+    return check_modified("%s.%d" % (STARTED, version), mtime, variant)
+
+def check_collection(collection_id):
+    """abort with 404 if there is no collection with this id"""
+
+    if not alveo.has_collection(collection_id):
+        abort(404, "No such collection")
+
+def check_item_lists():
+    """check_modified for a response built from the item lists"""
+
+    return check_modified("%s.i%d" % (STARTED, factory.version), factory.modified)
+
+def find_document(path):
+    """Return the files holding the document at path found when its
+    collection was indexed, as from compress.locate_all. Aborts with
+    404 if there were none or path is None"""
+
+    found = [] if path is None else alveo.get_document_files(path)
+    if not found:
+        abort(404, "File does not exist.")
+    return found
+
+def send_encoding(found):
+    """Return (filename, encoding, size, mtime) of the file to send
+    for a document found by find_document, where encoding is the
+    Content-Encoding to send it with, None to send the document
+    uncompressed. A compressed file is only sent as it is when the
+    client wants the text, accepts its encoding and has not asked
+    for a Range, which is of the uncompressed bytes"""
+
+    if wants_raw() and 'Range' not in request.headers:
+        for variant in found:
+            if variant[1] is not None and accepts_encoding(variant[1]):
+                return variant
+    return found[0][:1] + (None, ) + found[0][2:]
+
+def check_file(found):
+    """check_modified for a response built from a document found
+    by find_document"""
+
+    filename, encoding, size, mtime = send_encoding(found)
+    variant = "text" if wants_raw() else "html"
+    if encoding is not None:
+        variant += "-" + encoding
+    return check_modified("%d.%d" % (mtime, size), mtime,
+                          variant, 'Accept, Accept-Encoding')
 
 @application.get('/static/<path:path>')
 def static_files(path):
@@ -19,12 +126,12 @@ def static_files(path):
 @application.get('/')
 @view('home')
 def home():
-    temp_col = alveo.get_collections()
+    summaries = alveo.get_collection_summaries()
     collections = {}
-    for collection in temp_col:
-        collections[alveo.get_collection(collection)['collection_name']] = collection
+    for summary in summaries:
+        collections[summary['collection_name']] = summary['collection_url']
     itemlists = factory.get_item_lists()
-    return {'collections':collections, 'itemlists':itemlists}
+    return {'collections':collections, 'summaries':summaries, 'itemlists':itemlists}
     
 @application.get('/version')
 @view('version')
@@ -41,9 +148,11 @@ def version():
 @application.get('/catalog')
 @view('catalog')
 def catalog():
-    coll =  alveo.get_collections()
-    output = {'num_collections': len(coll),
-            'collections': coll}
+    check_graph()
+    summaries = alveo.get_collection_summaries()
+    output = {'num_collections': len(summaries),
+            'collections': [summary['collection_url'] for summary in summaries],
+            'summaries': summaries}
     if 'Accept' in request.headers and request.headers['Accept'] == "application/json":
         response.content_type = 'application/json'
         output = json.dumps(output)
@@ -52,6 +161,7 @@ def catalog():
 @application.get('/catalog/<collection_id>')
 @view('collection')
 def collection(collection_id):
+    check_graph(request.url)
     output = alveo.get_collection(request.url)
     if 'Accept' in request.headers and request.headers['Accept'] == "application/json":
         response.content_type = 'application/json'
@@ -61,6 +171,7 @@ def collection(collection_id):
 @application.get('/item_lists')
 @view('itemlists')
 def itemlists():
+    check_item_lists()
     output = factory.get_item_lists()
     if 'Accept' in request.headers and request.headers['Accept'] == "application/json":
         response.content_type = 'application/json'
@@ -70,6 +181,7 @@ def itemlists():
 @application.get('/item_lists/<itemlist_id>')
 @view('itemlist')
 def itemlist(itemlist_id):
+    check_item_lists()
     output = factory.get_item_list(request.url)
     if 'Accept' in request.headers and request.headers['Accept'] == "application/json":
         response.content_type = 'application/json'
@@ -134,39 +246,121 @@ def metadata(collection_id, item_id):
     url = request.url
     if not 'items' in url:
         url = url.replace(item_id, "items/%s" % item_id)
-    output = alveo.get_item_metadata(url)
+    check_graph(url)
+    output = alveo.get_item_metadata_json(url)
     if 'Accept' in request.headers and request.headers['Accept'] == "application/json":
         response.content_type = 'application/json'
-        output = json.dumps(output)
     else:
-        output = {"vars":output}
+        output = {"vars":json.loads(output)}
     return output
 
+def json_array(parts):
+    """generate a JSON array from the JSON text of its elements"""
+
+    yield "["
+    for i, part in enumerate(parts):
+        if i:
+            yield ",\n"
+        yield part
+    yield "]"
+
+@application.post('/catalog/metadata')
+def batch_metadata():
+    """metadata for a list of item URLs, given as {"items": [...]} or a
+    plain list, streamed as a JSON array or as NDJSON if asked for"""
+
+    input_data = request.json
+    if isinstance(input_data, dict):
+        input_data = input_data.get("items")
+    if not isinstance(input_data, list):
+        abort(400, "items parameter not an array")
+    results = alveo.get_items_metadata_json(input_data)
+    if 'Accept' in request.headers and request.headers['Accept'] == "application/x-ndjson":
+        response.content_type = 'application/x-ndjson'
+        return (result + "\n" for result in results)
+    response.content_type = 'application/json'
+    return json_array(results)
+
+def send_text(path, found, headers):
+    """send the document at path, found by find_document, with the
+    validator headers from check_file.
+    The file is streamed from disk if it is not compressed or the
+    client accepts its compression, static_file handles Range
+    requests and sets Content-Length"""
+
+    filename, encoding = send_encoding(found)[:2]
+    if encoding is not None or filename == path:
+        extra = {'Vary': headers['Vary']}
+        if encoding is not None:
+            extra['Content-Encoding'] = encoding
+        return static_file(os.path.basename(filename), root=os.path.dirname(filename),
+                           mimetype='text/plain', charset='utf-8',
+                           etag=headers['ETag'], headers=extra)
+
+    # compressed in a way the client can't take
+    data = alveo.text_cache.read(path, None, found[0])
+    response.content_type = 'text/plain; charset=utf-8'
+    response.set_header('Accept-Ranges', 'bytes')
+    if 'Range' in request.headers:
+        ranges = list(parse_range_header(request.headers['Range'], len(data)))
+        if not ranges:
+            abort(416, "Requested Range Not Satisfiable")
+        start, end = ranges[0]
+        response.status = 206
+        response.set_header('Content-Range', "bytes %d-%d/%d" % (start, end - 1, len(data)))
+        data = data[start:end]
+    return data
+
 @application.get('/catalog/<collection_id>/<item_id>/primary_text')
 @view('primary_text')
 def primary_text(collection_id, item_id):
     url = request.url
     url = url.replace("%s/primary_text" % item_id, "items/%s" % item_id)
-    output = alveo.get_primary_text(url)
-    if output == None:
+    path = alveo.get_primary_text_path(url)
+    if path == None:
         abort(404, "Item has no primary text")
-    else:
-        if 'Accept' in request.headers and request.headers['Accept'] == "application/json":
-            response.content_type = 'text/plain'
-        else:
-            output = {'text':output}
-    return output
-    
+    found = find_document(path)
+    headers = check_file(found)
+    if wants_raw():
+        return send_text(path, found, headers)
+    return {'text':alveo.get_primary_text(url)}
+
+@application.get('/catalog/<collection_id>/<item_id>/primary_text/slices')
+def primary_text_slices(collection_id, item_id):
+    """the text under each annotation=<id> and between each pair of
+    start=<offset>&end=<offset> given in the query, as JSON"""
+
+    url = "%scatalog/%s/items/%s" % (alveo.base_url, collection_id, item_id)
+    starts, ends = request.query.getall('start'), request.query.getall('end')
+    if len(starts) != len(ends):
+        abort(400, "start and end must be given in pairs")
+    try:
+        spans = [(int(start), int(end)) for start, end in zip(starts, ends)]
+    except ValueError:
+        abort(400, "start and end must be character offsets")
+    slices = alveo.get_text_slices(url, request.query.getall('annotation'), spans)
+    if slices is None:
+        abort(404, "Item has no primary text")
+    return {'item_url': url, 'slices': slices}
+
 @application.get('/documents/<collection_id>/<file_name>')
 @application.get('/catalog/<collection_id>/<item_id>/document/<file_name>')
 @view('document')
 def document(collection_id, item_id=None, file_name=None):
+    path = alveo.get_document_path(collection_id, file_name)
+    found = find_document(path)
+    headers = check_file(found)
+    if wants_raw():
+        return send_text(path, found, headers)
     output = alveo.get_document(collection_id, file_name)
-    if 'Accept' in request.headers and request.headers['Accept'] == "application/json":
-        response.content_type = 'text/plain'
-    else:
-        output = {'text':output}
-    return output
+    return {'text':output}
+
+@application.get('/stats')
+def stats():
+    """counters for monitoring"""
+
+    return {'text_cache': alveo.text_cache.stats(),
+            'queries': alveo.queries.stats()}
 
 @application.get('/schema/json-ld')
 @view('ann_context')
@@ -179,40 +373,101 @@ def annotation_context():
         output = {"vars":output}
     return output
 
+def query_count(name):
+    """the value of a query parameter that must be a whole number
+    if it is there, None if it isn't"""
+
+    if name not in request.query:
+        return None
+    try:
+        value = int(request.query[name])
+    except ValueError:
+        value = -1
+    if value < 0:
+        abort(400, "%s must be a whole number" % name)
+    return value
+
 @application.get('/catalog/<collection_id>/<item_id>/annotations')
 @view('annotations')
 def annotations(collection_id, item_id):
+    """the annotations of an item, limit and offset give one page of
+    them with a Link to the next. JSON and NDJSON are streamed one
+    annotation at a time"""
+
     input_data = request.query
     url = request.url
     if "?" in url:
         url = url[:url.index("?")]
+    page_url = url
     url = url.replace("%s/annotations" % item_id, "items/%s" % item_id)
-    output = alveo.get_annotations(url, input_data)
+    for key in ("start", "end"):
+        if key in input_data:
+            try:
+                float(input_data[key])
+            except ValueError:
+                abort(400, "%s must be an offset" % key)
+    offset = query_count('offset') or 0
+    limit = query_count('limit')
+    ndjson = 'Accept' in request.headers and request.headers['Accept'] == "application/x-ndjson"
+    check_collection(collection_id)
+    check_graph(url, "ndjson" if ndjson else None)
+    total, anns = alveo.iter_annotations(url, input_data, offset, limit)
+    if limit is not None and offset + limit < total:
+        query = [(k, v) for k, v in request.query.allitems() if k != 'offset']
+        query.append(('offset', offset + limit))
+        response.set_header('Link', '<%s?%s>; rel="next"' % (page_url, urlencode(query)))
+    annotates = alveo._get_display_document_url(url)
+    if ndjson:
+        response.content_type = 'application/x-ndjson'
+        return (json.dumps(annotation) + "\n" for annotation in anns)
     if 'Accept' in request.headers and request.headers['Accept'] == "application/json":
         response.content_type = 'application/json'
-        output = json.dumps(output)
-    else:
-        result = {"context":"https://app.alveo.edu.au/schema/json-ld",
-                  "commonProperties":{},
-                  "annotations":[]}
-        for key in output["commonProperties"].keys():
-            result['commonProperties'][key.replace("alveo:", "")] = output["commonProperties"][key]
-        for annotation in output['alveo:annotations']:
-            temp = {}
-            for key in annotation.keys():
-                value = annotation[key]
-                if key == "@type":
-                    key = "annType"
-                temp[key.replace("@", "")] = value
-            result["annotations"].append(temp)
-        output = result
-    return output
+        head = json.dumps({'@context': "https://app.alveo.edu.au/schema/json-ld",
+                           'commonProperties': {'alveo:annotates': annotates}})
+        return itertools.chain([head[:-1], ', "alveo:annotations": '],
+                               json_array(json.dumps(annotation) for annotation in anns), ["}"])
+    return {"context":"https://app.alveo.edu.au/schema/json-ld",
+            "commonProperties":{"annotates":annotates},
+            "annotations":(html_annotation(annotation) for annotation in anns)}
+
+def html_annotation(annotation):
+    """an annotation with the keys the annotations template uses"""
+
+    result = {}
+    for key, value in annotation.items():
+        if key == "@type":
+            key = "annType"
+        result[key.replace("@", "")] = value
+    return result
+
+def wants_counts():
+    """True if the query asks for the number of annotations of each type"""
+
+    return request.query.get('counts', 'false').lower() not in ('0', 'false', 'no')
 
 @application.route('/catalog/<collection_name>/<item_id>/annotations/types')
 @view('annotation_types')
 def annotation_types(collection_name, item_id):
     url = "http://localhost:3000/catalog/%s/items/%s" %(collection_name, item_id)
-    output = alveo.get_annotation_types(url)
+    check_collection(collection_name)
+    check_graph(url)
+    output = alveo.get_annotation_types(url, wants_counts())
+    if 'Accept' in request.headers and request.headers['Accept'] == "application/json":
+        response.content_type = 'application/json'
+        output = json.dumps(output)
+    else:
+        output = {'vars':output}
+    return output
+
+@application.route('/catalog/<collection_name>/annotations/types')
+@view('annotation_types')
+def collection_annotation_types(collection_name):
+    """the annotation types used across a collection"""
+
+    url = "%scatalog/%s" % (alveo.base_url, collection_name)
+    check_collection(collection_name)
+    check_graph(url)
+    output = alveo.get_collection_annotation_types(url, wants_counts())
     if 'Accept' in request.headers and request.headers['Accept'] == "application/json":
         response.content_type = 'application/json'
         output = json.dumps(output)
@@ -295,6 +550,25 @@ def rename_itemlist(itemlist_id):
         output = json.dumps(output)
     return output
 
+@application.post('/catalog/<collection_id>/annotations')
+def upload_annotations(collection_id):
+    """add many annotation documents at once, sent as NDJSON with one
+    document per line or as a multipart form with any number of files.
+    Each document is parsed as it is reached. A bad document gets a 400
+    whose JSON gives the documents added before it and where it was"""
+
+    collection_uri = "%scatalog/%s" % (alveo.base_url, collection_id)
+    check_collection(collection_id)
+    if request.content_type.startswith('multipart/'):
+        documents = (json.load(upload.file) for upload in request.files.getall('file'))
+    else:
+        documents = (json.loads(line) for line in request.body if line.strip())
+    output = alveo.add_annotations(collection_uri, documents)
+    if "error" in output:
+        response.status = 400
+    response.content_type = 'application/json'
+    return json.dumps(output)
+
 @application.post('/catalog/<collection_id>/<item_id>/annotations')
 @view('upload_ann')
 def upload_annotation(collection_id, item_id):